@@ -100,9 +100,7 @@ overview_query_dict = {
     #     "datecols": ["DATE"],
     # },
 }
-overview_data_dict = {}
-for k, v in overview_query_dict.items():
-    overview_data_dict[k] = utils.load_flipside_api_data(v["api"], v["datecols"])
+overview_data_dict = utils.load_flipside_api_datasets(overview_query_dict)
 overview_data_dict["Fees"] = (
     overview_data_dict["Fees"]
     .copy()
@@ -617,7 +615,12 @@ with programs:
 
 with defi:
     st.header("DeFi")
-    dex_info, dex_new_user, dex_signers_fee_payers = utils.load_defi_data()
+    dex_info_data, dex_new_user_data, dex_signers_fee_payers_data = utils.load_defi_data.dataset()
+    dex_info, dex_new_user, dex_signers_fee_payers = (
+        dex_info_data.df,
+        dex_new_user_data.df,
+        dex_signers_fee_payers_data.df,
+    )
     with st.expander("Expand to see DeFi protocols and their Program IDs"):
         for k, v in utils.dex_programs.items():
             progs = ""
@@ -639,7 +642,7 @@ with defi:
         index=2,
         key="defi_date_range",
     )
-    tx_data, user_data = utils.agg_defi_data(dex_info, date_range)
+    tx_data, user_data = utils.agg_defi_data(dex_info_data, date_range)
     c1, c2 = st.columns(2)
     chart = (
         alt.Chart(tx_data, title=f"DeFi Transactions by Protocol: Daily, Past {date_range}")
@@ -785,7 +788,7 @@ with defi:
         index=5,
         key="signers_fee_payers_select",
     )
-    defi_signers = utils.agg_defi_signers_data(dex_signers_fee_payers, date_range, protocol)
+    defi_signers = utils.agg_defi_signers_data(dex_signers_fee_payers_data, date_range, protocol)
     chart = (
         alt.Chart(defi_signers, title=f"Total Signers vs Fee Payers, {protocol}: Daily, Past {date_range}")
         .mark_area()
@@ -840,7 +843,7 @@ with defi:
     )
     c2.altair_chart(chart, use_container_width=True)
 
-    new_defi_users = utils.agg_new_defi_users_data(dex_new_user, date_range, protocol)
+    new_defi_users = utils.agg_new_defi_users_data(dex_new_user_data, date_range, protocol)
     chart = (
         alt.Chart(
             new_defi_users,
@@ -1,20 +1,88 @@
 #!/usr/bin/env python3
 import datetime
-import gc
-import json
 import logging
-from itertools import combinations
+import os
+import shutil
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
+from scipy import sparse
 
+import spire_fyi.storage as storage
 import spire_fyi.utils as utils
+from spire_fyi.helius_client import HeliusMetadataClient
+from spire_fyi.manifest import CombineWatermark
+from spire_fyi.nft_metadata import NFTMetadataStore
 
 helius_key = st.secrets["helius"]["api_key"]
 
+watermark = CombineWatermark("data/combine_watermark.json")
+
+
+def get_changed_partitions(data_dir, output_files, incremental=True):
+    """Partition signatures of `data_dir`, and the partition keys missing from (or changed since) `output_files`.
+
+    The changed keys are None when the outputs need a full rebuild.
+    """
+    signatures = utils.get_partition_signatures(data_dir)
+    # outputs written before the watermark existed are rebuilt once
+    if not incremental or not all(Path(x).exists() and x in watermark for x in output_files):
+        return signatures, None
+    changed = set()
+    # outputs can be at different watermarks if a previous run was interrupted
+    for x in output_files:
+        done = watermark.get(x)
+        changed |= {k for k, v in signatures.items() if done.get(k) != v}
+        changed |= set(done) - set(signatures)
+    # rows can only be matched back to dated partitions
+    if any(storage.get_file_date(x) is None for x in changed):
+        return signatures, None
+    logging.info(f"#@# {len(changed)} new or changed partitions in {data_dir}")
+    return signatures, changed
+
+
+def read_changed_partitions(data_dir, changed, **kwargs):
+    if changed is None:
+        return utils.combine_flipside_date_data(data_dir, **kwargs)
+    changed = changed & set(utils.get_partition_signatures(data_dir))
+    if not changed:
+        return None
+    return utils.combine_flipside_date_data(data_dir, dates=changed, **kwargs)
+
+
+def read_program_partitions(data_dir, changed=None, **kwargs):
+    df = read_changed_partitions(data_dir, changed, add_date=False, rename_columns={"DATE": "Date"}, **kwargs)
+    if df is not None:
+        df["PROGRAM_ID"] = df["PROGRAM_ID"].apply(
+            lambda x: "11111111111111111111111111111111" if x == "1.1111111111111112e+31" else x
+        )
+    return df
+
+
+def update_combined_data(df, output_file, signatures, changed, date_col):
+    """Write `df` to `output_file`, or (when `changed` is not None) replace the rows of the `changed` partitions in it.
+
+    New partitions are appended (as an extra gzip member for .gz files) without reading the
+    existing output; only changed or removed partitions need a rewrite.
+    """
+    compression = "gzip" if str(output_file).endswith(".gz") else None
+    if changed is None:
+        df.to_csv(output_file, index=False, compression=compression)
+    elif changed:
+        replaced = changed & set(watermark.get(output_file))
+        columns = pd.read_csv(output_file, nrows=0).columns
+        if df is not None and not replaced and set(columns) == set(df.columns):
+            df[columns].to_csv(output_file, mode="a", header=False, index=False, compression=compression)
+        else:
+            old_df = pd.read_csv(output_file)
+            old_dates = pd.to_datetime(old_df[date_col], utc=True).dt.strftime("%Y-%m-%d")
+            old_df = old_df[~old_dates.isin(replaced)]
+            pd.concat([old_df, df]).to_csv(output_file, index=False, compression=compression)
+    watermark.set(output_file, signatures)
+
 
 def get_labeled_program_df(df, programs):
     all_programs_df = pd.DataFrame({"ProgramID": pd.unique(programs)})
@@ -26,131 +94,64 @@ def get_labeled_program_df(df, programs):
     return all_programs_df
 
 
-def get_net_and_programs(labeled_programs, signers, label, cutoff_date):
+def get_program_overlap(df, programs, program_col="Program ID", user_col="Address", min_users=10):
+    """Overlap and Jaccard weight of the users of every pair of `programs`.
+
+    Addresses are encoded to integer ids and put in a sparse program x user incidence matrix
+    `M`, so all pairwise overlaps come from a single product `M @ M.T`. Pairs are returned in
+    `itertools.combinations(programs, 2)` order, skipping programs with fewer than `min_users`.
+    """
+    pairs = df[[program_col, user_col]].drop_duplicates()
+    rows = pd.Index(programs).get_indexer(pairs[program_col])
+    pairs = pairs[rows >= 0]
+    rows = rows[rows >= 0]
+    cols, _ = pd.factorize(pairs[user_col])
+    m = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(programs), cols.max() + 1 if len(cols) else 0),
+    )
+    n_users = np.asarray(m.sum(axis=1)).ravel()
+    overlap = (m @ m.T).toarray()
+
+    i, j = np.triu_indices(len(programs), k=1)
+    keep = (n_users[i] >= min_users) & (n_users[j] >= min_users)
+    i, j = i[keep], j[keep]
+    n_overlap = overlap[i, j]
+    return i, j, n_overlap / (n_users[i] + n_users[j] - n_overlap)
+
+
+def get_net_and_programs(labeled_programs, signers, label, cutoff_date, n=30):
     programs_labeled = labeled_programs.copy()[labeled_programs.LABEL != "solana"]
     programs_labeled = programs_labeled[programs_labeled.Date >= cutoff_date]
-    programs = utils.get_program_ids(programs_labeled)
+    programs = utils.get_program_ids(programs_labeled, n)
 
     df = signers.copy()
     df["Date"] = pd.to_datetime(df.Date, utc=True)
     df = df[df.Date >= cutoff_date]
     df = df[df["Program ID"].isin(programs)]
 
-    combos = list(combinations(programs, 2))
-
-    labels = programs_labeled.groupby("PROGRAM_ID").Name.first().reset_index()
-    df = df.merge(labels.rename(columns={"PROGRAM_ID": "Program ID"}), on="Program ID")
-
-    prog_user_dict = {}
-    for x in programs:
-        try:
-            prog_user_dict[x] = (
-                df[df["Program ID"] == x].Name.iloc[0],
-                df[df["Program ID"] == x].Address.unique(),
-            )
-        except IndexError:
-            print(x)
-            prog_user_dict[x] = (
-                x,
-                np.array([]),
-            )
-
-    df_list = []
-    for i, j in combos:
-        name1, prog1_users = prog_user_dict[i]
-        name2, prog2_users = prog_user_dict[j]
-        if len(prog1_users) < 10 or len(prog2_users) < 10:
-            continue
-        else:
-            all_users = np.union1d(prog1_users, prog2_users)
-            overlap = np.intersect1d(prog1_users, prog2_users, assume_unique=True)
-
-            n_users = len(all_users)
-            n_overlap = len(overlap)
-
-            df_dict = {}
-            df_dict["Program1"] = i
-            df_dict["Program2"] = j
-            df_dict["Name1"] = name1
-            df_dict["Name2"] = name2
-            df_dict["weight"] = n_overlap / n_users
-            df_dict["Timedelta"] = label
+    labels = programs_labeled.groupby("PROGRAM_ID").Name.first()
+    names = labels.reindex(programs)
+    missing = ~pd.Index(programs).isin(df["Program ID"])
+    for x in np.asarray(programs)[missing]:
+        logging.info(f"#@# No signers for {x} since {cutoff_date}, using its address as its name")
+    names[missing] = np.asarray(programs)[missing]
 
-            df_list.append(df_dict)
-    net_df = pd.DataFrame(df_list)
+    i, j, weight = get_program_overlap(df, programs)
+    net_df = pd.DataFrame(
+        {
+            "Program1": np.asarray(programs)[i],
+            "Program2": np.asarray(programs)[j],
+            "Name1": names.values[i],
+            "Name2": names.values[j],
+            "weight": weight,
+            "Timedelta": label,
+        }
+    )
 
     return net_df, programs
 
 
-def get_top_creator_info(creators):
-    data = {"creator_address": "", "creator_share": 0}
-    for x in creators:
-        if x["share"] > data["creator_share"]:
-            data["creator_share"] = x["share"]
-            data["creator_address"] = x["address"]
-    return data
-
-
-def get_important_metadata(enumerated_splits, filehandle):
-    url = f"https://api.helius.xyz/v0/tokens/metadata?api-key={helius_key}"
-    important_metadata = []
-    mints_no_metadata = []
-    for i, x in enumerated_splits:
-        if i % 100 == 0:
-            logging.info(f"Working on request {i}")
-        mints = x.tolist()
-        r = requests.post(url, json={"mintAccounts": mints})
-        metadata = r.json()
-        for y in metadata:
-            mint = y["mint"]
-            filehandle.write(f"{mint}\n")
-            try:
-                onchain = y["onChainData"]
-                onchaindata = onchain["data"]
-            except:
-                mints_no_metadata.append(mint)
-                continue
-
-            try:
-                name = onchaindata["name"]
-            except:
-                name = ""
-            try:
-                symbol = onchaindata["symbol"]
-            except:
-                symbol = ""
-            try:
-                seller_fee_basis_points = onchaindata["sellerFeeBasisPoints"]
-            except:
-                seller_fee_basis_points = 0
-            try:
-                uri = onchaindata["uri"]
-            except:
-                uri = ""
-            try:
-                update_authority = onchain["updateAuthority"]
-            except:
-                update_authority = ""
-            try:
-                creator_info = get_top_creator_info(onchaindata["creators"])
-            except:
-                creator_info = {"creator_address": "", "creator_share": 0}
-
-            data = {
-                "mint": mint,
-                "name": name,
-                "symbol": symbol,
-                "seller_fee_basis_points": seller_fee_basis_points,
-                "uri": uri,
-                "update_authority": update_authority,
-                **creator_info,
-            }
-            with open(f"data/nft_metadata/{mint}.json", "w") as f:
-                json.dump(data, f)
-            important_metadata.append(data)
-    return pd.DataFrame(important_metadata), mints_no_metadata
-
-
 def fix_carriage_return_error(df):
     """There is a `\r` character in some NFT metadata, which breaks parsing.
     Hack to fix this
@@ -206,6 +207,238 @@ def fix_carriage_return_error(df):
     return df
 
 
+def get_date_chunks(data_dir, max_bytes, start_date=None):
+    """Group the dated partitions in `data_dir` into consecutive chunks of at most `max_bytes` of csv each."""
+    sizes = {}
+    for x in Path(data_dir).glob("*.csv"):
+        date = storage.get_file_date(x)
+        if date is None or (start_date is not None and date < start_date):
+            continue
+        sizes[date] = sizes.get(date, 0) + x.stat().st_size
+    chunks = []
+    current, total = [], 0
+    for date in sorted(sizes):
+        if current and total + sizes[date] > max_bytes:
+            chunks.append(current)
+            current, total = [], 0
+        current.append(date)
+        total += sizes[date]
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def spill_royalty_tx(chunks, spill_dir, data_dir="data/sdk_nft_royalty_tx"):
+    """Split the (per collection) royalty transactions into one csv per date chunk, reading a file at a time.
+
+    Returns the royalty columns, so chunks without any royalty transactions can still be joined.
+    """
+    chunk_of_date = {date: i for i, chunk in enumerate(chunks) for date in chunk}
+    spill_dir.mkdir(exist_ok=True, parents=True)
+    columns = None
+    for x in sorted(Path(data_dir).glob("*.csv")):
+        try:
+            df = utils.read_flipside_date_file(x).drop(columns="__ROW_INDEX", errors="ignore")
+        except Exception as e:
+            logging.info(f"[ERROR] ({x}) {e}")
+            continue
+        if columns is None:
+            columns = list(df.columns)
+        dates = pd.to_datetime(df["BLOCK_TIMESTAMP"], utc=True).dt.strftime("%Y-%m-%d")
+        for i, chunk_df in df[columns].groupby(dates.map(chunk_of_date)):
+            spill_file = Path(spill_dir, f"chunk_{int(i)}.csv")
+            chunk_df.to_csv(spill_file, mode="a", header=not spill_file.exists(), index=False)
+    return columns
+
+
+def add_royalty_columns(nft_mints_df):
+    nft_mints_df["royalty_percentage"] = nft_mints_df.seller_fee_basis_points / 10000
+    nft_mints_df["total_royalty_amount"] = nft_mints_df.ROYALTY_AMOUNT / (nft_mints_df.creator_share / 100)
+
+    nft_mints_df["expected_royalty"] = nft_mints_df.SALES_AMOUNT * nft_mints_df.royalty_percentage
+    nft_mints_df["royalty_diff"] = nft_mints_df.total_royalty_amount - nft_mints_df.expected_royalty
+
+    nft_mints_df["royalty_percent_paid"] = nft_mints_df.total_royalty_amount / nft_mints_df.SALES_AMOUNT
+
+    nft_mints_df["paid_royalty"] = (nft_mints_df.ROYALTY_AMOUNT > 0) | (nft_mints_df.royalty_percentage == 0)
+    nft_mints_df["paid_full_royalty"] = np.isclose(
+        nft_mints_df.expected_royalty, nft_mints_df.total_royalty_amount, atol=0.001
+    )
+    nft_mints_df["paid_half_royalty"] = (
+        np.isclose(nft_mints_df.expected_royalty / 2, nft_mints_df.total_royalty_amount, atol=0.001)
+    ) & (nft_mints_df.royalty_percentage != 0)
+    # TODO: add this in, remove from utils
+    # df["paid_full_royalty"] = (df["paid_full_royalty"] | (df.total_royalty_amount > df.expected_royalty))
+    return nft_mints_df
+
+
+def write_chunk(df, output_file, columns):
+    """Append `df` to a gzipped csv, with the columns of the first chunk written to it."""
+    if output_file not in columns:
+        columns[output_file] = list(df.columns)
+        df.to_csv(output_file, index=False, compression="gzip")
+    else:
+        df.reindex(columns=columns[output_file]).to_csv(
+            output_file, mode="a", header=False, index=False, compression="gzip"
+        )
+
+
+def combine_nft_data(metadata_store, start_date, max_chunk_bytes=256 * 2**20):
+    """Build the nft sales and royalty datasets in date chunks, so memory is bounded by the chunk size.
+
+    Each chunk of mint partitions is joined to the metadata of its mints, looked up by key in
+    `metadata_store`, and to its royalty transactions, and appended to the outputs.
+    `unique_collection_mints` and the top collections are combined from
+    per-chunk aggregates, and the top collection sales are then filtered from the written
+    metadata output in a second streaming pass. Outputs are only moved into place once complete.
+    """
+    chunks = get_date_chunks("data/sdk_nft_mints", max_chunk_bytes, start_date)
+    spill_dir = Path("data/nft_royalty_chunks")
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    royalty_columns = spill_royalty_tx(chunks, spill_dir)
+
+    outputs = {
+        x: Path(f"{x}.tmp")
+        for x in [
+            "data/nft_mints.csv.gz",
+            "data/nft_sales_with_royalties.csv.gz",
+            "data/nft_sales_metadata_with_royalties.csv.gz",
+            "data/top_nft_sales_metadata_with_royalties.csv.gz",
+        ]
+    }
+    try:
+        write_nft_outputs(metadata_store, start_date, chunks, spill_dir, royalty_columns, outputs)
+    except BaseException:
+        # leave the previous outputs in place, and nothing half-written next to them
+        for tmp in outputs.values():
+            tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    for output_file, tmp in outputs.items():
+        if tmp.exists():
+            os.replace(tmp, output_file)
+
+
+def write_nft_outputs(metadata_store, start_date, chunks, spill_dir, royalty_columns, outputs):
+    """The body of `combine_nft_data`, writing each output to its `.tmp` file in `outputs`."""
+    columns = {}
+    collection_mints = []
+    recent_sales = []
+    cutoff = datetime.datetime.today() - pd.Timedelta("31d")
+    for i, dates in enumerate(chunks):
+        logging.info(f"#@# NFT chunk {i + 1}/{len(chunks)}: {dates[0]} to {dates[-1]}")
+        nft_mints_df = utils.combine_flipside_date_data("data/sdk_nft_mints", add_date=False, dates=dates)
+        nft_mints_df["BLOCK_TIMESTAMP"] = pd.to_datetime(nft_mints_df["BLOCK_TIMESTAMP"], utc=True)
+        nft_mints_df = nft_mints_df[nft_mints_df["BLOCK_TIMESTAMP"] >= start_date]
+        nft_mints_df = nft_mints_df.merge(
+            metadata_store.get(nft_mints_df.MINT.astype(str).unique()).rename(columns={"mint": "MINT"}),
+            on="MINT",
+            how="left",
+        )
+        write_chunk(nft_mints_df, outputs["data/nft_mints.csv.gz"], columns)
+        nft_mints_df = fix_carriage_return_error(nft_mints_df)
+
+        # #TODO: need to get rid of duplicates
+        spill_file = Path(spill_dir, f"chunk_{i}.csv")
+        if spill_file.exists():
+            unique_collection_df = pd.read_csv(spill_file)
+        else:
+            unique_collection_df = pd.DataFrame(
+                columns=royalty_columns
+                or ["BLOCK_TIMESTAMP", "TX_ID", "MINT", "SALES_AMOUNT", "ROYALTY_AMOUNT"]
+            )
+        unique_collection_df["BLOCK_TIMESTAMP"] = pd.to_datetime(
+            unique_collection_df["BLOCK_TIMESTAMP"], utc=True
+        ).dt.tz_localize(None)
+        unique_collection_df = unique_collection_df.astype({"SALES_AMOUNT": float, "ROYALTY_AMOUNT": float})
+        nft_mints_df = nft_mints_df.merge(
+            unique_collection_df, on=["BLOCK_TIMESTAMP", "TX_ID", "MINT", "SALES_AMOUNT"], how="left"
+        )
+        nft_mints_df = add_royalty_columns(nft_mints_df)
+        # save full data
+        write_chunk(nft_mints_df, outputs["data/nft_sales_with_royalties.csv.gz"], columns)
+
+        # only datasets with metadata:
+        metadata_df = nft_mints_df[~((nft_mints_df.name == "") & (nft_mints_df.symbol == ""))].copy()
+        del nft_mints_df
+        if len(metadata_df) == 0:
+            continue
+        metadata_df["collection_name"] = get_collection_names(metadata_df)
+        metadata_df["unique_collection"] = metadata_df.collection_name + "-" + metadata_df.creator_address
+        # save all metadata datasets
+        write_chunk(metadata_df, outputs["data/nft_sales_metadata_with_royalties.csv.gz"], columns)
+
+        collection_mints.append(
+            metadata_df.groupby(["collection_name", "creator_address"]).agg(
+                mints=("MINT", "unique"), total_sales=("SALES_AMOUNT", "sum")
+            )
+        )
+        recent_sales.append(
+            metadata_df[metadata_df.BLOCK_TIMESTAMP > cutoff].groupby("unique_collection").SALES_AMOUNT.sum()
+        )
+        del metadata_df
+
+    metadata_file = outputs["data/nft_sales_metadata_with_royalties.csv.gz"]
+    top_file = outputs["data/top_nft_sales_metadata_with_royalties.csv.gz"]
+    if not collection_mints:
+        logging.info("#@# No nft sales with metadata, writing empty collection outputs")
+        sales_columns = columns.get(outputs["data/nft_sales_with_royalties.csv.gz"], [])
+        metadata_columns = [*sales_columns, "collection_name", "unique_collection"]
+        write_chunk(pd.DataFrame(columns=metadata_columns), metadata_file, columns)
+        collection_mints = [
+            pd.DataFrame(
+                {"mints": pd.Series(dtype=object), "total_sales": pd.Series(dtype=float)},
+                index=pd.MultiIndex.from_arrays([[], []], names=["collection_name", "creator_address"]),
+            )
+        ]
+        recent_sales = [pd.Series(dtype=float, name="SALES_AMOUNT")]
+
+    # get unique_collection_mints
+    unique_collection_mints = (
+        pd.concat(collection_mints)
+        .groupby(level=["collection_name", "creator_address"])
+        .agg(
+            mints=("mints", lambda x: pd.unique(np.concatenate(x.values))),
+            total_sales=("total_sales", "sum"),
+        )
+        .reset_index()
+    )
+    unique_collection_mints["total_mints"] = unique_collection_mints["mints"].map(len)
+    unique_collection_mints = unique_collection_mints[
+        unique_collection_mints.total_sales >= unique_collection_mints.total_sales.quantile(0.5)
+    ].sort_values(by="total_mints", ascending=False)
+    unique_collection_mints["mints"] = unique_collection_mints["mints"].apply(lambda x: x.tolist())
+    unique_collection_mints.to_csv("data/unique_collection_mints.csv", index=False)
+
+    # get 99th percentile, ~top 75
+    total_sales = (
+        pd.concat(recent_sales).groupby(level=0).sum().rename_axis("unique_collection").reset_index()
+    )
+    top_collections = total_sales[
+        total_sales.SALES_AMOUNT > total_sales.SALES_AMOUNT.quantile(0.99)
+    ].sort_values("SALES_AMOUNT", ascending=False)
+
+    # manual labeled collections from the above dataset
+    labels = pd.read_csv("data/labeled_collections_by_uri.csv")  # #TODO: need to manually update this
+    labeled = labels.unique_collection[labels.Name.notna()]
+    unlabeled = top_collections.unique_collection[~top_collections.unique_collection.isin(labeled)]
+    if len(unlabeled):
+        raise ValueError(
+            f"{len(unlabeled)} top nft collections have no Name in data/labeled_collections_by_uri.csv, "
+            f"label them and run again: {unlabeled.tolist()}"
+        )
+    for metadata_df in pd.read_csv(metadata_file, compression="gzip", chunksize=500000):
+        metadata_df = metadata_df[metadata_df.unique_collection.isin(top_collections.unique_collection)]
+        metadata_df = metadata_df.merge(labels, on="unique_collection", how="left")
+        write_chunk(metadata_df, top_file, columns)
+    if top_file not in columns:
+        # no metadata rows at all, still write the columns
+        metadata_df = pd.read_csv(metadata_file, compression="gzip", nrows=0)
+        write_chunk(metadata_df.merge(labels, on="unique_collection", how="left"), top_file, columns)
+
+
 def get_collection_name(row):
     s = row["symbol"].strip()
     try:
@@ -250,48 +483,150 @@ def get_collection_name(row):
         return row.creator_address.strip()
 
 
+def join_tokens(tokens, keep):
+    """Join the `keep`-ed tokens of each row of an exploded token series with spaces."""
+    joined = tokens[keep].groupby(level=0).agg(" ".join).str.strip()
+    return joined.reindex(tokens.index.unique()).fillna("")
+
+
+def get_collection_names(df):
+    """Column-wise `get_collection_name`, evaluated once per distinct (name, symbol, creator_address)."""
+    cols = ["name", "symbol", "creator_address"]
+    codes = df.groupby(cols, sort=False, dropna=False).ngroup().to_numpy()
+    u = df[cols].drop_duplicates().reset_index(drop=True)
+    for col in ["name", "symbol"]:
+        # as `get_collection_name`, which fails on them, rather than silently naming them
+        not_str = ~u[col].map(type).eq(str)
+        if not_str.any():
+            raise TypeError(f"nft metadata has non-string {col} values: {u[col][not_str].head().tolist()}")
+
+    s = u.symbol.str.strip()
+    n = u.name.str.strip()
+    # the creator is only used as the fallback name, so may be missing
+    creator = u.creator_address.map(lambda x: x.strip() if isinstance(x, str) else x)
+
+    n_hash = n.str.count("#")
+    has_hash = n_hash > 0
+    one_hash = n_hash == 1
+    before_hash = n.str.split("#", n=1).str[0]
+    after_hash = n.str.split("#", n=1).str[1].fillna("")
+    after_hash_numeric = after_hash.str.strip().str.isnumeric()
+    # "#<number> <words>": the alphanumeric words after the number
+    tokens = after_hash.str.split().explode()
+    position = tokens.groupby(level=0).cumcount()
+    first_token_numeric = tokens[position == 0].str.isnumeric().reindex(u.index, fill_value=False)
+    numbered_words = join_tokens(tokens, (position > 0) & tokens.str.isalnum().fillna(False))
+    # "TYR-...": the alphabetic parts
+    dash_parts = n.str.split("-").explode()
+    tyr_words = join_tokens(dash_parts, dash_parts.str.isalpha().fillna(False))
+    last_numeric = n.str[-1].str.isnumeric().fillna(False)
+
+    conditions = [
+        s != "",
+        has_hash & ~one_hash,
+        has_hash & n.str.startswith("#") & after_hash_numeric,
+        has_hash & n.str.startswith("#") & first_token_numeric,
+        has_hash & n.str.startswith("#"),
+        has_hash & after_hash_numeric,
+        # a single "#" that is not followed by a number has no collection name
+        has_hash,
+        n.str.contains(":", regex=False),
+        n.str.contains("|", regex=False),
+        n.str.contains("-", regex=False) & (n.str.split("-").str[0] == "TYR"),
+        n.str.contains("-", regex=False),
+        ~last_numeric,
+    ]
+    choices = [
+        s,
+        before_hash.str.strip(),
+        creator,
+        numbered_words,
+        creator,
+        before_hash.str.strip(),
+        np.full(len(u), None, dtype=object),
+        n.str.split(":").str[0].str.strip(),
+        n.str.split("|").str[0].str.strip(),
+        tyr_words,
+        n.str.split("-").str[0].str.strip(),
+        n,
+    ]
+    names = np.select(
+        [np.asarray(x, dtype=bool) for x in conditions],
+        [np.asarray(x, dtype=object) for x in choices],
+        default=np.asarray(creator, dtype=object),
+    )
+    return pd.Series(names[codes], index=df.index)
+
+
 # #TODO: add to cli
 if __name__ == "__main__":
     do_main = True
+    # only read and append partitions that are new or changed since the last combine
+    incremental = True
     do_network = False
     do_nft = False
-    combine_nft = False
+    # the nft sales are processed in date chunks of about this many MB of raw csv at a time
+    nft_chunk_mb = 256
     # TODO: need to update helius get_mintlist to new API
     do_xnft = False
     do_fees = True
     do_madlad_metadata = True
     do_staking_report = True
+    # program, staker and LST addresses are interned as they are combined, and saved at the end
+    address_dictionary = utils.get_address_dictionary()
 
     if do_main:
-        dfs = []
-        for x in [
-            ("data/sdk_programs_sol", "data/programs.csv.gz"),
-            ("data/sdk_programs_new_users_sol", "data/programs_new_users.csv.gz"),
-            ("data/sdk_programs_all_signers_sol", "data/programs_all_signers.csv.gz"),
-            ("data/sdk_programs_new_users_all_signers_sol", "data/programs_new_users_all_signers.csv.gz"),
-        ]:
-            data, output_file = x
-            df = utils.combine_flipside_date_data(data, add_date=False, rename_columns={"DATE": "Date"})
-            df["PROGRAM_ID"] = df["PROGRAM_ID"].apply(
-                lambda x: "11111111111111111111111111111111" if x == "1.1111111111111112e+31" else x
-            )
-            df.to_csv(output_file, index=False, compression="gzip")
-            dfs.append(df)
-        program_df = pd.concat(dfs)
-        utils.get_flipside_labels(program_df, "all_programs", "PROGRAM_ID")
-        utils.get_solana_fm_labels(program_df, "all_programs", "PROGRAM_ID")
-
-        for data, output_file in zip(
-            dfs,
-            [
-                "data/programs_labeled.csv.gz",
+        program_outputs = [
+            ("data/sdk_programs_sol", "data/programs.csv.gz", "data/programs_labeled.csv.gz"),
+            (
+                "data/sdk_programs_new_users_sol",
+                "data/programs_new_users.csv.gz",
                 "data/programs_new_users_labeled.csv.gz",
+            ),
+            (
+                "data/sdk_programs_all_signers_sol",
+                "data/programs_all_signers.csv.gz",
                 "data/programs_all_signers_labeled.csv.gz",
+            ),
+            (
+                "data/sdk_programs_new_users_all_signers_sol",
+                "data/programs_new_users_all_signers.csv.gz",
                 "data/programs_new_users_all_signers_labeled.csv.gz",
-            ],
-        ):
-            labeled_program_df = utils.add_program_labels(data, prefix="all_programs")
-            labeled_program_df.to_csv(output_file, index=False, compression="gzip")
+            ),
+        ]
+        dfs = []
+        for data, output_file, labeled_output_file in program_outputs:
+            signatures, changed = get_changed_partitions(
+                data, [output_file, labeled_output_file], incremental
+            )
+            df = read_program_partitions(data, changed)
+            update_combined_data(df, output_file, signatures, changed, "Date")
+            dfs.append((df, labeled_output_file, signatures, changed))
+        new_dfs = [x[0] for x in dfs if x[0] is not None]
+        if new_dfs:
+            program_df = pd.concat(new_dfs)
+            utils.get_flipside_labels(program_df, "all_programs", "PROGRAM_ID", update=incremental)
+            utils.get_solana_fm_labels(program_df, "all_programs", "PROGRAM_ID", update=incremental)
+
+        for data, output_file, signatures, changed in dfs:
+            labeled_program_df = None
+            if data is not None:
+                address_dictionary.add(data.PROGRAM_ID)
+                labeled_program_df = utils.add_program_labels(data, prefix="all_programs")
+            update_combined_data(labeled_program_df, output_file, signatures, changed, "Date")
+
+        # the top program rankings are relative to today, so they are rebuilt even if nothing changed,
+        # from only the partitions within the longest ranked date range
+        today = pd.Timestamp.now(tz="UTC")
+        ranking_start = today - max(pd.Timedelta(x) for x in utils.PROGRAM_DATE_RANGES)
+        for data, _, labeled_output_file in program_outputs:
+            df = read_program_partitions(data, start_date=ranking_start.strftime("%Y-%m-%d"))
+            if df is None or len(df) == 0:
+                logging.info(f"#@# No {data} partitions since {ranking_start:%Y-%m-%d}, not ranking programs")
+                continue
+            labeled_program_df = utils.add_program_labels(df, prefix="all_programs")
+            labeled_program_df["Date"] = pd.to_datetime(labeled_program_df["Date"], utc=True)
+            utils.write_program_rankings(labeled_program_df, labeled_output_file, today)
 
         # ----------
         # # #NOTE: this section looks at new users, and is not currently used. will be useful when doing network analysis
@@ -340,42 +675,30 @@ if __name__ == "__main__":
         # grouped.to_csv("data/weekly_days_active.csv", index=False)
         # ------
 
-        weekly_program_data = utils.combine_flipside_date_data(
-            "data/sdk_weekly_program_count_sol", add_date=False
-        )
-        weekly_program_data.to_csv("data/weekly_program.csv", index=False)
-
-        weekly_new_program_data = utils.combine_flipside_date_data(
-            "data/sdk_weekly_new_program_count_sol",
-            add_date=False,
-            rename_columns={"NEW PROGRAMS": "New Programs"},
-        )
-        weekly_new_program_data.to_csv("data/weekly_new_program.csv", index=False)
-
-        weekly_user_data = utils.combine_flipside_date_data("data/sdk_weekly_users_sol", add_date=False)
-        weekly_user_data.to_csv("data/weekly_users.csv", index=False)
-        weekly_new_user_data = utils.combine_flipside_date_data(
-            "data/sdk_weekly_new_users_sol", add_date=False
-        )
-        weekly_new_user_data.to_csv("data/weekly_new_users.csv", index=False)
-
-        weekly_user_all_signers_data = utils.combine_flipside_date_data(
-            "data/sdk_weekly_users_all_signers_sol", add_date=False
-        )
-        weekly_user_all_signers_data.to_csv("data/weekly_users_all_signers.csv", index=False)
-        weekly_new_user_all_signers_data = utils.combine_flipside_date_data(
-            "data/sdk_weekly_new_users_all_signers_sol", add_date=False
-        )
-        weekly_new_user_all_signers_data.to_csv("data/weekly_new_users_all_signers.csv", index=False)
-
-        dex_new_users = utils.combine_flipside_date_data("data/sdk_dex_new_users", add_date=False)
-        dex_new_users.to_csv("data/dex_new_users.csv", index=False)
-
-        dex = utils.combine_flipside_date_data("data/sdk_dex", add_date=False)
-        dex.to_csv("data/dex_info.csv", index=False)
-
-        signers_fee_payers = utils.combine_flipside_date_data("data/sdk_openbook_users", add_date=False)
-        signers_fee_payers.to_csv("data/dex_signers_fee_payers.csv", index=False)
+        for data, output_file, date_col, rename_columns in [
+            ("data/sdk_weekly_program_count_sol", "data/weekly_program.csv", "WEEK", None),
+            (
+                "data/sdk_weekly_new_program_count_sol",
+                "data/weekly_new_program.csv",
+                "WEEK",
+                {"NEW PROGRAMS": "New Programs"},
+            ),
+            ("data/sdk_weekly_users_sol", "data/weekly_users.csv", "WEEK", None),
+            ("data/sdk_weekly_new_users_sol", "data/weekly_new_users.csv", "WEEK", None),
+            ("data/sdk_weekly_users_all_signers_sol", "data/weekly_users_all_signers.csv", "WEEK", None),
+            (
+                "data/sdk_weekly_new_users_all_signers_sol",
+                "data/weekly_new_users_all_signers.csv",
+                "WEEK",
+                None,
+            ),
+            ("data/sdk_dex_new_users", "data/dex_new_users.csv", "FIRST_TX_DATE", None),
+            ("data/sdk_dex", "data/dex_info.csv", "DATE", None),
+            ("data/sdk_openbook_users", "data/dex_signers_fee_payers.csv", "DATE", None),
+        ]:
+            signatures, changed = get_changed_partitions(data, [output_file], incremental)
+            df = read_changed_partitions(data, changed, add_date=False, rename_columns=rename_columns)
+            update_combined_data(df, output_file, signatures, changed, date_col)
 
         # #---
         # #TODO: need to divide the ~500k+ addresses into ~10 queries to add labels, if necessary
@@ -400,12 +723,10 @@ if __name__ == "__main__":
         )
 
         labeled_program_df["Date"] = pd.to_datetime(labeled_program_df.Date, utc=True)
-        labeled_program_df["Name"] = labeled_program_df.apply(utils.apply_program_name, axis=1)
+        labeled_program_df["Name"] = utils.get_program_names(labeled_program_df)
 
         labeled_program_new_users_df["Date"] = pd.to_datetime(labeled_program_new_users_df.Date, utc=True)
-        labeled_program_new_users_df["Name"] = labeled_program_new_users_df.apply(
-            utils.apply_program_name, axis=1
-        )
+        labeled_program_new_users_df["Name"] = utils.get_program_names(labeled_program_new_users_df)
 
         cutoff_dates = [
             ("7d", datetime.datetime.today() - pd.Timedelta("8d")),
@@ -449,148 +770,37 @@ if __name__ == "__main__":
         all_programs_new_users_df.to_csv("data/all_programs_new_users.csv", index=False)
 
     if do_nft:
-        if do_main:
-            # Clear memory so this runs on my laptop
-            del program_df
-            del labeled_program_df
-            del program_new_users_df
-            del labeled_program_new_users_df
-            del user_df
-            del last30d_users
-            del grouped
-            del weekly_program_data
-            del weekly_new_program_data
-            del weekly_user_data
-            del weekly_new_user_data
-        if do_network:
-            del signers_by_programID
-            del signers_by_programID_new_users
-            del all_net_df
-            del all_programs_df
-            del all_net_df_new_users
-            del all_programs_new_users_df
-        gc.collect()
-
-        nft_mints_df = utils.combine_flipside_date_data("data/sdk_nft_mints", add_date=False)
-        nft_mints_df["BLOCK_TIMESTAMP"] = pd.to_datetime(nft_mints_df["BLOCK_TIMESTAMP"], utc=True)
         # #TODO: eventually do all dates, for now just since right before royalties turned off
-        nft_mints_df = nft_mints_df[nft_mints_df["BLOCK_TIMESTAMP"] >= "2022-10-07"]
-        all_mints = sorted(nft_mints_df.MINT.astype(str).unique())
-
-        checked_for_metadata_file = "data/checked_for_metadata.txt"
-        with open("data/checked_for_metadata.txt", "r+") as f:
-            completed_metadata = [x.strip() for x in f]
-            mints_to_check = np.setdiff1d(all_mints, completed_metadata)
-
-            n_splits = np.ceil(len(mints_to_check) / 100)
-            if n_splits == 0:
-                logging.info("#@# No new mints to  check")
-            else:
-                all_mint_splits = np.array_split(mints_to_check, n_splits)
-                logging.info(
-                    f"#@# Using Helius get metadata for {len(mints_to_check)} of {len(all_mints)} divided into {len(all_mint_splits)} requests..."
-                )
-                all_mints_metadata, mints_no_metadata = get_important_metadata(enumerate(all_mint_splits), f)
-                # #TODO: remove, not necessary:
-                # with open("data/mints_no_metadata.txt", "w") as f:
-                #     f.writelines(f"{x}\n" for x in mints_no_metadata)
-        if len(mints_to_check) != len(all_mints):
-            json_data = []
-            for x in Path("data/nft_metadata").glob("*.json"):
-                with open(x) as f:
-                    data = json.load(f)
-                    json_data.append(data)
-            all_mints_metadata = pd.DataFrame(json_data)
-        all_mints_metadata.to_csv("data/nft_mints_metadata.csv.gz", compression="gzip", index=False)
-
-        nft_mints_df = nft_mints_df.merge(
-            all_mints_metadata.rename(columns={"mint": "MINT"}), on="MINT", how="left"
-        )
-        nft_mints_df.to_csv("data/nft_mints.csv.gz", compression="gzip", index=False)
-
-        if not do_nft and combine_nft:
-            nft_mints_df = pd.read_csv("data/nft_mints.csv.gz")
-        nft_mints_df = fix_carriage_return_error(nft_mints_df)
-
-        # #TODO: need to get rid of duplicates
-        unique_collection_df = utils.combine_flipside_date_data(
-            "data/sdk_nft_royalty_tx", add_date=False, nft_royalty=True
-        )
-        unique_collection_df["BLOCK_TIMESTAMP"] = pd.to_datetime(
-            unique_collection_df["BLOCK_TIMESTAMP"], utc=True
-        )
-
-        nft_mints_df = nft_mints_df.merge(
-            unique_collection_df, on=["BLOCK_TIMESTAMP", "TX_ID", "MINT", "SALES_AMOUNT"], how="left"
-        )
-
-        # Add in useful column
-        nft_mints_df["royalty_percentage"] = nft_mints_df.seller_fee_basis_points / 10000
-        nft_mints_df["total_royalty_amount"] = nft_mints_df.ROYALTY_AMOUNT / (
-            nft_mints_df.creator_share / 100
-        )
-
-        nft_mints_df["expected_royalty"] = nft_mints_df.SALES_AMOUNT * nft_mints_df.royalty_percentage
-        nft_mints_df["royalty_diff"] = nft_mints_df.total_royalty_amount - nft_mints_df.expected_royalty
-
-        nft_mints_df["royalty_percent_paid"] = nft_mints_df.total_royalty_amount / nft_mints_df.SALES_AMOUNT
-
-        nft_mints_df["paid_royalty"] = (nft_mints_df.ROYALTY_AMOUNT > 0) | (
-            nft_mints_df.royalty_percentage == 0
-        )
-        nft_mints_df["paid_full_royalty"] = np.isclose(
-            nft_mints_df.expected_royalty, nft_mints_df.total_royalty_amount, atol=0.001
+        nft_start_date = "2022-10-07"
+        nft_mints_df = utils.combine_flipside_date_data(
+            "data/sdk_nft_mints",
+            add_date=False,
+            columns=["BLOCK_TIMESTAMP", "MINT"],
+            start_date=nft_start_date,
         )
-        nft_mints_df["paid_half_royalty"] = (
-            np.isclose(nft_mints_df.expected_royalty / 2, nft_mints_df.total_royalty_amount, atol=0.001)
-        ) & (nft_mints_df.royalty_percentage != 0)
-        # TODO: add this in, remove from utils
-        # df["paid_full_royalty"] = (df["paid_full_royalty"] | (df.total_royalty_amount > df.expected_royalty))
-        # save full data
-        nft_mints_df.to_csv("data/nft_sales_with_royalties.csv.gz", compression="gzip", index=False)
+        nft_mints_df["BLOCK_TIMESTAMP"] = pd.to_datetime(nft_mints_df["BLOCK_TIMESTAMP"], utc=True)
+        nft_mints_df = nft_mints_df[nft_mints_df["BLOCK_TIMESTAMP"] >= nft_start_date]
+        all_mints = sorted(nft_mints_df.MINT.astype(str).unique())
+        del nft_mints_df
 
-        # only datasets with metadata:
-        metadata_df = nft_mints_df[~((nft_mints_df.name == "") & (nft_mints_df.symbol == ""))]
-        collection_names = metadata_df.copy().apply(get_collection_name, axis=1)
-        metadata_df["collection_name"] = collection_names
-        metadata_df["unique_collection"] = metadata_df.collection_name + "-" + metadata_df.creator_address
-        # save all metadata datasets
-        metadata_df.to_csv("data/nft_sales_metadata_with_royalties.csv.gz", compression="gzip", index=False)
+        metadata_store = NFTMetadataStore("data/nft_metadata.db")
+        if len(metadata_store) == 0:
+            metadata_store.import_legacy("data/nft_metadata", "data/checked_for_metadata.txt")
+        mints_to_check = metadata_store.get_unchecked(all_mints)
 
-        # get unique_collection_mints
-        unique_collection_mints = (
-            metadata_df.groupby(["collection_name", "creator_address"])
-            .agg(
-                mints=("MINT", "unique"), total_sales=("SALES_AMOUNT", "sum"), total_mints=("MINT", "nunique")
+        if len(mints_to_check) == 0:
+            logging.info("#@# No new mints to  check")
+        else:
+            logging.info(
+                f"#@# Using Helius get metadata for {len(mints_to_check)} of {len(all_mints)} mints..."
             )
-            .reset_index()
-        )
-        unique_collection_mints = unique_collection_mints[
-            unique_collection_mints.total_sales >= unique_collection_mints.total_sales.quantile(0.5)
-        ].sort_values(by="total_mints", ascending=False)
-        unique_collection_mints["mints"] = unique_collection_mints["mints"].apply(lambda x: x.tolist())
-        unique_collection_mints.to_csv("data/unique_collection_mints.csv", index=False)
-
-        # get 99th percentile, ~top 75
-        total_sales = (
-            metadata_df[metadata_df.BLOCK_TIMESTAMP > (datetime.datetime.today() - pd.Timedelta("31d"))]
-            .groupby(["unique_collection"])
-            .SALES_AMOUNT.sum()
-            .reset_index()
-        )
-        top_collections = total_sales[
-            total_sales.SALES_AMOUNT > total_sales.SALES_AMOUNT.quantile(0.99)
-        ].sort_values("SALES_AMOUNT", ascending=False)
-        metadata_df = metadata_df[metadata_df.unique_collection.isin(top_collections.unique_collection)]
+            HeliusMetadataClient(helius_key, metadata_store).fetch_missing(mints_to_check)
+        metadata_file = Path("data/nft_mints_metadata.csv.gz.tmp")
+        for i, batch in enumerate(metadata_store.iter_frames()):
+            batch.to_csv(metadata_file, mode="a" if i else "w", header=not i, index=False, compression="gzip")
+        os.replace(metadata_file, "data/nft_mints_metadata.csv.gz")
 
-        # manual labeled collections from the above dataset
-        labels = pd.read_csv("data/labeled_collections_by_uri.csv")  # #TODO: need to manually update this
-        metadata_df = metadata_df.merge(labels, on="unique_collection", how="left")
-        x = metadata_df[metadata_df.Name.isna()]
-        assert len(x) == 0
-        metadata_df.to_csv(
-            "data/top_nft_sales_metadata_with_royalties.csv.gz", compression="gzip", index=False
-        )
+        combine_nft_data(metadata_store, nft_start_date, max_chunk_bytes=nft_chunk_mb * 2**20)
 
     if do_xnft:
         xnft_df = utils.combine_flipside_date_data("data/sdk_xnft")
@@ -671,11 +881,10 @@ if __name__ == "__main__":
             drop=[],
             sfm_only=True,
         )
-        labeled_stakers["Name"] = labeled_stakers.apply(
-            utils.apply_program_name, axis=1, address_col="ADDRESS"
-        )
+        address_dictionary.add(labeled_stakers.ADDRESS)
+        labeled_stakers["Name"] = utils.get_program_names(labeled_stakers, address_col="ADDRESS")
         labeled_stakers["Rank"] = labeled_stakers.groupby("DATE")["TOTAL_STAKE"].rank(ascending=False)
-        labeled_stakers["Diff"] = labeled_stakers.groupby(["ADDRESS"]).Rank.diff()
+        labeled_stakers["Diff"] = labeled_stakers.groupby(["ADDRESS"], observed=True).Rank.diff()
         labeled_stakers["DATE"] = pd.to_datetime(labeled_stakers["DATE"], utc=True)
         labeled_stakers = labeled_stakers.sort_values(
             by=["DATE", "TOTAL_STAKE"], ascending=False
@@ -700,31 +909,9 @@ if __name__ == "__main__":
         max_date = labeled_stakers.DATE.max()
         lst_delta_df = lst_delta_df[lst_delta_df.DATE <= max_date].reset_index(drop=True)
         # ---
-        results = []
-        for x in lst_delta_df.ADDRESS.unique():
-            df = lst_delta_df[lst_delta_df.ADDRESS == x]
-            for y in df.TOKEN.unique():
-                results.append(df[df.TOKEN == y].DATE.idxmax())
-        lst_delta_df_copy = lst_delta_df.iloc[results].copy()
-        lst_delta_df_copy["DATE"] = max_date
-        lst_df = pd.concat([lst_delta_df, lst_delta_df_copy])
-
-        # https://stackoverflow.com/a/74039090
-        c = ["ADDRESS", "TOKEN", "TOKEN_NAME", "SYMBOL", "DATE"]
-        m = lst_df[c].duplicated(keep="last")
-        s = (
-            lst_df[~m]
-            .set_index("DATE")
-            .groupby(["ADDRESS", "TOKEN", "TOKEN_NAME", "SYMBOL"])
-            .resample("D")
-            .ffill()
-        )
-        lst_df = (
-            s.droplevel(["ADDRESS", "TOKEN", "TOKEN_NAME", "SYMBOL"])
-            .reset_index()
-            # .sort_values(by=["DATE", "ADDRESS", "TOKEN"])
-            .sort_values(by=["ADDRESS", "TOKEN", "DATE"])
-            .reset_index(drop=True)
+        # latest holdings of every address/token on each day up to max_date
+        lst_df = utils.build_asof_panel(
+            lst_delta_df, ["ADDRESS", "TOKEN", "TOKEN_NAME", "SYMBOL"], date_col="DATE", end_date=max_date
         )
         #     lst_df = lst_df.join(
         #         labeled_stakers['ADDRESS', 'TOTAL_STAKE', 'ADDRESS_NAME', 'LABEL', 'LABEL_SUBTYPE',
@@ -734,6 +921,7 @@ if __name__ == "__main__":
         #     )
         lst_df["LST_Rank"] = lst_df.groupby(["DATE", "SYMBOL"])["AMOUNT"].rank(ascending=False)
         lst_df.to_csv("data/liquid_staking_token_holders.csv.gz", index=False, compression="gzip")
+        address_dictionary.add(lst_df.ADDRESS)
 
         # Combine the two datasets
         staking_combined_df = lst_df.merge(
@@ -743,9 +931,7 @@ if __name__ == "__main__":
             #   right_on=['DATE', 'ADDRESS']
         )
         # get rid of na's in Name
-        staking_combined_df["Name"] = staking_combined_df.apply(
-            utils.apply_program_name, axis=1, address_col="ADDRESS"
-        )
+        staking_combined_df["Name"] = utils.get_program_names(staking_combined_df, address_col="ADDRESS")
         staking_combined_df["Explorer URL"] = staking_combined_df.ADDRESS.apply(
             lambda x: f"https://solana.fm/address/{x}"
         )
@@ -760,3 +946,6 @@ if __name__ == "__main__":
         #     #   right_on=['Date', 'WALLET']
         # )
         # staking_delta_combined.to_csv("data/staking_delta_combined.csv.gz", index=False, compression="gzip")
+
+    # persist the addresses interned above, so every app worker loads them with the same ids
+    address_dictionary.save()
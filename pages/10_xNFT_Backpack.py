@@ -47,7 +47,8 @@ c2.caption(
 st.write("---")
 st.subheader("xNFT Installs")
 st.caption("Highlighting the installation of xNFTs")
-xnft_df = utils.load_xnft_data()
+xnft_data = utils.load_xnft_data.dataset()
+xnft_df = xnft_data.df
 createInstall = xnft_df[xnft_df["Instruction Type"] == "createInstall"]
 
 xnft_counts_by_user = (
@@ -80,7 +81,9 @@ chart_df = createInstall.copy()[
     createInstall["Block Timestamp"]
     >= (pd.to_datetime(datetime.datetime.today(), utc=True) - pd.Timedelta(f"{int(date_range[:-1])}d"))
 ]
-chart_df, totals = utils.aggregate_xnft_data(chart_df, xnfts)
+chart_df, totals = utils.aggregate_xnft_data(
+    xnft_data.derive(chart_df, "installs", date_range, datetime.date.today()), xnfts
+)
 
 chart = (
     (
@@ -367,6 +370,9 @@ else:
         st.caption(address)
         backpack = True
     if st.button("Load data"):
+        st.session_state["backpack_query_address"] = address
+    # keep polling the queries on the reruns after the button was clicked
+    if st.session_state.get("backpack_query_address") == address:
         if utils.RUN_INTERACTIVE_QUERIES:
             tx_info = """
             --sql
@@ -422,13 +428,16 @@ else:
                 and succeeded = 'TRUE'
             ;
             """
-            data_load_state = st.text(f"Querying data for {address}...")
-            tx_data = utils.run_query_and_cache("backpack_tx_info", tx_info, address)
-            sales_data = utils.run_query_and_cache("backpack_sales_info", nft_sales, address)
-            purchases_data = utils.run_query_and_cache("backpack_purchase_info", nft_purchases, address)
-            mints_data = utils.run_query_and_cache("backpack_mints_info", nft_mints, address)
-            swaps_data = utils.run_query_and_cache("backpack_swaps_info", swaps, address)
-            data_load_state.text("")
+            tx_data, sales_data, purchases_data, mints_data, swaps_data = utils.wait_for_query_jobs(
+                [
+                    utils.submit_query_job("backpack_tx_info", tx_info, address),
+                    utils.submit_query_job("backpack_sales_info", nft_sales, address),
+                    utils.submit_query_job("backpack_purchase_info", nft_purchases, address),
+                    utils.submit_query_job("backpack_mints_info", nft_mints, address),
+                    utils.submit_query_job("backpack_swaps_info", swaps, address),
+                ],
+                f"Querying data for {address}...",
+            )
 
             if len(tx_data) > 0:
                 try:
@@ -1,6 +1,5 @@
 import altair as alt
 import numpy as np
-import pandas as pd
 import streamlit as st
 from PIL import Image
 from st_pages import _get_page_hiding_code
@@ -88,8 +87,8 @@ exclude_oracle = c4.checkbox("Exclude Oracle Programs", key="program_exclude_ora
 new_users_only = c4.checkbox("New Users Only", key="program_new_users")
 log_scale = c4.checkbox("Log Scale", key="program_log_scale")
 st.write("---")
-df = utils.load_labeled_program_data(new_users_only=new_users_only, user_type=user_type)
-df["Date"] = pd.to_datetime(df["Date"], utc=True)
+program_data = utils.load_labeled_program_data.dataset(new_users_only=new_users_only, user_type=user_type)
+df = program_data.df
 c1, c2 = st.columns(2)
 date_range = c1.radio(
     "Choose a date range:",
@@ -118,9 +117,15 @@ else:
     if not programs:
         programs = np.random.choice(df.PROGRAM_ID.unique(), 5)
 
-chart_df = utils.get_program_chart_data(
-    df, metric, agg_method, date_range, exclude_solana, exclude_oracle, programs
-)
+chart_df = None
+if chart_type == "Top Programs":
+    chart_df = utils.get_ranked_program_chart_data(
+        metric, agg_method, date_range, exclude_solana, exclude_oracle, programs, new_users_only, user_type
+    )
+if chart_df is None:
+    chart_df = utils.get_program_chart_data(
+        program_data, metric, agg_method, date_range, exclude_solana, exclude_oracle, programs
+    )
 chart = charts.alt_line_chart(chart_df, metric, log_scale)
 st.altair_chart(chart, use_container_width=True)
 
@@ -225,11 +230,17 @@ from
 """
 program_id = st.text_input("Enter a program address", chart_df.iloc[0]["Program ID"])
 if st.button("Load data"):
+    st.session_state["program_query_id"] = program_id
+# keep polling the queries on the reruns after the button was clicked
+if st.session_state.get("program_query_id") == program_id:
     if utils.RUN_INTERACTIVE_QUERIES:
-        data_load_state = st.text("Querying data for program address...")
-        program_usage_data = utils.run_query_and_cache("program_usage", progam_usage_query, program_id)
-        new_wallet_data = utils.run_query_and_cache("new_wallet", new_wallets_for_program, program_id)
-        data_load_state.text("")
+        program_usage_data, new_wallet_data = utils.wait_for_query_jobs(
+            [
+                utils.submit_query_job("program_usage", progam_usage_query, program_id),
+                utils.submit_query_job("new_wallet", new_wallets_for_program, program_id),
+            ],
+            "Querying data for program address...",
+        )
 
         program_usage_data = utils.reformat_columns(program_usage_data, datecols=["DATE"])
         new_wallet_data = utils.reformat_columns(new_wallet_data, datecols=["FIRST_TX_DATE"])
@@ -62,9 +62,8 @@ whale_query_dict = {
         "datecols": ["BLOCK_TIMESTAMP"],
     },
 }
-whale_data_dict = {}
-for k, v in whale_query_dict.items():
-    whale_data_dict[k] = utils.load_flipside_api_data(v["api"], v["datecols"])
+whale_data_dict = utils.load_flipside_api_datasets(whale_query_dict)
+for k in whale_data_dict:
     try:
         whale_data_dict[k]["Explorer URL"] = whale_data_dict[k]["Tx Id"].apply(
             lambda x: f"https://solana.fm/tx/{x}"
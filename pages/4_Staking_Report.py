@@ -82,7 +82,8 @@ with st.expander("Instructions"):
 st.write("---")
 staker_interaction_df = utils.load_staker_interaction_data()
 token_name_dict = {x[1]: x[0] for x in utils.liquid_staking_tokens.values()}
-staker_df_all = utils.load_staker_data()
+staker_data = utils.load_staker_data.dataset()
+staker_df_all = staker_data.df
 current_date = staker_df_all.Date.max()
 min_stake_date = staker_df_all[staker_df_all["Total Stake"].notna()].Date.min()
 
@@ -98,7 +99,8 @@ min_stake_value = c2.number_input(
     label_visibility="collapsed",
     key="stakers_input",
 )
-staker_df = utils.filter_staker_data(staker_df_all, min_stake_value)
+staker_data = utils.filter_staker_data(staker_data, min_stake_value)
+staker_df = staker_data.df
 current_df = staker_df[staker_df.Date == current_date]
 
 st.write("---")
@@ -200,7 +202,7 @@ user_type_dict = {
 
 lst_symbol = token_name_dict[lst] if lst != "All LSTs" else "All LSTs"
 staker_chart_df, token_top_stakers_df, token_top_holders_df = utils.get_stakers_chart_data(
-    staker_df, date_range, exclude_foundation, exclude_labeled, n_addresses, lst, keep_others=keep_others
+    staker_data, date_range, exclude_foundation, exclude_labeled, n_addresses, lst, keep_others=keep_others
 )
 
 with st.expander("Top Stakers", expanded=True):
@@ -366,7 +368,7 @@ with st.expander("Summary", expanded=True):
     top_stakers["LST Amounts"] = top_stakers.apply(lst_amount, axis=1)
     top_stakers = top_stakers.merge(
         (
-            top_stakers.groupby("Address")
+            top_stakers.groupby("Address", observed=True)
             .agg(
                 LSTs_Held=("Holds LST", "sum"),
                 LST_Tokens=(
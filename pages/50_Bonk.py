@@ -62,9 +62,7 @@ bonk_query_dict = {
         "datecols": ["DATE"],
     },
 }
-bonk_data_dict = {}
-for k, v in bonk_query_dict.items():
-    bonk_data_dict[k] = utils.load_flipside_api_data(v["api"], v["datecols"])
+bonk_data_dict = utils.load_flipside_api_datasets(bonk_query_dict)
 burn_data = bonk_data_dict["Daily Bonk Burned"].copy()
 total_burn_df = bonk_data_dict["Total Bonk Burned"].copy()
 leaderboard = bonk_data_dict["Bonk Leaderboard"].copy()
@@ -1,30 +1,39 @@
 #!/usr/bin/env python3
 
+import argparse
 import ast
+import asyncio
 import datetime
 import hashlib
 import json
 import logging
 import shutil
-from multiprocessing import Pool
+import time
 from pathlib import Path
-from time import sleep
 
 import numpy as np
 import pandas as pd
 import streamlit as st
 from flipside import Flipside
 
-# from flipside.errors.api_error import ApiError
 from jinja2 import Environment, FileSystemLoader
 
+import spire_fyi.storage as storage
 import spire_fyi.utils as utils
+from spire_fyi.jobs import JobQueue
+from spire_fyi.manifest import QueryManifest
+from spire_fyi.scheduler import QueryScheduler, get_date_priority, is_rate_limit_error
 
 API_KEY = st.secrets["flipside"]["api_key"]
 sdk = Flipside(API_KEY)
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 
+manifest = QueryManifest("data/query_manifest.json")
+jobs = JobQueue("data/query_jobs.db")
+# "parquet" moves per-date results of templates in `storage.schemas` to data/parquet
+storage_format = "csv"
+
 
 # #TODO: move to utils and CLI
 
@@ -96,6 +105,16 @@ past_90d_hours = [
     )
 ]
 
+# Templates that accept a `date2` to query a date range, with the result column used to split
+# the batch back into per-date partitions
+batched_queries = {
+    "sdk_programs_sol": "Date",
+    "sdk_programs_all_signers_sol": "Date",
+    "sdk_transactions_sol": "DATETIME",
+    "sdk_dex": "DATE",
+    "sdk_openbook_users": "DATE",
+}
+
 all_weeks = [
     f"{x:%Y-%m-%d}"
     for x in pd.date_range(
@@ -149,10 +168,92 @@ def get_queries_by_date(date, query_basename, update_cache=False, output_file=No
         output_file = Path(output_dir, f"{query_basename}_{date.replace(' ', '_')}.csv")
     else:
         output_file = Path(output_dir, output_file)
-    if update_cache or not output_file.exists():
+    if manifest.needs_update(output_file, query, update_cache):
         return query, output_file
 
 
+def get_batched_queries_by_date(dates, query_basename, batch_days=30, update_cache=False):
+    """One query per window of up to `batch_days` consecutive dates, instead of one per date.
+
+    Only dates missing from the per-date cache are queried. Each returned item is
+    `(query, output_file, partitions)`, where `partitions` maps each date in the window to its
+    usual `data/<query_basename>/<query_basename>_<date>.csv` file.
+    """
+    output_dir = Path(f"data/{query_basename}")
+    todo = {}
+    for date in sorted(dates):
+        output_file = Path(output_dir, f"{query_basename}_{date.replace(' ', '_')}.csv")
+        if manifest.needs_update(output_file, create_query_by_date(date, query_basename), update_cache):
+            todo[date] = output_file
+
+    queries_to_do = []
+    window = []
+    for date in todo:
+        if window and (
+            len(window) >= batch_days
+            or (pd.Timestamp(date) - pd.Timestamp(window[-1])) != pd.Timedelta("1d")
+        ):
+            queries_to_do.append(create_batched_query(window, query_basename, todo))
+            window = []
+        window.append(date)
+    if window:
+        queries_to_do.append(create_batched_query(window, query_basename, todo))
+    return queries_to_do
+
+
+def create_batched_query(window, query_basename, output_files):
+    start, end = window[0], window[-1]
+    query = create_query_by_date(start, query_basename, date2=end)
+    output_file = Path(f"data/{query_basename}", f"{query_basename}_{start}--{end}.csv")
+    partitions = {x: output_files[x] for x in window}
+    return query, output_file, partitions
+
+
+def split_batched_result(batch_file, query_basename, partitions, chunksize=100000):
+    date_col = batched_queries[query_basename]
+    columns = pd.read_csv(batch_file, nrows=0).columns
+    # NOTE: flipside SDK v2 returns lowercase column names
+    date_col = [x for x in columns if x.upper() == date_col.upper()][0]
+    rows = {date: 0 for date in partitions}
+    for output_file in partitions.values():
+        output_file.parent.mkdir(exist_ok=True, parents=True)
+        # write empty partitions too, so dates without data are not re-queried
+        pd.DataFrame(columns=columns).to_csv(output_file, index=False)
+    total = 0
+    for chunk in pd.read_csv(batch_file, chunksize=chunksize, dtype=str, keep_default_na=False):
+        dates = pd.to_datetime(chunk[date_col]).dt.strftime("%Y-%m-%d")
+        for date, partition_df in chunk.groupby(dates):
+            if date not in partitions:
+                continue
+            partition_df.to_csv(partitions[date], mode="a", header=False, index=False)
+            rows[date] += len(partition_df)
+        total += len(chunk)
+    for date, output_file in partitions.items():
+        manifest.record(output_file, create_query_by_date(date, query_basename), rows[date])
+        store_partition(output_file)
+    logging.info(f"#@# Split {total} rows into {len(partitions)} partitions")
+
+
+def store_partition(output_file):
+    query_basename = output_file.parent.name
+    if storage_format != "parquet" or query_basename not in storage.schemas:
+        return
+    date = storage.get_file_date(output_file)
+    if date is not None:
+        storage.csv_to_partition(output_file, query_basename, date)
+
+
+def convert_to_parquet():
+    for query_basename in storage.schemas:
+        # adopt legacy csvs first, so the manifest still knows about them once they are moved
+        for x in Path(f"data/{query_basename}").glob("*.csv"):
+            date = storage.get_file_date(x)
+            if date is not None:
+                manifest.needs_update(x, create_query_by_date(date, query_basename))
+        manifest.save()
+        storage.convert_csv_dir(query_basename, remove_csv=True)
+
+
 def get_queries_by_date_and_wallets(
     date, query_basename, wallets, n_wallets, wallet_hash, update_cache=False
 ):
@@ -161,7 +262,7 @@ def get_queries_by_date_and_wallets(
     output_file = Path(
         output_dir, f"{query_basename}_{n_wallets}wallets_sha1-{wallet_hash}_{date.replace(' ', '_')}.csv"
     )
-    if update_cache or not output_file.exists():
+    if manifest.needs_update(output_file, query, update_cache):
         return query, output_file
 
 
@@ -169,7 +270,7 @@ def get_queries_by_date_and_dex_program(date, query_basename, program, update_ca
     query = create_query_by_date_and_program(date, query_basename, program)
     output_dir = Path(f"data/{query_basename}")
     output_file = Path(output_dir, f"{query_basename}_{date.replace(' ', '_')}_{program}.csv")
-    if update_cache or not output_file.exists():
+    if manifest.needs_update(output_file, query, update_cache):
         return query, output_file
 
 
@@ -177,7 +278,7 @@ def get_queries_by_mint_list(mintlist, query_basename, update_cache=False):
     query = create_query_by_creator_address_and_mints(query_basename, "", mintlist)
     output_dir = Path(f"data/{query_basename}")
     output_file = Path(output_dir, f"{query_basename}_2022-12-01.csv")
-    if update_cache or not output_file.exists():
+    if manifest.needs_update(output_file, query, update_cache):
         return query, output_file
 
 
@@ -200,7 +301,7 @@ def get_nft_transfer_queries(unique_collection_mints, query_basename, update_cac
                 output_dir,
                 f"{query_basename}_{collection_name}-{creator_address}--{total_mints}mints_p1_first15000.csv",
             )
-            if update_cache or not output_file_p1.exists():
+            if manifest.needs_update(output_file_p1, query_p1, update_cache):
                 queries_to_do.append((query_p1, output_file_p1))
 
             query_p2 = create_query_by_creator_address_and_mints(query_basename, creator_address, mints_p2)
@@ -208,7 +309,7 @@ def get_nft_transfer_queries(unique_collection_mints, query_basename, update_cac
                 output_dir,
                 f"{query_basename}_{collection_name}-{creator_address}--{total_mints}mints_p2_last{mints_p2_len}.csv",
             )
-            if update_cache or not output_file_p2.exists():
+            if manifest.needs_update(output_file_p2, query_p2, update_cache):
                 queries_to_do.append((query_p2, output_file_p2))
         else:
             query = create_query_by_creator_address_and_mints(query_basename, creator_address, mints)
@@ -216,7 +317,7 @@ def get_nft_transfer_queries(unique_collection_mints, query_basename, update_cac
             output_file = Path(
                 output_dir, f"{query_basename}_{collection_name}-{creator_address}--{total_mints}mints.csv"
             )
-            if update_cache or not output_file.exists():
+            if manifest.needs_update(output_file, query, update_cache):
                 queries_to_do.append((query, output_file))
     return queries_to_do
 
@@ -229,7 +330,7 @@ def get_queries_by_date_and_programs(date, query_basename, df, update_cache=Fals
             query = create_query_by_date_and_program(date, query_basename, program)
             output_dir = Path(f"data/{query_basename}")
             output_file = Path(output_dir, f"{query_basename}_{date.replace(' ', '_')}_{program}.csv")
-            if update_cache or not output_file.exists():
+            if manifest.needs_update(output_file, query, update_cache):
                 pre_ran = Path(
                     "data/sdk_signers_by_programID_new_users_sol--all_user-programIDs",
                     f"{query_basename}_{date.replace(' ', '_')}_{program}.csv",
@@ -242,56 +343,103 @@ def get_queries_by_date_and_programs(date, query_basename, df, update_cache=Fals
     return queries_to_do
 
 
-def query_flipside_data(enumerated_query_info, save=True, page_size=1000000, page_number=1):
-    i, query_info = enumerated_query_info
-    query, output_file = query_info
+def query_flipside_data(query_info, save=True, page_size=100000, raise_error=False):
+    query, output_file = query_info[:2]
+    partitions = query_info[2] if len(query_info) > 2 else None
     query_file = Path(output_file.parent, "queries", f"{output_file.stem}.sql")
     logging.info(f"#@# Querying data for {output_file} ...")
     query_file.parent.mkdir(exist_ok=True, parents=True)
     with open(query_file, "w") as f:
         f.write(query)
-    # if i % 1 == 0:
-    #     sleep(5)
-    if i % 5 == 0:
-        sleep(3)
-    if i % 10 == 0:
-        sleep(10)
-    if i % 100 == 0:
-        sleep(15)
     try:
-        query_result_set = sdk.query(
-            query,
-            ttl_minutes=120,
-            timeout_minutes=30,
-            retry_interval_seconds=1,
-            page_size=page_size,
-            page_number=page_number,
-            cached=False,
-        )
         if save:
-            df = pd.DataFrame(
-                pd.DataFrame(query_result_set.rows, columns=query_result_set.columns)
-            )  # NOTE: flipside SDK v2.0 returns lowercase values, need to check these
-            output_file.parent.mkdir(exist_ok=True, parents=True)
-            df.to_csv(
-                output_file,
-                index=False,
-            )
+            # NOTE: flipside SDK v2.0 returns lowercase values, need to check these
+            if partitions is not None:
+                # keep the window result out of the partition dir, so it is not combined twice
+                batch_file = Path(output_file.parent, "batches", output_file.name)
+                utils.stream_query_to_csv(query, batch_file, page_size=page_size)
+                split_batched_result(batch_file, output_file.parent.name, partitions)
+                batch_file.unlink()
+            else:
+                rows = utils.stream_query_to_csv(query, output_file, page_size=page_size)
+                manifest.record(output_file, query, rows)
+                store_partition(output_file)
+        else:
+            sdk.query(query, ttl_minutes=120, timeout_minutes=30, retry_interval_seconds=1, cached=False)
         logging.info(f"#@# Saved {output_file}")
         return output_file
-    # # #TODO deal with large page size
-    # except ApiError as e:
-    #     msg = e.args[0]
-    #     if "RequestedPageSizeTooLarge" in msg:
-    #         #HACK : attempt to parse error message
-    #         max_rows = int(msg.split('We suggest reducing your page size to below ')[1].split(' ')[0])
-    #     return
     except Exception as e:
+        # let the scheduler back off and retry
+        if raise_error or is_rate_limit_error(e):
+            raise
         logging.info(f"[ERROR] ({query_file}) {e}")
         return
 
 
+def run_query_job(query_info):
+    output_file = query_info[1]
+    jobs.start(output_file)
+    start = time.monotonic()
+    try:
+        result = query_flipside_data(query_info, raise_error=True)
+    except Exception as e:
+        if is_rate_limit_error(e):
+            jobs.release(output_file)
+            raise
+        logging.info(f"[ERROR] ({output_file}) {e}")
+        jobs.fail(output_file, str(e), time.monotonic() - start)
+        return
+    jobs.finish(output_file, time.monotonic() - start)
+    return result
+
+
+def run_queries(query_info, resume=False, max_attempts=3, rate=2.0, burst=8, max_concurrency=8):
+    if resume:
+        planned = None
+    else:
+        jobs.add(query_info)
+        planned = {str(x[1]) for x in query_info}
+    try:
+        for i in range(max_attempts):
+            todo = [x for x in jobs.get_unfinished(max_attempts) if planned is None or str(x[1]) in planned]
+            if not todo:
+                break
+            if i > 0:
+                logging.info(f"#@# Retrying {len(todo)} failed queries (pass {i + 1} of {max_attempts})...")
+            scheduler = QueryScheduler(run_query_job, rate=rate, burst=burst, max_concurrency=max_concurrency)
+            # newest dates first, then historical backfill
+            scheduler.submit_many(todo, priority_func=lambda x: get_date_priority(x[1]))
+            asyncio.run(scheduler.run())
+    finally:
+        manifest.save()
+    logging.info(f"#@# Query jobs: {jobs.summary()}")
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query Flipside data for spire.fyi")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Only run unfinished or failed jobs from data/query_jobs.db, without re-planning queries",
+    )
+    parser.add_argument("--max-attempts", type=int, default=3, help="Max attempts per query job")
+    parser.add_argument(
+        "--storage",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="Write per-date results as csvs, or as parquet partitions under data/parquet",
+    )
+    parser.add_argument(
+        "--convert-to-parquet",
+        action="store_true",
+        help="Move existing per-date csvs of templates with a parquet schema to data/parquet, then exit",
+    )
+    args = parser.parse_args()
+    storage_format = args.storage
+    if args.convert_to_parquet:
+        convert_to_parquet()
+        raise SystemExit
+
     # #TODO make cli...
     update_cache = False
     lst_force_update = False
@@ -305,7 +453,11 @@ if __name__ == "__main__":
     do_lst = True
     # main routines
     do_pull_flipside_data = True
-    do_pool = True
+    do_run_queries = True
+    # query date ranges in one go for `batched_queries`, set to None for one query per date
+    batch_days = 30
+    if args.resume:
+        do_main = do_nft_metadata = do_xnft = do_lst = False
 
     query_info = []
     if do_main:
@@ -337,6 +489,9 @@ if __name__ == "__main__":
         if do_nft_mints:
             main_queries.append(("sdk_nft_mints", past_90d_hours))
         for q, dates in main_queries:
+            if batch_days and q in batched_queries:
+                query_info.extend(get_batched_queries_by_date(dates, q, batch_days))
+                continue
             for date in dates:
                 if q == "sdk_dex_new_users":  # HACK
                     dex_program_ids = [x for v in utils.dex_programs.values() for x in v]  # flatten dict
@@ -469,10 +624,9 @@ if __name__ == "__main__":
             }
             json.dump(top_stakers_log, f, indent=2)
 
-    if do_pool:
+    if do_run_queries:
         logging.info(f"Running {len(query_info)} queries...")
-        with Pool(8) as p:
-            p.map(query_flipside_data, list(enumerate(query_info)))
+        run_queries(query_info, resume=args.resume, max_attempts=args.max_attempts)
 
     if do_pull_flipside_data:
         top_staker_interactions = utils.load_flipside_api_data(
@@ -482,6 +636,10 @@ if __name__ == "__main__":
         top_staker_interactions.sort_values(by="Date", ascending=False).to_csv(
             "data/top_staker_interactions.csv", index=False
         )
+        # the app loads `Address` as a categorical of the shared address dictionary
+        address_dictionary = utils.get_address_dictionary()
+        address_dictionary.add(top_staker_interactions.Address)
+        address_dictionary.save()
 
     # #TODO combine data, get program_ids
     # df = combine_flipside_date_data("data/sdk_programs_sol")
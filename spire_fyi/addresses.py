@@ -0,0 +1,75 @@
+from typing import Iterable, Union
+
+import logging
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["AddressDictionary"]
+
+
+class AddressDictionary:
+    """Append-only mapping of base58 addresses to stable int32 ids, shared across datasets.
+
+    Persisted as a one-column csv where the id is the row number, so ids never change once
+    assigned. Only the combine step adds addresses (and `save`s them), for every address column
+    the app loads; the Streamlit app only reads it.
+    """
+
+    def __init__(self, path: Union[str, Path] = "data/address_dictionary.csv"):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        if self.path.exists():
+            addresses = pd.read_csv(self.path, dtype=str).ADDRESS.to_numpy(dtype=object)
+        else:
+            addresses = np.array([], dtype=object)
+        self._set_addresses(addresses)
+        self._saved = len(self)
+
+    def _set_addresses(self, addresses: np.ndarray) -> None:
+        self.addresses = addresses
+        self._index = pd.Index(addresses)
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def add(self, values: Iterable[str]) -> int:
+        values = pd.unique(pd.Series(values, dtype=object).dropna())
+        with self._lock:
+            new = values[self._index.get_indexer(values) < 0]
+            if len(new):
+                self._set_addresses(np.concatenate([self.addresses, new.astype(object)]))
+        return len(new)
+
+    def to_categorical(self, values: Iterable[str]) -> pd.Categorical:
+        """Categorical of `values`, with only the addresses present as categories, ordered by id.
+
+        Addresses not in the dictionary yet come last, in sorted order, but are not assigned ids here:
+        every process reading the same dictionary encodes a column the same way.
+        """
+        values = pd.Series(values, dtype=object)
+        ids = self._index.get_indexer(values)
+        present = np.unique(ids[ids >= 0])
+        codes = np.searchsorted(present, ids)
+        unknown = (ids < 0) & values.notna().to_numpy()
+        new = np.array([], dtype=object)
+        if unknown.any():
+            new = np.unique(values[unknown].to_numpy(dtype=str)).astype(object)
+            codes[unknown] = len(present) + np.searchsorted(new, values[unknown].to_numpy(dtype=str))
+            logging.info(f"#@# {len(new)} addresses are not in {self.path} yet, run the combine step to add them")
+        codes[(ids < 0) & ~unknown] = -1
+        categories = pd.Index(np.concatenate([self.addresses[present], new]), dtype=object)
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    def save(self) -> None:
+        with self._lock:
+            if len(self) == self._saved and self.path.exists():
+                return
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            tmp = self.path.with_suffix(".tmp")
+            pd.DataFrame({"ADDRESS": self.addresses}).to_csv(tmp, index=False)
+            os.replace(tmp, self.path)
+            self._saved = len(self)
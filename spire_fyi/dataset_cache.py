@@ -0,0 +1,166 @@
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["Dataset", "DatasetCache", "get_version_token"]
+
+
+def get_version_token(*parts: Any) -> str:
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class Dataset:
+    """A loaded frame with a version token, which changes whenever the frame is (re)loaded.
+
+    `st.cache_data` functions taking a `Dataset` are keyed on the token (see `utils.DATASET_HASH_FUNCS`)
+    instead of hashing every row of the frame on each rerun.
+    """
+
+    def __init__(self, df: pd.DataFrame, version: str):
+        self.df = df
+        self.version = version
+
+    def __repr__(self) -> str:
+        return f"Dataset(version={self.version}, shape={self.df.shape})"
+
+    def derive(self, df: pd.DataFrame, *params: Any) -> "Dataset":
+        """`df` computed from this dataset with `params` (which must determine it), versioned on both."""
+        return Dataset(df, get_version_token(self.version, *params))
+
+
+def get_nbytes(data: Any) -> int:
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(index=True, deep=True).sum())
+    if isinstance(data, pd.Series):
+        return int(data.memory_usage(index=True, deep=True))
+    if isinstance(data, (tuple, list)):
+        return sum(get_nbytes(x) for x in data)
+    return 0
+
+
+def freeze(data: Any) -> Any:
+    """Mark the arrays backing `data` read-only, so a page writing into a view fails loudly."""
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        for arr in data._mgr.arrays:
+            # categoricals and datetimes keep their values in `_ndarray`
+            arr = getattr(arr, "_ndarray", arr)
+            if isinstance(arr, np.ndarray):
+                arr.setflags(write=False)
+    elif isinstance(data, (tuple, list)):
+        for x in data:
+            freeze(x)
+    return data
+
+
+def get_view(data: Any) -> Any:
+    """Shallow copy of `data`: adding or replacing columns does not touch the cached frame."""
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return data.copy(deep=False)
+    if isinstance(data, (tuple, list)):
+        return type(data)(get_view(x) for x in data)
+    return data
+
+
+class DatasetCache:
+    """Process-wide cache of loaded datasets, shared by every Streamlit session.
+
+    Unlike `st.cache_data`, hits are not unpickled into a new copy per session: each caller gets
+    a shallow view of the same read-only arrays. Entries expire after their `ttl` (seconds), and
+    the least recently used are evicted once the total size is over `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, dict]" = OrderedDict()
+        self._loading: Dict[Hashable, threading.Lock] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    def _get_entry(self, key: Hashable) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] is not None and entry["expires_at"] < time.monotonic():
+            self._pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _pop(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self.nbytes -= entry["nbytes"]
+
+    def _evict(self, keep: Hashable) -> None:
+        # never evict the entry just loaded, even if it is over the budget on its own
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            nbytes = self._entries[key]["nbytes"]
+            self._pop(key)
+            logging.info(f"#@# Evicted {key} ({nbytes / 2**20:.1f} MB) from the dataset cache")
+
+    def _load(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None) -> dict:
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is not None:
+                return entry
+            load_lock = self._loading.setdefault(key, threading.Lock())
+
+        with load_lock:
+            # another session may have loaded it while this one waited
+            with self._lock:
+                entry = self._get_entry(key)
+                if entry is not None:
+                    return entry
+            start = time.monotonic()
+            data = freeze(loader())
+            nbytes = get_nbytes(data)
+            entry = {
+                "data": data,
+                "nbytes": nbytes,
+                "version": get_version_token(key, time.time_ns()),
+                "expires_at": None if ttl is None else time.monotonic() + ttl,
+            }
+            with self._lock:
+                self._entries[key] = entry
+                self.nbytes += nbytes
+                self._evict(keep=key)
+                self._loading.pop(key, None)
+            logging.info(
+                f"#@# Loaded {key} into the dataset cache in {time.monotonic() - start:.1f}s "
+                f"({nbytes / 2**20:.1f} MB, {self.nbytes / 2**20:.1f} of {self.max_bytes / 2**20:.0f} MB used)"
+            )
+        return entry
+
+    def get(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        """View of the dataset cached under `key`, calling `loader` (once, across threads) on a miss."""
+        return get_view(self._load(key, loader, ttl)["data"])
+
+    def get_dataset(self, key: Hashable, loader: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        """Like `get`, wrapped in a `Dataset` (or a tuple of them, for loaders returning several frames)."""
+        entry = self._load(key, loader, ttl)
+        data = get_view(entry["data"])
+        if isinstance(data, (tuple, list)):
+            return tuple(Dataset(x, get_version_token(entry["version"], i)) for i, x in enumerate(data))
+        return Dataset(data, entry["version"])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
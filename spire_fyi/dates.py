@@ -0,0 +1,15 @@
+from typing import Optional, Union
+
+import re
+from pathlib import Path
+
+__all__ = ["DATE_PATTERN", "get_file_date"]
+
+# per-date query results are named `<query_basename>_<YYYY-MM-DD>.csv`
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def get_file_date(path: Union[str, Path]) -> Optional[str]:
+    """Last `YYYY-MM-DD` date in the file name of `path`, if any."""
+    dates = DATE_PATTERN.findall(Path(path).name)
+    return dates[-1] if dates else None
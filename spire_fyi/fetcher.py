@@ -0,0 +1,80 @@
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .dataset_cache import freeze, get_view
+
+__all__ = ["DatasetFetcher"]
+
+
+class DatasetFetcher:
+    """Process-wide, stale-while-revalidate cache of remote datasets, fetched concurrently.
+
+    A page asks for all of its datasets at once with `get_many`: the ones never fetched before
+    are downloaded in parallel (so a cold page waits for the slowest one, not for the sum), and
+    ones older than `ttl` seconds are returned as they are while a refresh runs in the background.
+    Only one fetch per dataset is ever in flight, and a failed refresh keeps the last good copy
+    (retried after `retry_after` seconds).
+    """
+
+    def __init__(
+        self, fetch: Callable[..., Any], ttl: float, max_workers: int = 8, retry_after: float = 60
+    ):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dataset-fetcher")
+        self._entries: Dict[Hashable, dict] = {}
+        self._pending: Dict[Hashable, Future] = {}
+
+    def _refresh(self, args: Tuple) -> Any:
+        start = time.monotonic()
+        try:
+            data = freeze(self.fetch(*args))
+        except Exception as e:
+            logging.info(f"[ERROR] Fetching {args[0]} failed: {e}")
+            with self._lock:
+                entry = self._entries.get(args)
+                if entry is not None:
+                    # keep serving the stale copy, and back off before trying again
+                    entry["fetched_at"] = time.monotonic() - self.ttl + self.retry_after
+                self._pending.pop(args, None)
+            raise
+        with self._lock:
+            self._entries[args] = {"data": data, "fetched_at": time.monotonic()}
+            self._pending.pop(args, None)
+        logging.info(f"#@# Fetched {args[0]} in {time.monotonic() - start:.1f}s")
+        return data
+
+    def _submit(self, args: Tuple) -> Future:
+        # under self._lock
+        future = self._pending.get(args)
+        if future is None:
+            future = self._executor.submit(self._refresh, args)
+            self._pending[args] = future
+        return future
+
+    def get_many(self, requests: Dict[str, Tuple]) -> Dict[str, Any]:
+        """`{name: fetch args}` -> `{name: view of the dataset}`, waiting only for datasets never fetched."""
+        now = time.monotonic()
+        results = {}
+        waiting = {}
+        with self._lock:
+            for name, args in requests.items():
+                entry = self._entries.get(args)
+                if entry is None:
+                    waiting[name] = self._submit(args)
+                    continue
+                results[name] = entry["data"]
+                if now - entry["fetched_at"] > self.ttl:
+                    self._submit(args)
+        for name, future in waiting.items():
+            results[name] = future.result()
+        return {name: get_view(results[name]) for name in requests}
+
+    def get(self, *args: Any) -> Any:
+        return self.get_many({"data": args})["data"]
@@ -0,0 +1,154 @@
+from typing import Iterable, List, Optional, Tuple
+
+import asyncio
+import logging
+import random
+
+import httpx
+import numpy as np
+import pandas as pd
+
+from .nft_metadata import NFTMetadataStore
+
+__all__ = ["HeliusMetadataClient", "parse_metadata"]
+
+HELIUS_METADATA_URL = "https://api.helius.xyz/v0/tokens/metadata"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def get_top_creator_info(creators):
+    data = {"creator_address": "", "creator_share": 0}
+    for x in creators:
+        if x["share"] > data["creator_share"]:
+            data["creator_share"] = x["share"]
+            data["creator_address"] = x["address"]
+    return data
+
+
+def parse_metadata(item: dict) -> Optional[dict]:
+    """The fields of a helius metadata response item that are kept, or None if it has no on-chain metadata."""
+    try:
+        onchain = item["onChainData"]
+        onchaindata = onchain["data"]
+    except (KeyError, TypeError):
+        return None
+
+    def get(d, key, default):
+        try:
+            return d[key]
+        except (KeyError, TypeError):
+            return default
+
+    try:
+        creator_info = get_top_creator_info(onchaindata["creators"])
+    except (KeyError, TypeError):
+        creator_info = {"creator_address": "", "creator_share": 0}
+    return {
+        "mint": item["mint"],
+        "name": get(onchaindata, "name", ""),
+        "symbol": get(onchaindata, "symbol", ""),
+        "seller_fee_basis_points": get(onchaindata, "sellerFeeBasisPoints", 0),
+        "uri": get(onchaindata, "uri", ""),
+        "update_authority": get(onchain, "updateAuthority", ""),
+        **creator_info,
+    }
+
+
+class HeliusMetadataClient:
+    """Fetches nft metadata from helius in concurrent 100-mint batches, through a shared metadata store.
+
+    Mints already in the store (with or without metadata) are never requested again. Requests
+    share one connection pool, at most `max_concurrency` are in flight, and rate limits (429),
+    server errors and connection errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        store: NFTMetadataStore,
+        batch_size: int = 100,
+        max_concurrency: int = 8,
+        max_retries: int = 5,
+        min_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 60.0,
+    ):
+        self.api_key = api_key
+        self.store = store
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+    def _get_backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        if response is not None and "retry-after" in response.headers:
+            try:
+                return float(response.headers["retry-after"])
+            except ValueError:
+                pass
+        return min(self.max_backoff, self.min_backoff * 2**attempt) * (1 + random.random() / 2)
+
+    async def _fetch_batch(
+        self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, mints: List[str]
+    ) -> Tuple[List[dict], List[str]]:
+        for attempt in range(self.max_retries + 1):
+            response = None
+            async with semaphore:
+                try:
+                    response = await client.post(
+                        HELIUS_METADATA_URL, params={"api-key": self.api_key}, json={"mintAccounts": mints}
+                    )
+                    if response.status_code not in RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        break
+                    error = f"status code: {response.status_code}"
+                except httpx.TransportError as e:
+                    error = f"{type(e).__name__}: {e}"
+            if attempt == self.max_retries:
+                raise Exception(f"helius metadata request failed after {attempt + 1} attempts ({error})")
+            backoff = self._get_backoff(attempt, response)
+            logging.info(f"#@# Helius metadata request failed ({error}), retrying in {backoff:.1f}s")
+            await asyncio.sleep(backoff)
+
+        metadata = []
+        mints_no_metadata = []
+        for item in response.json():
+            data = parse_metadata(item)
+            if data is None:
+                mints_no_metadata.append(item["mint"])
+            else:
+                metadata.append(data)
+        # store each batch as it completes, so an interrupted backfill keeps what it fetched
+        self.store.upsert(metadata, mints_no_metadata)
+        return metadata, mints_no_metadata
+
+    async def _fetch(self, mints: List[str]) -> int:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        limits = httpx.Limits(max_connections=self.max_concurrency)
+        batches = [mints[i : i + self.batch_size] for i in range(0, len(mints), self.batch_size)]
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout) as client:
+            results = await asyncio.gather(
+                *[self._fetch_batch(client, semaphore, x) for x in batches], return_exceptions=True
+            )
+        failed = [x for x in results if isinstance(x, Exception)]
+        for e in failed[:5]:
+            logging.info(f"[ERROR] {e}")
+        logging.info(
+            f"#@# Fetched helius metadata for {len(mints)} mints in {len(batches)} requests ({len(failed)} failed)"
+        )
+        return len(batches) - len(failed)
+
+    def fetch_missing(self, mints: Iterable[str]) -> int:
+        """Fetch and store the metadata of any `mints` not in the store yet."""
+        mints = list(self.store.get_unchecked(mints))
+        if not mints:
+            return 0
+        return asyncio.run(self._fetch(mints))
+
+    def get_metadata(self, mints: Iterable[str]) -> pd.DataFrame:
+        """Metadata of `mints` (only those that have any), fetching the ones not seen before."""
+        mints = np.unique(np.asarray(list(mints), dtype=str))
+        self.fetch_missing(mints)
+        return self.store.get(mints)
@@ -0,0 +1,130 @@
+from typing import Dict, Optional, Union
+
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+
+__all__ = ["HTTPCache"]
+
+
+class HTTPCache:
+    """On-disk cache of JSON API responses, shared by every process that points at `cache_dir`.
+
+    Each url keeps its gzipped response body, the headers needed to revalidate it (ETag and
+    Last-Modified) and a parquet sidecar of the parsed frame. Cached urls are requested
+    conditionally, so an unchanged result costs a 304 and a parquet read instead of a download
+    and a JSON parse. Responses validated less than `max_age` seconds ago (by any process) are
+    served without a request at all.
+    """
+
+    def __init__(
+        self, cache_dir: Union[str, Path] = "data/http_cache", max_age: float = 0, timeout: float = 60
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_age = max_age
+        self.timeout = timeout
+
+    def _get_paths(self, url: str) -> Dict[str, Path]:
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return {x: self.cache_dir / f"{key}.{x}" for x in ["meta.json", "json.gz", "parquet"]}
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        # unique per writer and atomic, as several processes may refresh the same url
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _read_meta(self, paths: Dict[str, Path]) -> Optional[dict]:
+        try:
+            with open(paths["meta.json"]) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_meta(self, paths: Dict[str, Path], meta: dict) -> None:
+        self._write(paths["meta.json"], json.dumps(meta, indent=1).encode("utf-8"))
+
+    def _read_frame(self, paths: Dict[str, Path], meta: dict) -> pd.DataFrame:
+        try:
+            table = pq.read_table(paths["parquet"])
+            # the sidecar must belong to the same body as the metadata
+            if (table.schema.metadata or {}).get(b"body_sha1", b"").decode() == meta["body_sha1"]:
+                return table.to_pandas()
+        except (FileNotFoundError, pa.ArrowException):
+            pass
+        with gzip.open(paths["json.gz"], "rb") as f:
+            df = pd.read_json(BytesIO(f.read()))
+        self._write_frame(paths, df, meta["body_sha1"])
+        return df
+
+    def _write_frame(self, paths: Dict[str, Path], df: pd.DataFrame, body_sha1: str) -> None:
+        try:
+            table = pa.Table.from_pandas(df)
+        except (pa.ArrowException, ValueError) as e:
+            # e.g. columns of mixed types; the gzipped body is parsed again instead
+            logging.info(f"[ERROR] No parquet sidecar for {paths['parquet'].name}: {e}")
+            return
+        table = table.replace_schema_metadata({**table.schema.metadata, b"body_sha1": body_sha1.encode()})
+        buffer = pa.BufferOutputStream()
+        pq.write_table(table, buffer, compression="zstd")
+        self._write(paths["parquet"], buffer.getvalue().to_pybytes())
+
+    def read_json(self, url: str, headers: Optional[dict] = None) -> pd.DataFrame:
+        """`pd.read_json(url)`, revalidating the cached response instead of downloading it again."""
+        paths = self._get_paths(url)
+        meta = self._read_meta(paths)
+        if meta is not None and not paths["json.gz"].exists():
+            meta = None
+        now = time.time()
+        if meta is not None and now - meta["validated_at"] < self.max_age:
+            return self._read_frame(paths, meta)
+
+        request_headers = {"Accept-Encoding": "gzip", **(headers or {})}
+        if meta is not None:
+            if meta.get("etag"):
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                request_headers["If-Modified-Since"] = meta["last_modified"]
+        r = requests.get(url, headers=request_headers, timeout=self.timeout)
+        if r.status_code == 304 and meta is not None:
+            meta["validated_at"] = now
+            self._write_meta(paths, meta)
+            logging.info(f"#@# {url} not modified, using the cached copy")
+            return self._read_frame(paths, meta)
+        r.raise_for_status()
+
+        body_sha1 = hashlib.sha1(r.content).hexdigest()
+        new_meta = {
+            "url": url,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "body_sha1": body_sha1,
+            "bytes": len(r.content),
+            "fetched_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "validated_at": now,
+        }
+        if meta is not None and meta["body_sha1"] == body_sha1:
+            # no validators (or they changed), but the same body: keep the parsed sidecar
+            self._write_meta(paths, new_meta)
+            return self._read_frame(paths, new_meta)
+        df = pd.read_json(BytesIO(r.content))
+        self._write(paths["json.gz"], gzip.compress(r.content, compresslevel=5))
+        self._write_frame(paths, df, body_sha1)
+        self._write_meta(paths, new_meta)
+        logging.info(f"#@# Downloaded {url} ({len(r.content) / 2**20:.1f} MB)")
+        return df
@@ -0,0 +1,245 @@
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from .result_cache import QueryResultCache
+
+__all__ = ["JobQueue", "QueryJob", "QueryJobManager"]
+
+JOB_STATES = ["pending", "running", "done", "failed"]
+
+
+class JobQueue:
+    """Durable table of query jobs, so an ingestion run can be resumed after a crash.
+
+    Jobs are keyed on their output file and hold the rendered SQL (and batch partitions, if
+    any), so resuming does not need to re-render templates. Each job tracks its state
+    (`pending`, `running`, `done`, `failed`), attempt count, last error and duration.
+    """
+
+    def __init__(self, path: Union[str, Path] = "data/query_jobs.db"):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """
+            create table if not exists jobs (
+                output_file text primary key,
+                query text not null,
+                partitions text,
+                state text not null default 'pending',
+                attempts integer not null default 0,
+                last_error text,
+                duration real,
+                updated_at text
+            )
+            """
+        )
+        self.conn.commit()
+
+    def _execute(self, sql: str, params: tuple = ()) -> None:
+        with self._lock:
+            self.conn.execute(sql, params)
+            self.conn.commit()
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.datetime.now().isoformat(timespec="seconds")
+
+    def add(self, query_info: Iterable[tuple]) -> int:
+        rows = []
+        for x in query_info:
+            query, output_file = x[:2]
+            partitions = None
+            if len(x) > 2:
+                partitions = json.dumps({k: str(v) for k, v in x[2].items()})
+            rows.append((str(output_file), query, partitions, self._now()))
+        with self._lock:
+            self.conn.executemany(
+                """
+                insert into jobs (output_file, query, partitions, updated_at) values (?, ?, ?, ?)
+                on conflict(output_file) do update set
+                    query = excluded.query,
+                    partitions = excluded.partitions,
+                    state = 'pending',
+                    attempts = 0,
+                    last_error = null,
+                    updated_at = excluded.updated_at
+                """,
+                rows,
+            )
+            self.conn.commit()
+        return len(rows)
+
+    def get_unfinished(self, max_attempts: int = 3) -> List[tuple]:
+        """Pending, failed and interrupted (`running`) jobs with attempts left, as `query_info` tuples."""
+        with self._lock:
+            rows = self.conn.execute(
+                "select query, output_file, partitions from jobs where state != 'done' and attempts < ?",
+                (max_attempts,),
+            ).fetchall()
+        query_info = []
+        for query, output_file, partitions in rows:
+            if partitions is None:
+                query_info.append((query, Path(output_file)))
+            else:
+                partitions = {k: Path(v) for k, v in json.loads(partitions).items()}
+                query_info.append((query, Path(output_file), partitions))
+        return query_info
+
+    def start(self, output_file: Union[str, Path]) -> None:
+        self._execute(
+            "update jobs set state = 'running', attempts = attempts + 1, updated_at = ? where output_file = ?",
+            (self._now(), str(output_file)),
+        )
+
+    def finish(self, output_file: Union[str, Path], duration: float) -> None:
+        self._execute(
+            "update jobs set state = 'done', last_error = null, duration = ?, updated_at = ? where output_file = ?",
+            (duration, self._now(), str(output_file)),
+        )
+
+    def fail(self, output_file: Union[str, Path], error: str, duration: float) -> None:
+        self._execute(
+            "update jobs set state = 'failed', last_error = ?, duration = ?, updated_at = ? where output_file = ?",
+            (error, duration, self._now(), str(output_file)),
+        )
+
+    def release(self, output_file: Union[str, Path]) -> None:
+        """Put a job back to `pending` without using up an attempt, e.g. after a rate limit."""
+        self._execute(
+            "update jobs set state = 'pending', attempts = max(attempts - 1, 0), updated_at = ? where output_file = ?",
+            (self._now(), str(output_file)),
+        )
+
+    def summary(self) -> dict:
+        with self._lock:
+            rows = self.conn.execute("select state, count(*) from jobs group by state").fetchall()
+        return {state: n for state, n in rows}
+
+
+class QueryJob:
+    """Handle on an interactive query, shared by every session that asked for the same result."""
+
+    def __init__(self, output_file: Optional[Path] = None, state: str = "pending"):
+        self.output_file = output_file
+        self.state = state
+        self.error: Optional[str] = None
+        self.pages = (0, None)
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self._finished = threading.Event()
+        if state == "done":
+            self._finish("done")
+
+    def _finish(self, state: str, error: Optional[str] = None) -> None:
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.state = state
+        self._finished.set()
+
+    @property
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._finished.wait(timeout)
+
+    def result(self, timeout: Optional[float] = None) -> pd.DataFrame:
+        """The query results, blocking until the job has finished.
+
+        Raises FileNotFoundError if the result was evicted from the cache before it was read; submitting
+        the query again then re-runs it.
+        """
+        if not self.wait(timeout):
+            raise TimeoutError(f"Query job is still {self.state}")
+        if self.state == "failed":
+            raise Exception(f"Query job failed: {self.error}")
+        try:
+            return pd.read_parquet(self.output_file)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Query result {self.output_file} was evicted before it was read")
+
+
+class QueryJobManager:
+    """Runs interactive queries in background threads, one run per result across all sessions.
+
+    `run(query, csv_file, on_page)` writes the results to a csv, which is then kept in the
+    `QueryResultCache`. Asking for a result that is cached (and fresh) returns a finished job,
+    and asking for one that is being queried returns the job already running, so pages poll
+    the same handle instead of launching duplicate queries. Failed jobs are returned as they
+    are for `retry_after` seconds, so polling pages can show the error rather than re-running
+    the query.
+    """
+
+    def __init__(
+        self,
+        run: Callable[..., int],
+        cache: QueryResultCache,
+        max_workers: int = 4,
+        retry_after: float = 60,
+    ):
+        self.run = run
+        self.cache = cache
+        self.retry_after = retry_after
+        self.tmp_dir = cache.cache_dir / "tmp"
+        self.tmp_dir.mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-job")
+        self._jobs: Dict[tuple, QueryJob] = {}
+
+    def _run(self, key: tuple, job: QueryJob, query: str) -> None:
+        job.state = "running"
+
+        def on_page(page_number, total_pages):
+            job.pages = (page_number, total_pages)
+
+        name, param = key
+        csv_file = self.tmp_dir / f"{name}_{threading.get_ident()}.csv"
+        try:
+            rows = self.run(query, csv_file, on_page=on_page)
+            job.output_file = self.cache.put(name, param, csv_file)
+        except Exception as e:
+            logging.info(f"[ERROR] Query {name} for {param} failed after {job.elapsed:.0f}s: {e}")
+            job._finish("failed", f"{type(e).__name__}: {e}")
+        else:
+            logging.info(f"#@# Queried {rows} rows for {name} {param} in {job.elapsed:.0f}s")
+            job._finish("done")
+        with self._lock:
+            if job.state == "done" and self._jobs.get(key) is job:
+                del self._jobs[key]
+
+    def submit(self, name: str, sql: str, param: str, force_update: bool = False) -> QueryJob:
+        """Job for `sql.format(param=param)`, starting it only if it is neither cached nor running."""
+        key = (name, str(param))
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None:
+                if job.state != "failed" or time.monotonic() - job.finished_at < self.retry_after:
+                    return job
+            if not force_update:
+                output_file = self.cache.get(name, param)
+                if output_file is not None:
+                    return QueryJob(output_file, state="done")
+            job = QueryJob()
+            self._jobs[key] = job
+        self._executor.submit(self._run, key, job, sql.format(param=param))
+        return job
+
+    def running(self) -> List[QueryJob]:
+        with self._lock:
+            return list(self._jobs.values())
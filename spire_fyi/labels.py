@@ -0,0 +1,171 @@
+from typing import Iterable, List, Optional, Union
+
+import asyncio
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import requests
+
+from .scheduler import QueryScheduler
+
+__all__ = ["SolanaFMLabelStore"]
+
+SOLANA_FM_LABEL_URL = "https://api.solana.fm/v0/accounts"
+
+
+class SolanaFMLabelStore:
+    """Persistent cache of solana.fm account labels, keyed on address.
+
+    Addresses that solana.fm has no label for are stored as negative entries (null data), so
+    they are not looked up again on every run. Labels are refreshed after `ttl_days`, and
+    negative entries after the (shorter) `negative_ttl_days`; None means never.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path] = "data/solana_fm_labels.db",
+        ttl_days: Optional[float] = 30,
+        negative_ttl_days: Optional[float] = 7,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.ttl_days = ttl_days
+        self.negative_ttl_days = negative_ttl_days
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """
+            create table if not exists labels (
+                address text primary key,
+                data text,
+                fetched_at text not null
+            )
+            """
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _now() -> str:
+        return datetime.datetime.now().isoformat(timespec="seconds")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("select count(*) from labels").fetchone()[0]
+
+    def _get_rows(self, addresses: Iterable[str]) -> pd.DataFrame:
+        addresses = list(addresses)
+        rows = []
+        with self._lock:
+            # stay under sqlite's bound parameter limit
+            for i in range(0, len(addresses), 900):
+                batch = addresses[i : i + 900]
+                placeholders = ",".join("?" * len(batch))
+                rows += self.conn.execute(
+                    f"select address, data, fetched_at from labels where address in ({placeholders})", batch
+                ).fetchall()
+        return pd.DataFrame(rows, columns=["address", "data", "fetched_at"])
+
+    def put(self, labels: dict, fetched_at: Optional[str] = None) -> None:
+        """Store `{address: label data}`, where None marks an address without a label."""
+        fetched_at = fetched_at or self._now()
+        rows = [(k, None if v is None else json.dumps(v), fetched_at) for k, v in labels.items()]
+        with self._lock:
+            self.conn.executemany(
+                """
+                insert into labels (address, data, fetched_at) values (?, ?, ?)
+                on conflict(address) do update set data = excluded.data, fetched_at = excluded.fetched_at
+                """,
+                rows,
+            )
+            self.conn.commit()
+
+    def get_stale(self, addresses: Iterable[str]) -> np.ndarray:
+        """Addresses never looked up, or whose entry is older than its ttl."""
+        addresses = pd.unique(pd.Series(addresses, dtype=object).dropna())
+        rows = self._get_rows(addresses)
+        now = datetime.datetime.now()
+        fetched_at = pd.to_datetime(rows.fetched_at)
+        expired = pd.Series(False, index=rows.index)
+        for is_label, ttl in [(True, self.ttl_days), (False, self.negative_ttl_days)]:
+            if ttl is not None:
+                expired |= (rows.data.notna() == is_label) & (fetched_at < now - pd.Timedelta(days=ttl))
+        fresh = rows.address[~expired]
+        return addresses[~pd.Index(addresses).isin(fresh)]
+
+    def import_csv(self, label_file: Union[str, Path]) -> int:
+        """Adopt the labels of an existing `*_solana_fm_labels.csv`, using its mtime as the fetch time."""
+        label_file = Path(label_file)
+        if not label_file.exists():
+            return 0
+        df = pd.read_csv(label_file, dtype=str)
+        df = df.rename(
+            columns={x: x[0].lower() + x[1:].replace(" ", "_") for x in df.columns if x != "ADDRESS"}
+        )
+        # only addresses missing from the store, so a rewritten csv does not reset their ttl
+        df = df[~df.ADDRESS.isin(self._get_rows(df.ADDRESS.dropna().unique()).address)]
+        labels = {
+            x["ADDRESS"]: {k: v for k, v in x.items() if k != "ADDRESS" and pd.notna(v)}
+            for x in df.to_dict(orient="records")
+        }
+        mtime = datetime.datetime.fromtimestamp(label_file.stat().st_mtime).isoformat(timespec="seconds")
+        self.put(labels, fetched_at=mtime)
+        return len(labels)
+
+    @staticmethod
+    def _fetch_batch(addresses: List[str]) -> dict:
+        r = requests.post(SOLANA_FM_LABEL_URL, json={"accountHashes": addresses}, timeout=60)
+        if r.status_code == 429:
+            # recognized as a rate limit by the scheduler
+            raise Exception("solana.fm labels status code: 429")
+        r.raise_for_status()
+        labels = {x: None for x in addresses}
+        for x in r.json()["result"]:
+            try:
+                labels[x["accountHash"]] = x["data"]
+            except KeyError:
+                pass
+        return labels
+
+    def fetch(
+        self, addresses: Iterable[str], batch_size: int = 100, rate: float = 4.0, max_concurrency: int = 4
+    ) -> int:
+        """Look up the stale `addresses` in concurrent batches, storing each batch as it completes.
+
+        Batches that fail are not stored, so they are looked up again on the next run.
+        """
+        stale = list(self.get_stale(addresses))
+        if not stale:
+            return 0
+
+        def fetch_and_store(batch):
+            labels = self._fetch_batch(batch)
+            self.put(labels)
+            return len(labels)
+
+        scheduler = QueryScheduler(
+            fetch_and_store, rate=rate, burst=max_concurrency, max_concurrency=max_concurrency
+        )
+        scheduler.submit_many([stale[i : i + batch_size] for i in range(0, len(stale), batch_size)])
+        fetched = sum(x for x in asyncio.run(scheduler.run()) if x is not None)
+        logging.info(f"#@# Fetched solana.fm labels for {fetched} of {len(stale)} new or stale addresses")
+        return fetched
+
+    def to_frame(self, addresses: Optional[Iterable[str]] = None) -> pd.DataFrame:
+        """Labelled addresses in the `*_solana_fm_labels.csv` layout, sorted by ADDRESS."""
+        if addresses is None:
+            with self._lock:
+                rows = self.conn.execute("select address, data from labels where data is not null").fetchall()
+        else:
+            rows = self._get_rows(pd.unique(pd.Series(addresses, dtype=object).dropna()))
+            rows = rows.loc[rows.data.notna(), ["address", "data"]].to_numpy().tolist()
+        df = pd.DataFrame([{**json.loads(data), "ADDRESS": address} for address, data in rows])
+        if df.empty:
+            return df
+        df = df.sort_values(by="ADDRESS").reset_index(drop=True)
+        return df.rename(columns={x: (x[0].upper() + x[1:]).replace("_", " ") for x in df.columns})
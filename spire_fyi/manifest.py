@@ -0,0 +1,178 @@
+from typing import Dict, Optional, Set, Union
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+from . import storage
+
+__all__ = ["QueryManifest", "CombineWatermark", "get_sql_hash", "find_partition"]
+
+
+def get_sql_hash(query: str) -> str:
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+def find_partition(output_file: Union[str, Path]) -> Optional[Path]:
+    """The file holding the partition of `output_file`: the csv itself, or the parquet partition it became."""
+    output_file = Path(output_file)
+    if output_file.exists():
+        return output_file
+    date = storage.get_file_date(output_file)
+    if date is not None:
+        partition_file = storage.get_partition_file(output_file.parent.name, date)
+        if partition_file.exists():
+            return partition_file
+    return None
+
+
+class QueryManifest:
+    """Index of cached query partitions, keyed on output file.
+
+    Each entry stores the sha1 of the rendered SQL, row count, byte size and fetch time, so
+    a partition is only re-queried when its SQL changes (or `update_cache` is set), or when its
+    file is gone. Partitions written before the manifest existed are adopted with the current SQL
+    hash the first time they are seen.
+
+    Whether a partition still exists is checked against a listing of its csv dir and its parquet
+    dataset dir, each scanned once per manifest (i.e. once per run), not with a `stat` per partition.
+    """
+
+    def __init__(self, path: Union[str, Path] = "data/query_manifest.json", autosave_every: int = 50):
+        self.path = Path(path)
+        self.autosave_every = autosave_every
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._listings: Dict[str, Set[str]] = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries: Dict[str, dict] = json.load(f)
+        else:
+            self.entries = {}
+
+    def _listing(self, directory: Path) -> Set[str]:
+        key = str(directory)
+        with self._lock:
+            if key not in self._listings:
+                try:
+                    with os.scandir(directory) as it:
+                        self._listings[key] = {x.name for x in it}
+                except FileNotFoundError:
+                    self._listings[key] = set()
+            return self._listings[key]
+
+    def has_partition(self, output_file: Union[str, Path]) -> bool:
+        """Whether `output_file`, or the parquet partition it became, is on disk (as of the first listing)."""
+        output_file = Path(output_file)
+        if output_file.name in self._listing(output_file.parent):
+            return True
+        date = storage.get_file_date(output_file)
+        if date is None:
+            return False
+        dataset_dir = storage.get_dataset_dir(output_file.parent.name)
+        return f"{storage.PARTITION_KEY}={date}" in self._listing(dataset_dir)
+
+    def __contains__(self, output_file: Union[str, Path]) -> bool:
+        return str(output_file) in self.entries
+
+    def get(self, output_file: Union[str, Path]) -> Optional[dict]:
+        return self.entries.get(str(output_file))
+
+    def needs_update(self, output_file: Union[str, Path], query: str, update_cache: bool = False) -> bool:
+        if update_cache:
+            return True
+        sql_hash = get_sql_hash(query)
+        entry = self.get(output_file)
+        if entry is not None:
+            if entry["sql_sha1"] != sql_hash:
+                logging.info(f"#@# SQL changed for {output_file}, re-querying")
+                return True
+            if not self.has_partition(output_file):
+                logging.info(f"#@# {output_file} was deleted, re-querying")
+                return True
+            return False
+        # not in the manifest yet, fall back to the file itself
+        partition_file = find_partition(output_file) if self.has_partition(output_file) else None
+        if partition_file is None:
+            return True
+        stat = partition_file.stat()
+        self._set(
+            output_file,
+            {
+                "sql_sha1": sql_hash,
+                "rows": None,
+                "bytes": stat.st_size,
+                "fetched_at": datetime.datetime.fromtimestamp(stat.st_mtime).isoformat(timespec="seconds"),
+                "adopted": True,
+            },
+        )
+        return False
+
+    def record(self, output_file: Union[str, Path], query: str, rows: int) -> None:
+        output_file = Path(output_file)
+        with self._lock:
+            if str(output_file.parent) in self._listings:
+                self._listings[str(output_file.parent)].add(output_file.name)
+        self._set(
+            output_file,
+            {
+                "sql_sha1": get_sql_hash(query),
+                "rows": int(rows),
+                "bytes": Path(output_file).stat().st_size,
+                "fetched_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            },
+        )
+
+    def _set(self, output_file: Union[str, Path], entry: dict) -> None:
+        with self._lock:
+            self.entries[str(output_file)] = entry
+            self._unsaved += 1
+            save = self._unsaved >= self.autosave_every
+        if save:
+            self.save()
+
+    def save(self) -> None:
+        with self._lock:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            self._unsaved = 0
+
+
+class CombineWatermark:
+    """Which partitions (and which version of each) are already in each combined output.
+
+    Maps output file -> {partition date: signature}, where the signature is built from the size
+    and mtime of the partition's files, so rewritten partitions are picked up again.
+    """
+
+    def __init__(self, path: Union[str, Path] = "data/combine_watermark.json"):
+        self.path = Path(path)
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries: Dict[str, Dict[str, str]] = json.load(f)
+        else:
+            self.entries = {}
+
+    def __contains__(self, output_file: Union[str, Path]) -> bool:
+        return str(output_file) in self.entries
+
+    def get(self, output_file: Union[str, Path]) -> Dict[str, str]:
+        return self.entries.get(str(output_file), {})
+
+    def set(self, output_file: Union[str, Path], signatures: Dict[str, str]) -> None:
+        self.entries[str(output_file)] = dict(signatures)
+        self.save()
+
+    def save(self) -> None:
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -0,0 +1,145 @@
+from typing import Iterable, Iterator, List, Union
+
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["NFTMetadataStore"]
+
+METADATA_COLUMNS = [
+    "mint",
+    "name",
+    "symbol",
+    "seller_fee_basis_points",
+    "uri",
+    "update_authority",
+    "creator_address",
+    "creator_share",
+]
+
+
+class NFTMetadataStore:
+    """Keyed store of the helius metadata of each nft mint, replacing one json file per mint.
+
+    Every mint that has been looked up has a row; mints without on-chain metadata have
+    `has_metadata = 0`, so they are not requested again (as with `checked_for_metadata.txt`).
+    """
+
+    def __init__(self, path: Union[str, Path] = "data/nft_metadata.db"):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """
+            create table if not exists metadata (
+                mint text primary key,
+                has_metadata integer not null,
+                name text,
+                symbol text,
+                seller_fee_basis_points real,
+                uri text,
+                update_authority text,
+                creator_address text,
+                creator_share real
+            )
+            """
+        )
+        self.conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("select count(*) from metadata").fetchone()[0]
+
+    def upsert(self, metadata: List[dict], mints_no_metadata: Iterable[str] = ()) -> None:
+        rows = [(x["mint"], 1, *[x.get(k) for k in METADATA_COLUMNS[1:]]) for x in metadata]
+        rows += [(x, 0, *[None] * (len(METADATA_COLUMNS) - 1)) for x in mints_no_metadata]
+        with self._lock:
+            self.conn.executemany(
+                f"insert or replace into metadata (mint, has_metadata, {', '.join(METADATA_COLUMNS[1:])}) "
+                f"values ({', '.join('?' * (len(METADATA_COLUMNS) + 1))})",
+                rows,
+            )
+            self.conn.commit()
+
+    def _load_mints(self, mints: Iterable[str]) -> None:
+        self.conn.execute("create temp table if not exists mints_to_check (mint text primary key)")
+        self.conn.execute("delete from mints_to_check")
+        self.conn.executemany("insert or ignore into mints_to_check values (?)", ((x,) for x in mints))
+
+    def get_unchecked(self, mints: Iterable[str]) -> np.ndarray:
+        """Sorted `mints` that have not been looked up yet, from a single join against the store."""
+        mints = np.unique(np.asarray(list(mints), dtype=str))
+        with self._lock:
+            self._load_mints(mints)
+            rows = self.conn.execute(
+                """
+                select c.mint from mints_to_check c
+                left join metadata m on m.mint = c.mint
+                where m.mint is null
+                order by c.mint
+                """
+            ).fetchall()
+            self.conn.execute("delete from mints_to_check")
+        return np.array([x[0] for x in rows], dtype=str)
+
+    def get(self, mints: Iterable[str]) -> pd.DataFrame:
+        """Metadata of the `mints` that have any."""
+        with self._lock:
+            self._load_mints(mints)
+            df = pd.read_sql_query(
+                f"""
+                select {', '.join(f'm.{x}' for x in METADATA_COLUMNS)} from mints_to_check c
+                join metadata m on m.mint = c.mint
+                where m.has_metadata = 1
+                order by m.mint
+                """,
+                self.conn,
+            )
+            self.conn.execute("delete from mints_to_check")
+        return df
+
+    def iter_frames(self, batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        """All mints with metadata, in batches of `batch_size` ordered by mint and in the columns of
+        the old per-mint json files. Yields a single empty frame if there are none.
+        """
+        last_mint = ""
+        while True:
+            with self._lock:
+                df = pd.read_sql_query(
+                    f"select {', '.join(METADATA_COLUMNS)} from metadata "
+                    "where has_metadata = 1 and mint > ? order by mint limit ?",
+                    self.conn,
+                    params=(last_mint, batch_size),
+                )
+            if len(df) or last_mint == "":
+                yield df
+            if len(df) < batch_size:
+                return
+            last_mint = df["mint"].iloc[-1]
+
+    def import_legacy(
+        self,
+        metadata_dir: Union[str, Path] = "data/nft_metadata",
+        checked_file: Union[str, Path] = "data/checked_for_metadata.txt",
+    ) -> int:
+        """Load the per-mint json files and the list of checked mints written before the store existed."""
+        metadata = []
+        for x in Path(metadata_dir).glob("*.json"):
+            with open(x) as f:
+                metadata.append(json.load(f))
+        checked = []
+        if Path(checked_file).exists():
+            with open(checked_file) as f:
+                checked = [x.strip() for x in f if x.strip()]
+        mints_no_metadata = set(checked) - {x["mint"] for x in metadata}
+        self.upsert(metadata, mints_no_metadata)
+        logging.info(
+            f"#@# Imported metadata of {len(metadata)} mints ({len(mints_no_metadata)} without) into {self.path}"
+        )
+        return len(metadata) + len(mints_no_metadata)
@@ -0,0 +1,175 @@
+from typing import Dict, Optional, Union
+
+import datetime
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+__all__ = ["QueryResultCache", "get_expires_at"]
+
+# `{date}_{name}_{param}.csv` files written before the cache had an index
+LEGACY_FILE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}_.+\.csv$")
+
+
+def get_expires_at(
+    created_at: float, max_age: Optional[float] = None, refresh_hour: Optional[int] = None
+) -> float:
+    """When a result created at `created_at` (epoch seconds) goes stale.
+
+    With `refresh_hour`, results stay fresh until that hour (UTC) comes round again, i.e. until
+    the next day's data has landed; otherwise after `max_age` seconds.
+    """
+    if refresh_hour is None:
+        return created_at + max_age
+    created = datetime.datetime.fromtimestamp(created_at, tz=datetime.timezone.utc)
+    expires = created.replace(hour=refresh_hour, minute=0, second=0, microsecond=0)
+    if expires <= created:
+        expires += datetime.timedelta(days=1)
+    return expires.timestamp()
+
+
+class QueryResultCache:
+    """Size-bounded cache of interactive query results, indexed by query name and parameter.
+
+    Results are stored as zstd parquet files in `cache_dir`, with one sqlite row per
+    (name, param) holding its path, size, expiry and last access. How long a result stays fresh
+    depends on its query: `policies` maps query names to `get_expires_at` keyword arguments,
+    and other queries use `default_max_age`. Expired results are deleted, and the least recently
+    used ones once the total size is over `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = "data/cache",
+        max_bytes: int = 512 * 2**20,
+        policies: Optional[Dict[str, dict]] = None,
+        default_max_age: float = 6 * 3600,
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_bytes = max_bytes
+        self.policies = policies or {}
+        self.default_max_age = default_max_age
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.cache_dir / "index.db", check_same_thread=False, timeout=30)
+        self.conn.execute(
+            """
+            create table if not exists results (
+                name text not null,
+                param text not null,
+                path text not null,
+                rows integer not null,
+                bytes integer not null,
+                created_at real not null,
+                expires_at real not null,
+                last_access real not null,
+                primary key (name, param)
+            )
+            """
+        )
+        self.conn.commit()
+        self._remove_legacy_files()
+
+    def _remove_legacy_files(self) -> None:
+        legacy = [x for x in self.cache_dir.iterdir() if LEGACY_FILE_PATTERN.match(x.name)]
+        for x in legacy:
+            x.unlink(missing_ok=True)
+        if legacy:
+            logging.info(f"#@# Removed {len(legacy)} unindexed result files from {self.cache_dir}")
+
+    def get_path(self, name: str, param: str, created_at: float) -> Path:
+        param = re.sub(r"[^A-Za-z0-9_.-]", "_", str(param))
+        return self.cache_dir / f"{name}_{param}_{created_at * 1000:.0f}.parquet"
+
+    def get(self, name: str, param: str) -> Optional[Path]:
+        """Path of the fresh result of `name` for `param`, if there is one."""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "select path from results where name = ? and param = ? and expires_at > ?",
+                (name, str(param), now),
+            ).fetchone()
+            if row is None or not Path(row[0]).exists():
+                return None
+            self.conn.execute(
+                "update results set last_access = ? where name = ? and param = ?", (now, name, str(param))
+            )
+            self.conn.commit()
+        return Path(row[0])
+
+    def put(self, name: str, param: str, csv_file: Union[str, Path]) -> Path:
+        """Store the results in `csv_file` (which is removed) and return the path they are read from."""
+        created_at = time.time()
+        path = self.get_path(name, param, created_at)
+        df = pd.read_csv(csv_file)
+        tmp = path.with_name(f"{path.name}.tmp")
+        df.to_parquet(tmp, compression="zstd", index=False)
+        os.replace(tmp, path)
+        Path(csv_file).unlink(missing_ok=True)
+        policy = self.policies.get(name, {"max_age": self.default_max_age})
+        with self._lock:
+            old = self.conn.execute(
+                "select path from results where name = ? and param = ?", (name, str(param))
+            ).fetchone()
+            self.conn.execute(
+                """
+                insert or replace into results
+                (name, param, path, rows, bytes, created_at, expires_at, last_access)
+                values (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    name,
+                    str(param),
+                    str(path),
+                    len(df),
+                    path.stat().st_size,
+                    created_at,
+                    get_expires_at(created_at, **policy),
+                    created_at,
+                ),
+            )
+            self.conn.commit()
+        if old is not None and old[0] != str(path):
+            Path(old[0]).unlink(missing_ok=True)
+        self.evict(keep=(name, str(param)))
+        return path
+
+    def evict(self, keep: Optional[tuple] = None) -> int:
+        """Delete expired results, then the least recently used until the cache fits in `max_bytes`.
+
+        `keep` is a (name, param) that is never evicted, e.g. the result just stored.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "select name, param, path, bytes, expires_at from results order by last_access desc"
+            ).fetchall()
+            now = time.time()
+            total = 0
+            evicted = []
+            for name, param, path, nbytes, expires_at in rows:
+                if (name, param) != keep and (expires_at <= now or total + nbytes > self.max_bytes):
+                    evicted.append((name, param, path))
+                else:
+                    total += nbytes
+            self.conn.executemany(
+                "delete from results where name = ? and param = ?", [x[:2] for x in evicted]
+            )
+            self.conn.commit()
+        for _, _, path in evicted:
+            Path(path).unlink(missing_ok=True)
+        if evicted:
+            logging.info(
+                f"#@# Evicted {len(evicted)} query results from {self.cache_dir} ({total / 2**20:.1f} MB kept)"
+            )
+        return len(evicted)
+
+    def summary(self) -> dict:
+        with self._lock:
+            n, nbytes = self.conn.execute("select count(*), coalesce(sum(bytes), 0) from results").fetchone()
+        return {"results": n, "bytes": nbytes, "max_bytes": self.max_bytes}
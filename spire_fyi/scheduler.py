@@ -0,0 +1,167 @@
+from typing import Any, Callable, List, Optional
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from pathlib import Path
+
+from flipside.errors import QueryRunRateLimitError
+
+from .dates import get_file_date
+
+__all__ = [
+    "TokenBucket",
+    "QueryScheduler",
+    "is_rate_limit_error",
+    "get_date_priority",
+]
+
+# HACK: flipside reports concurrency limits as a generic ApiError, so check the error name as well
+RATE_LIMIT_MESSAGES = ["MaxConcurrentQueries", "QUERY_RUN_RATE_LIMIT_ERROR", "status code: 429"]
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    if isinstance(e, QueryRunRateLimitError):
+        return True
+    msg = str(e)
+    return any(x in msg for x in RATE_LIMIT_MESSAGES) or "rate limit" in msg.lower()
+
+
+def get_date_priority(output_file: Path) -> float:
+    """Most recent dates first, so newer partitions land before historical backfill.
+
+    Lower values run first; files without a date in their name run last.
+    """
+    date = get_file_date(output_file)
+    if date is None:
+        return 0.0
+    return -time.mktime(time.strptime(date, "%Y-%m-%d"))
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens are added per second, up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int, min_rate: Optional[float] = None):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def slow_down(self) -> None:
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def speed_up(self, step: Optional[float] = None) -> None:
+        self.rate = min(self.max_rate, self.rate + (step or self.max_rate / 10))
+
+
+class QueryScheduler:
+    """Runs blocking query functions concurrently, throttled by a token bucket.
+
+    Jobs are pulled from a priority queue (lowest value first). When `func` raises an error
+    that `is_rate_limit_error` recognizes, every worker pauses for an exponentially growing
+    backoff, the bucket rate is halved and the job is requeued. Successful calls slowly raise
+    the rate back up to the configured maximum.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[Any], Any],
+        rate: float = 2.0,
+        burst: int = 8,
+        max_concurrency: int = 8,
+        max_rate_limit_retries: int = 10,
+        min_backoff: float = 5.0,
+        max_backoff: float = 300.0,
+    ):
+        self.func = func
+        self.bucket = TokenBucket(rate, burst)
+        self.max_concurrency = max_concurrency
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._backoff = min_backoff
+        self._paused_until = 0.0
+        self._queue: List[tuple] = []
+        self._counter = itertools.count()
+        self.results: List[Any] = []
+        self.rate_limited = 0
+
+    def submit(self, item: Any, priority: float = 0.0) -> None:
+        heapq.heappush(self._queue, (priority, next(self._counter), 0, item))
+
+    def submit_many(self, items: List[Any], priority_func: Optional[Callable[[Any], float]] = None) -> None:
+        for x in items:
+            self.submit(x, 0.0 if priority_func is None else priority_func(x))
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    async def _wait_for_backoff(self) -> None:
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _on_rate_limit(self) -> None:
+        self.rate_limited += 1
+        self.bucket.slow_down()
+        pause = self._backoff * (1 + random.random() / 2)
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        self._backoff = min(self.max_backoff, self._backoff * 2)
+        logging.info(
+            f"#@# Rate limited, pausing {pause:.1f}s and slowing to {self.bucket.rate:.2f} queries/s"
+        )
+
+    def _on_success(self) -> None:
+        self._backoff = max(self.min_backoff, self._backoff / 2)
+        self.bucket.speed_up()
+
+    async def _call(self, item: Any) -> Any:
+        return await asyncio.to_thread(self.func, item)
+
+    async def _worker(self) -> None:
+        while self._queue:
+            priority, count, attempts, item = heapq.heappop(self._queue)
+            await self._wait_for_backoff()
+            await self.bucket.acquire()
+            try:
+                result = await self._call(item)
+            except Exception as e:
+                if is_rate_limit_error(e) and attempts < self.max_rate_limit_retries:
+                    self._on_rate_limit()
+                    heapq.heappush(self._queue, (priority, count, attempts + 1, item))
+                    continue
+                logging.info(f"[ERROR] {e}")
+                self.results.append(None)
+                continue
+            self._on_success()
+            self.results.append(result)
+
+    async def run(self) -> List[Any]:
+        n_workers = max(1, min(self.max_concurrency, len(self._queue)))
+        start = time.monotonic()
+        total = len(self._queue)
+        await asyncio.gather(*[self._worker() for _ in range(n_workers)])
+        logging.info(
+            f"#@# Ran {total} queries in {time.monotonic() - start:.1f}s ({self.rate_limited} rate limited)"
+        )
+        return self.results
@@ -0,0 +1,234 @@
+from typing import Dict, Iterable, List, Optional, Union
+
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .dates import get_file_date
+
+__all__ = [
+    "PARQUET_DIR",
+    "schemas",
+    "csv_dtypes",
+    "get_csv_dtypes",
+    "get_file_date",
+    "in_date_range",
+    "has_dataset",
+    "get_partition_file",
+    "get_partition_files",
+    "get_partition_dates",
+    "write_partition",
+    "csv_to_partition",
+    "convert_csv_dir",
+    "read_dataset",
+]
+
+PARQUET_DIR = Path("data/parquet")
+PARTITION_KEY = "partition_date"
+
+# Fixed (uppercased) schema per query template, only these are written to parquet
+program_schema = {"DATE": "str", "PROGRAM_ID": "str", "TX_COUNT": "int64", "SIGNERS": "int64"}
+schemas: Dict[str, Dict[str, str]] = {
+    "sdk_programs_sol": program_schema,
+    "sdk_programs_new_users_sol": program_schema,
+    "sdk_programs_all_signers_sol": program_schema,
+    "sdk_programs_new_users_all_signers_sol": program_schema,
+    "sdk_dex": {"DATE": "str", "TXS": "int64", "FEE_PAYERS": "int64", "DEX": "str"},
+    "sdk_openbook_users": {"TYPE": "str", "DATE": "str", "WALLETS": "int64", "DEX": "str"},
+    "sdk_top_stakers_by_date_sol": {
+        "STAKER": "str",
+        "TOTAL_STAKE": "float64",
+        "ADDRESS_NAME": "str",
+        "LABEL": "str",
+        "LABEL_SUBTYPE": "str",
+        "LABEL_TYPE": "str",
+    },
+}
+# dtypes for reading per-date csvs, including templates that are not stored as parquet
+csv_dtypes: Dict[str, Dict[str, str]] = {
+    **schemas,
+    "sdk_signers_by_programID_sol": {"PROGRAM_ID": "str", "SIGNERS": "str"},
+    "sdk_signers_by_programID_new_users_sol": {"PROGRAM_ID": "str", "SIGNERS": "str"},
+    "sdk_top_liquid_staking_token_holders_delta": {
+        "DATE": "str",
+        "WALLET": "str",
+        "TOKEN": "str",
+        "TOKEN_NAME": "str",
+        "SYMBOL": "str",
+        "AMOUNT": "float64",
+        "AMOUNT_USD": "float64",
+    },
+    "sdk_nft_mints": {
+        "BLOCK_TIMESTAMP": "str",
+        "TX_ID": "str",
+        "PURCHASER": "str",
+        "SELLER": "str",
+        "MINT": "str",
+        "SALES_AMOUNT": "float64",
+    },
+}
+arrow_types = {"str": pa.string(), "int64": pa.int64(), "float64": pa.float64()}
+
+
+def in_date_range(
+    path: Union[str, Path], start_date: Optional[str] = None, end_date: Optional[str] = None
+) -> bool:
+    date = get_file_date(path)
+    if date is None:
+        return True
+    return (start_date is None or date >= str(start_date)) and (end_date is None or date <= str(end_date))
+
+
+def get_csv_dtypes(query_basename: str) -> Optional[Dict[str, str]]:
+    """`pd.read_csv` dtypes for a template, under each casing flipside has returned column names in.
+
+    Integer columns are left to inference, since they may be missing in older partitions.
+    """
+    if query_basename not in csv_dtypes:
+        return None
+    dtype = {}
+    for col, t in csv_dtypes[query_basename].items():
+        if t == "int64":
+            continue
+        for name in [col, col.lower(), col.title()]:
+            dtype[name] = str if t == "str" else t
+    return dtype
+
+
+def get_arrow_schema(query_basename: str) -> pa.Schema:
+    return pa.schema([(k, arrow_types[v]) for k, v in schemas[query_basename].items()])
+
+
+def get_dataset_dir(query_basename: str, root: Union[str, Path] = PARQUET_DIR) -> Path:
+    return Path(root, query_basename)
+
+
+def has_dataset(query_basename: str, root: Union[str, Path] = PARQUET_DIR) -> bool:
+    d = get_dataset_dir(query_basename, root)
+    return d.exists() and any(d.glob(f"{PARTITION_KEY}=*/*.parquet"))
+
+
+def get_partition_files(query_basename: str, root: Union[str, Path] = PARQUET_DIR) -> Dict[str, Path]:
+    d = get_dataset_dir(query_basename, root)
+    return {x.parent.name.split("=")[1]: x for x in sorted(d.glob(f"{PARTITION_KEY}=*/*.parquet"))}
+
+
+def get_partition_file(query_basename: str, date: str, root: Union[str, Path] = PARQUET_DIR) -> Path:
+    """`<root>/<query_basename>/partition_date=<date>/part-0.parquet`"""
+    return Path(get_dataset_dir(query_basename, root), f"{PARTITION_KEY}={date}", "part-0.parquet")
+
+
+def get_partition_dates(query_basename: str, root: Union[str, Path] = PARQUET_DIR) -> List[str]:
+    return sorted(get_partition_files(query_basename, root))
+
+
+def cast_to_schema(df: pd.DataFrame, query_basename: str) -> pd.DataFrame:
+    # restore old flipside behavior
+    df = df.rename(columns={x: x.upper() for x in df.columns})
+    schema = schemas[query_basename]
+    missing = [x for x in schema if x not in df.columns]
+    if missing:
+        raise ValueError(f"{query_basename} is missing columns {missing}")
+    df = df[list(schema)].copy()
+    for col, dtype in schema.items():
+        if dtype == "str":
+            df[col] = df[col].astype("string")
+        else:
+            df[col] = pd.to_numeric(df[col]).astype(dtype)
+    return df
+
+
+def write_partition(
+    df: pd.DataFrame, query_basename: str, date: str, root: Union[str, Path] = PARQUET_DIR
+) -> Path:
+    """Write one date of `query_basename` to its partition file (see `get_partition_file`)."""
+    df = cast_to_schema(df, query_basename)
+    table = pa.Table.from_pandas(df, schema=get_arrow_schema(query_basename), preserve_index=False)
+    output_file = get_partition_file(query_basename, date, root)
+    output_file.parent.mkdir(exist_ok=True, parents=True)
+    tmp = output_file.with_suffix(".tmp")
+    pq.write_table(table, tmp)
+    os.replace(tmp, output_file)
+    return output_file
+
+
+def read_partition_csv(csv_file: Union[str, Path], query_basename: str) -> pd.DataFrame:
+    return pd.read_csv(csv_file, dtype=get_csv_dtypes(query_basename))
+
+
+def csv_to_partition(
+    csv_file: Union[str, Path], query_basename: str, date: Optional[str] = None, remove_csv: bool = True
+) -> Path:
+    csv_file = Path(csv_file)
+    date = date or get_file_date(csv_file)
+    output_file = write_partition(read_partition_csv(csv_file, query_basename), query_basename, date)
+    if remove_csv:
+        csv_file.unlink()
+    return output_file
+
+
+def convert_csv_dir(
+    query_basename: str, data_dir: Optional[Union[str, Path]] = None, remove_csv: bool = False
+) -> int:
+    """Migrate the existing per-date csvs of `query_basename` to parquet partitions."""
+    data_dir = Path(data_dir or f"data/{query_basename}")
+    n = 0
+    for x in sorted(data_dir.glob("*.csv")):
+        date = get_file_date(x)
+        if date is None:
+            continue
+        try:
+            csv_to_partition(x, query_basename, date, remove_csv=remove_csv)
+            n += 1
+        except Exception as e:
+            logging.info(f"[ERROR] ({x}) {e}")
+    logging.info(f"#@# Converted {n} partitions of {query_basename} to parquet")
+    return n
+
+
+def read_dataset(
+    query_basename: str,
+    columns: Optional[Iterable[str]] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    add_date: bool = False,
+    root: Union[str, Path] = PARQUET_DIR,
+    dates: Optional[Iterable[str]] = None,
+) -> pd.DataFrame:
+    """Read a hive-partitioned dataset, loading only `columns` and the partitions in the date range.
+
+    `dates`, if given, selects the partitions instead of the date range.
+    """
+    dataset = ds.dataset(
+        get_dataset_dir(query_basename, root),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([(PARTITION_KEY, pa.string())]), flavor="hive"),
+    )
+    filters = None
+    if start_date is not None:
+        filters = ds.field(PARTITION_KEY) >= str(start_date)
+    if end_date is not None:
+        f = ds.field(PARTITION_KEY) <= str(end_date)
+        filters = f if filters is None else filters & f
+    if dates is not None:
+        f = ds.field(PARTITION_KEY).isin(list(dates))
+        filters = f if filters is None else filters & f
+    if columns is not None:
+        columns = [x for x in schemas[query_basename] if x in {c.upper() for c in columns}]
+    else:
+        columns = list(schemas[query_basename])
+    if add_date:
+        columns = [*columns, PARTITION_KEY]
+    df = dataset.to_table(columns=columns, filter=filters).to_pandas(ignore_metadata=True)
+    # keep object columns with NaN for missing values, as with the csv reader
+    str_cols = [x for x in df.columns if schemas[query_basename].get(x, "str") == "str"]
+    df[str_cols] = df[str_cols].where(df[str_cols].notna(), np.nan)
+    if add_date:
+        df = df.drop(columns="DATE", errors="ignore").rename(columns={PARTITION_KEY: "DATE"})
+    return df
@@ -1,24 +1,42 @@
-from typing import Dict, Iterable, Optional, Union
+from typing import Callable, Dict, Iterable, List, Optional, Union
 
 import asyncio
 import datetime
+import functools
+import json
 import logging
+import os
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
 from pathlib import Path
 from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import requests
 import solders
 import streamlit as st
 from flipside import Flipside
+from flipside.errors import ApiError
 from helius import NFTAPI, BalancesAPI
 from jinja2 import Environment, FileSystemLoader
 from PIL import Image
 from solana.rpc.async_api import AsyncClient
 
+from . import storage
+from .addresses import AddressDictionary
+from .dataset_cache import Dataset, DatasetCache
+from .fetcher import DatasetFetcher
+from .helius_client import HeliusMetadataClient
+from .http_cache import HTTPCache
+from .jobs import QueryJob, QueryJobManager
+from .labels import SolanaFMLabelStore
+from .nft_metadata import NFTMetadataStore
+from .result_cache import QueryResultCache
 from .xnft.accounts import Xnft
 
 logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
@@ -27,10 +45,22 @@ __all__ = [
     "query_base",
     "api_base",
     "add_program_labels",
+    "build_label_index",
+    "load_label_index",
+    "get_address_dictionary",
+    "encode_address_columns",
+    "build_asof_panel",
     "apply_program_name",
+    "get_program_names",
     "combine_flipside_date_data",
+    "get_partition_signatures",
     "get_flipside_labels",
+    "get_solana_fm_labels",
     "get_program_chart_data",
+    "build_program_rankings",
+    "write_program_rankings",
+    "get_ranked_program_chart_data",
+    "cache_dataset",
     "load_labeled_program_data",
     "load_weekly_new_program_data",
     "load_weekly_program_data",
@@ -47,7 +77,10 @@ __all__ = [
     "get_random_image",
     "reformat_columns",
     "load_flipside_api_data",
-    "run_query_and_cache",
+    "load_flipside_api_datasets",
+    "submit_query_job",
+    "wait_for_query_jobs",
+    "stream_query_to_csv",
     "get_short_address",
     "get_nft_mint_data",
     "get_bonk_balance",
@@ -68,6 +101,25 @@ helius_key = st.secrets["helius"]["api_key"]
 rpc_url = f"https://mainnet.helius-rpc.com/?api-key={helius_key}"
 
 RUN_INTERACTIVE_QUERIES = False
+# total size of the datasets shared across sessions, see `cache_dataset`
+DATASET_CACHE_MAX_BYTES = 2 * 2**30
+# key cached functions taking a `Dataset` on its version, rather than hashing the whole frame
+DATASET_HASH_FUNCS = {Dataset: lambda x: x.version}
+# age after which Flipside API results are refreshed in the background, see `load_flipside_api_datasets`
+FLIPSIDE_API_TTL = 3600
+# API responses revalidated by any worker this recently are served from data/http_cache as they are
+HTTP_CACHE_MAX_AGE = 60
+# size budget of the interactive query results in data/cache, and how long each kind stays fresh:
+# the 60d program charts end yesterday, so they are good until the next day's data has landed
+QUERY_CACHE_MAX_BYTES = 512 * 2**20
+QUERY_CACHE_POLICIES = {
+    "program_usage": {"refresh_hour": 6},
+    "new_wallet": {"refresh_hour": 6},
+}
+
+# Program Activity date ranges (and number of programs) with rankings materialized by the combine step
+PROGRAM_DATE_RANGES = ["90d", "60d", "30d", "14d", "7d"]
+PROGRAM_RANKING_MAX_N = 30
 
 LAMPORTS_PER_SOL = 1_000_000_000
 IPFS_RESOLVER_URL = "https://cloudflare-ipfs.com/ipfs"
@@ -171,34 +223,116 @@ liquid_staking_tokens = {
 }
 
 
+def get_file_signature(x):
+    stat = Path(x).stat()
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def get_partition_key(x):
+    return storage.get_file_date(x) or x.name
+
+
+def get_partition_signatures(data_dir):
+    """Partition key (date, or file name for undated files) -> signature of its files in `data_dir`."""
+    d = Path(data_dir)
+    files = {}
+    for x in d.glob("*.csv"):
+        files.setdefault(get_partition_key(x), []).append(x)
+    if d.name in storage.schemas:
+        for date, x in storage.get_partition_files(d.name).items():
+            files.setdefault(date, []).append(x)
+    signatures = {}
+    for key, xs in files.items():
+        signatures[key] = ",".join(get_file_signature(x) for x in sorted(xs))
+    return signatures
+
+
+def read_flipside_date_file(
+    x, dtype=None, columns=None, rename_columns=None, add_date=False, with_program=False
+):
+    df = pd.read_csv(x, dtype=dtype, usecols=None if columns is None else lambda c: c.upper() in columns)
+    # restore old flipside behavior
+    df.columns = [x.upper() for x in df.columns]
+    if rename_columns is not None:
+        df = df.rename(columns=rename_columns)
+    if add_date and not with_program:
+        date_str = x.name.split("_")[-1].split(".csv")[0]
+        df["DATE"] = date_str
+    if add_date and with_program:
+        date_str = x.name.split("_")[-2]
+        df["DATE"] = date_str
+    return df
+
+
 def combine_flipside_date_data(
-    data_dir, add_date=False, with_program=False, nft_royalty=False, rename_columns=None, raise_error=True
+    data_dir,
+    add_date=False,
+    with_program=False,
+    nft_royalty=False,
+    rename_columns=None,
+    raise_error=True,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    n_workers=8,
+    dates=None,
 ):
+    """Combine the per-date results in `data_dir`.
+
+    Partitions already in the parquet store (see `spire_fyi.storage`) are read from there,
+    with only `columns` and dates between `start_date` and `end_date` loaded; any remaining
+    csvs are read by `n_workers` threads, using the template's dtypes from `storage.csv_dtypes`.
+    Files that fail to parse are summarized at the end, and skipped unless `raise_error`.
+    `dates` limits the read to those partition keys, as returned by `get_partition_signatures`.
+    """
     d = Path(data_dir)
     data_files = d.glob("*.csv")
+    if start_date is not None or end_date is not None:
+        data_files = [x for x in data_files if storage.in_date_range(x, start_date, end_date)]
+    if dates is not None:
+        dates = set(dates)
+        data_files = [x for x in data_files if get_partition_key(x) in dates]
     if nft_royalty:
         data_files_todo = {}
         # TODO: get the most recent / highest mints for each nft collection
     dfs = []
-    for x in data_files:
-        try:
-            df = pd.read_csv(x)
-        except:
-            print(f"Missing data: {x}")
-            if raise_error:
-                raise
-        # restore old flipside behavior
-        df.columns = [x.upper() for x in df.columns]
+    if d.name in storage.schemas and storage.has_dataset(d.name) and not with_program:
+        df = storage.read_dataset(d.name, columns, start_date, end_date, add_date=add_date, dates=dates)
         if rename_columns is not None:
             df = df.rename(columns=rename_columns)
-        if add_date and not with_program:
-            date_str = x.name.split("_")[-1].split(".csv")[0]
-            df["DATE"] = date_str
-        if add_date and with_program:
-            date_str = x.name.split("_")[-2]
-            df["DATE"] = date_str
         dfs.append(df)
-    combined_df = pd.concat(dfs)
+        stored_dates = set(storage.get_partition_dates(d.name))
+        data_files = [x for x in data_files if storage.get_file_date(x) not in stored_dates]
+    if columns is not None:
+        columns = {x.upper() for x in columns}
+        if add_date:
+            columns.add("DATE")
+    data_files = sorted(data_files)
+    dtype = storage.get_csv_dtypes(d.name)
+    results = [None] * len(data_files)
+    bad_files = {}
+    log_every = max(1, len(data_files) // 10)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {
+            pool.submit(read_flipside_date_file, x, dtype, columns, rename_columns, add_date, with_program): i
+            for i, x in enumerate(data_files)
+        }
+        for n, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                bad_files[data_files[i]] = e
+            if n % log_every == 0 or n == len(data_files):
+                logging.info(f"#@# Read {n}/{len(data_files)} files from {d}")
+    if bad_files:
+        logging.info(f"#@# {len(bad_files)} bad files in {d}:")
+        for x, e in bad_files.items():
+            logging.info(f"Missing data: {x} ({type(e).__name__}: {e})")
+        if raise_error:
+            raise next(iter(bad_files.values()))
+    dfs.extend(x for x in results if x is not None)
+    combined_df = pd.concat(dfs, copy=False)
     try:
         combined_df = combined_df.drop(columns="__ROW_INDEX")
     except KeyError:
@@ -206,6 +340,108 @@ def combine_flipside_date_data(
     return combined_df
 
 
+def get_max_page_size(e: Exception, page_size: int) -> Union[int, None]:
+    """Largest usable page size after a `RequestedPageSizeTooLarge` error, or None for other errors.
+
+    Keeps halving `page_size` (rather than using the suggested size directly), so the new pages
+    usually line up with the rows already written. Once halving reaches an odd size they no longer
+    do, and `stream_query_to_csv` skips the rows it already has from the first page it refetches.
+    """
+    msg = str(e)
+    if "RequestedPageSizeTooLarge" not in msg:
+        return None
+    # HACK: attempt to parse error message
+    suggested = re.search(r"reducing your page size to below (\d+)", msg)
+    max_rows = int(suggested.group(1)) if suggested else page_size
+    page_size = page_size // 2
+    while page_size >= max_rows:
+        page_size = page_size // 2
+    return page_size
+
+
+def stream_query_to_csv(
+    query: str,
+    output_file: Union[str, Path],
+    page_size: int = 100000,
+    min_page_size: int = 1000,
+    ttl_minutes: int = 120,
+    timeout_minutes: int = 30,
+    cached: bool = False,
+    on_page: Optional[Callable[[int, int], None]] = None,
+) -> int:
+    """Run `query` and append its results to `output_file` one page at a time.
+
+    Rows are written to a `.part` file that replaces `output_file` once every page has been
+    fetched, so an interrupted download never leaves a truncated csv behind. If the server
+    rejects the page size, it is halved (down to `min_page_size`) and the query run is reused.
+    `on_page(page_number, total_pages)` is called after each page. Returns the number of rows written.
+    """
+    output_file = Path(output_file)
+    output_file.parent.mkdir(exist_ok=True, parents=True)
+    part_file = output_file.with_name(f"{output_file.name}.part")
+    query_id = None
+    max_age_minutes = 0
+    header = True
+    rows_written = 0
+    # rows at the start of the next page that were already written with the previous page size
+    skip_rows = 0
+    page_number = 1
+    total_pages = None
+    with open(part_file, "w", newline="") as f:
+        while total_pages is None or page_number <= total_pages:
+            try:
+                if query_id is None:
+                    query_result_set = sdk.query(
+                        query,
+                        ttl_minutes=ttl_minutes,
+                        timeout_minutes=timeout_minutes,
+                        retry_interval_seconds=1,
+                        page_size=page_size,
+                        page_number=page_number,
+                        max_age_minutes=max_age_minutes,
+                        cached=cached,
+                    )
+                else:
+                    query_result_set = sdk.get_query_results(
+                        query_id, page_number=page_number, page_size=page_size
+                    )
+            except ApiError as e:
+                new_page_size = get_max_page_size(e, page_size)
+                if new_page_size is None or new_page_size < min_page_size:
+                    part_file.unlink(missing_ok=True)
+                    raise
+                logging.info(f"#@# Page size {page_size} too large for {output_file}, trying {new_page_size}")
+                page_number = rows_written // new_page_size + 1
+                skip_rows = rows_written % new_page_size
+                page_size = new_page_size
+                # the page count changes with the page size
+                total_pages = None
+                # the query run has finished already, reuse it instead of re-running the query
+                max_age_minutes = ttl_minutes
+                continue
+            except Exception:
+                part_file.unlink(missing_ok=True)
+                raise
+            query_id = query_result_set.query_id
+            if query_result_set.page is not None:
+                total_pages = query_result_set.page.totalPages
+            else:
+                total_pages = page_number
+            rows = (query_result_set.rows or [])[skip_rows:]
+            skip_rows = 0
+            if rows or header:
+                pd.DataFrame(rows, columns=query_result_set.columns).to_csv(f, header=header, index=False)
+                header = False
+            rows_written += len(rows)
+            if total_pages > 1:
+                logging.info(f"#@# Fetched page {page_number}/{total_pages} for {output_file}")
+            if on_page is not None:
+                on_page(page_number, total_pages)
+            page_number += 1
+    os.replace(part_file, output_file)
+    return rows_written
+
+
 def query_flipside_data(query_info, save=True):
     query, output_file = query_info
     query_file = Path(output_file.parent, "queries", f"{output_file.stem}.sql")
@@ -214,22 +450,10 @@ def query_flipside_data(query_info, save=True):
     with open(query_file, "w") as f:
         f.write(query)
     try:
-        query_result_set = sdk.query(
-            query,
-            ttl_minutes=120,
-            timeout_minutes=30,
-            retry_interval_seconds=1,
-            page_size=1000000,
-            page_number=1,
-            cached=False,
-        )
         if save:
-            df = pd.DataFrame(query_result_set.rows, columns=query_result_set.columns)
-            output_file.parent.mkdir(exist_ok=True, parents=True)
-            df.to_csv(
-                output_file,
-                index=False,
-            )
+            stream_query_to_csv(query, output_file)
+        else:
+            sdk.query(query, ttl_minutes=120, timeout_minutes=30, retry_interval_seconds=1, cached=False)
         logging.info(f"#@# Saved {output_file}")
         return output_file
     except Exception as e:
@@ -244,59 +468,210 @@ def create_label_query(addresses):
     return query
 
 
-def get_flipside_labels(df, output_prefix, col):
+@st.cache_resource
+def get_http_cache():
+    return HTTPCache("data/http_cache", max_age=HTTP_CACHE_MAX_AGE)
+
+
+def read_api_json(url: str) -> pd.DataFrame:
+    """`pd.read_json` of an API url, through the on-disk response cache shared by all workers."""
+    return get_http_cache().read_json(url, headers=storage_options)
+
+
+@st.cache_resource
+def get_dataset_cache():
+    return DatasetCache(DATASET_CACHE_MAX_BYTES)
+
+
+def cache_dataset(ttl=None):
+    """Like `st.cache_data` for dataset loaders, but kept once per process instead of copied per session.
+
+    Returns a shallow view of read-only arrays: pages can add or replace columns, but not write in place.
+    `func.dataset(...)` returns the same view as a versioned `Dataset`, to pass on to cached functions.
+    """
+
+    def decorator(func):
+        def get_key(args, kwargs):
+            return (func.__qualname__, args, tuple(sorted(kwargs.items())))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return get_dataset_cache().get(get_key(args, kwargs), lambda: func(*args, **kwargs), ttl=ttl)
+
+        def dataset(*args, **kwargs):
+            return get_dataset_cache().get_dataset(
+                get_key(args, kwargs), lambda: func(*args, **kwargs), ttl=ttl
+            )
+
+        wrapper.dataset = dataset
+        return wrapper
+
+    return decorator
+
+
+@st.cache_resource
+def get_address_dictionary():
+    return AddressDictionary("data/address_dictionary.csv")
+
+
+def encode_address_columns(df, columns):
+    """Replace address columns with categoricals encoded by the shared address dictionary."""
+    addresses = get_address_dictionary()
+    for col in columns:
+        if col in df.columns:
+            df[col] = addresses.to_categorical(df[col])
+    return df
+
+
+def get_new_label_ids(ids, label_file, address_col="ADDRESS"):
+    """Ids not in an existing label file yet (ids without any label are looked up again)."""
+    if not Path(label_file).exists():
+        return ids
+    existing = pd.read_csv(label_file, usecols=lambda c: c.upper() == address_col, dtype=str)
+    return np.setdiff1d(ids, existing.iloc[:, 0].astype(str))
+
+
+def merge_label_file(label_file, new_label_file, address_col="ADDRESS"):
+    """Add newly fetched labels to `label_file`, keeping the existing labels of other ids."""
+    new_labels = pd.read_csv(new_label_file)
+    if Path(label_file).exists():
+        labels = pd.read_csv(label_file)
+        new_addresses = new_labels[[x for x in new_labels.columns if x.upper() == address_col][0]]
+        old_addresses = labels[[x for x in labels.columns if x.upper() == address_col][0]]
+        labels = pd.concat([labels[~old_addresses.isin(new_addresses)], new_labels])
+    else:
+        labels = new_labels
+    labels.to_csv(label_file, index=False)
+    Path(new_label_file).unlink()
+
+
+def get_flipside_labels(df, output_prefix, col, update=False):
+    """Query flipside labels for the ids in `df[col]`.
+
+    With `update`, only ids missing from the existing label file are queried, and their
+    labels are added to it instead of replacing it.
+    """
     # #TODO combine with solana.fm
     ids = df[col].unique()
+    output_file = Path(f"data/{output_prefix}_flipside_labels.csv")
+    if update:
+        ids = get_new_label_ids(ids, output_file)
+        if len(ids) == 0:
+            return
+        new_output_file = output_file.with_name(f"{output_file.stem}_new.csv")
+        query_flipside_data([create_label_query(ids), new_output_file])
+        merge_label_file(output_file, new_output_file)
+        return
     labels = create_label_query(ids)
-    query_flipside_data([labels, Path(f"data/{output_prefix}_flipside_labels.csv")])
+    query_flipside_data([labels, output_file])
+
 
+@st.cache_resource
+def get_solana_fm_label_store():
+    return SolanaFMLabelStore("data/solana_fm_labels.db")
 
-def get_solana_fm_labels(df, output_prefix, col):
+
+def get_solana_fm_labels(df, output_prefix, col, update=False):
+    """Write the solana.fm labels of the ids in `df[col]` to `data/<output_prefix>_solana_fm_labels.csv`.
+
+    Labels come from the persistent label store, so only ids it has never seen (or whose
+    entry has expired) are requested. With `update`, labels of ids already in the file are kept.
+    """
     ids = df[col].unique()
-    split_ids = [ids[i : i + 100] for i in range(0, len(ids), 100)]
-
-    label_url = "https://api.solana.fm/v0/accounts"
-    label_results = []
-    for i, id_set in enumerate(split_ids):
-        if i % 4 == 0:
-            time.sleep(1)
-        r = requests.post(label_url, json={"accountHashes": list(id_set)})
-        res = r.json()["result"]
-        for x in res:
-            try:
-                data = x["data"]
-                data["ADDRESS"] = x["accountHash"]
-                label_results.append(data)
-            except KeyError:
-                pass
-    df = pd.DataFrame(label_results).sort_values(by="ADDRESS").reset_index(drop=True)
-    df = df.rename(columns={x: (x[0].upper() + x[1:]).replace("_", " ") for x in df.columns})
-    df.to_csv(f"data/{output_prefix}_solana_fm_labels.csv", index=False)
+    output_file = Path(f"data/{output_prefix}_solana_fm_labels.csv")
+    store = get_solana_fm_label_store()
+    store.import_csv(output_file)
+    store.fetch(ids)
+    if update and output_file.exists():
+        ids = np.union1d(ids.astype(str), pd.read_csv(output_file, usecols=["ADDRESS"], dtype=str).ADDRESS)
+    df = store.to_frame(ids)
+    if df.empty:
+        return
+    df.to_csv(output_file, index=False)
 
 
 def load_program_label_df(prefix="program", use_manual=True, sfm_only=False):
-    solfm_labs = pd.read_csv(f"data/{prefix}_solana_fm_labels.csv")
+    """All labels of `prefix`, one row per address.
+
+    Manual labels take precedence over flipside labels for the same address, and the solana.fm
+    columns (FriendlyName, Category, ...) are joined alongside them.
+    """
+    solfm_labs = pd.read_csv(f"data/{prefix}_solana_fm_labels.csv", dtype={"ADDRESS": str})
+    solfm_labs = solfm_labs.drop_duplicates(subset="ADDRESS", keep="last")
     if sfm_only:
         return solfm_labs
     else:
-        fs_labs = pd.read_csv(f"data/{prefix}_flipside_labels.csv")
+        fs_labs = pd.read_csv(f"data/{prefix}_flipside_labels.csv", dtype={"address": str, "ADDRESS": str})
         fs_labs.columns = [x.upper() for x in fs_labs.columns]
-        fs_labs["ADDRESS"] = fs_labs["ADDRESS"].apply(
-            lambda x: "11111111111111111111111111111111" if x == "1.1111111111111112e+31" else x
+        fs_labs["ADDRESS"] = fs_labs["ADDRESS"].replace(
+            "1.1111111111111112e+31", "11111111111111111111111111111111"
         )
-        try:
-            fs_labs = fs_labs.drop(columns="__ROW_INDEX")
-        except KeyError:
-            pass
+        fs_labs = fs_labs.drop(columns="__ROW_INDEX", errors="ignore")
         if use_manual:
-            manual_labs = pd.read_csv("data/program_manual_labels.csv")
+            manual_labs = pd.read_csv("data/program_manual_labels.csv", dtype={"ADDRESS": str})
             labs = pd.concat([fs_labs, manual_labs])
         else:
             labs = fs_labs
+        labs = labs.drop_duplicates(subset="ADDRESS", keep="last")
         merged = labs.merge(solfm_labs, on="ADDRESS", how="outer")
         return merged
 
 
+def get_label_sources(prefix="program", use_manual=True, sfm_only=False):
+    sources = [f"data/{prefix}_solana_fm_labels.csv"]
+    if not sfm_only:
+        sources.append(f"data/{prefix}_flipside_labels.csv")
+        if use_manual:
+            sources.append("data/program_manual_labels.csv")
+    return sources
+
+
+def get_label_index_file(prefix="program", use_manual=True, sfm_only=False):
+    suffix = "_sfm" if sfm_only else ("" if use_manual else "_no_manual")
+    return Path(f"data/{prefix}_label_index{suffix}.parquet")
+
+
+def build_label_index(prefix="program", use_manual=True, sfm_only=False):
+    """Compile the labels of `prefix` (see `load_program_label_df`) and their display `Name` to parquet.
+
+    The signatures of the source files are kept in the file metadata, so `load_label_index`
+    can tell when the index is out of date.
+    """
+    label_df = load_program_label_df(prefix, use_manual, sfm_only)
+    name_cols = ["ADDRESS", "ADDRESS_NAME", "LABEL", "FriendlyName"]
+    label_df["Name"] = get_program_names(label_df.reindex(columns=name_cols), address_col="ADDRESS")
+    sources = json.dumps({x: get_file_signature(x) for x in get_label_sources(prefix, use_manual, sfm_only)})
+    table = pa.Table.from_pandas(label_df.reset_index(drop=True), preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, b"label_sources": sources.encode()})
+    output_file = get_label_index_file(prefix, use_manual, sfm_only)
+    tmp = output_file.with_suffix(".tmp")
+    pq.write_table(table, tmp)
+    os.replace(tmp, output_file)
+    logging.info(f"#@# Built label index {output_file} ({len(label_df)} addresses)")
+    return output_file
+
+
+_label_indexes = {}
+
+
+def load_label_index(prefix="program", use_manual=True, sfm_only=False):
+    """Label index of `prefix`, indexed on ADDRESS, rebuilt when any of its sources changed."""
+    sources = {x: get_file_signature(x) for x in get_label_sources(prefix, use_manual, sfm_only)}
+    index_file = get_label_index_file(prefix, use_manual, sfm_only)
+    key = (str(index_file), json.dumps(sources))
+    if key in _label_indexes:
+        return _label_indexes[key]
+    built = None
+    if index_file.exists():
+        metadata = pq.read_schema(index_file).metadata or {}
+        built = json.loads(metadata.get(b"label_sources", b"null"))
+    if built != sources:
+        build_label_index(prefix, use_manual, sfm_only)
+    label_index = pd.read_parquet(index_file).set_index("ADDRESS")
+    _label_indexes[key] = label_index
+    return label_index
+
+
 def add_program_labels(
     df,
     left_on="PROGRAM_ID",
@@ -306,9 +681,33 @@ def add_program_labels(
     prefix="program",
     use_manual=True,
     sfm_only=False,
+    add_name=False,
 ):
-    label_df = load_program_label_df(prefix, use_manual, sfm_only)
-    df = df.merge(label_df, left_on=left_on, right_on=right_on, how="left").drop(axis=1, columns=drop)
+    """Add the label columns of `df[left_on]`, from a single hash lookup in the label index.
+
+    With `add_name`, also adds the display `Name` (the address itself when it has no label).
+    """
+    label_index = load_label_index(prefix, use_manual, sfm_only)
+    keys = df[left_on]
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        # look up each category once, then take by code (-1 for missing values stays -1)
+        positions = np.append(label_index.index.get_indexer(keys.cat.categories), -1)[keys.cat.codes]
+    else:
+        positions = label_index.index.get_indexer(keys.astype(object))
+    matched = positions >= 0
+    columns = [right_on, *label_index.columns]
+    if not add_name:
+        columns.remove("Name")
+    columns = [x for x in columns if x not in df.columns and x not in drop]
+    labels = {}
+    for col in columns:
+        # the index ends with an all-missing row, so unmatched positions (-1) take missing values
+        values = label_index.index if col == right_on else label_index[col]
+        labels[col] = np.append(np.asarray(values, dtype=object), np.nan)[positions]
+    if "Name" in labels:
+        labels["Name"] = np.where(matched, labels["Name"], np.asarray(keys, dtype=object))
+    df = df.drop(columns=[x for x in drop if x in df.columns])
+    df = pd.concat([df, pd.DataFrame(labels, index=df.index)], axis=1)
     if rename_solana_label:
         df.loc[df.PROGRAM_ID == "ComputeBudget111111111111111111111111111111", "LABEL"] = "solana"
     return df
@@ -337,24 +736,42 @@ def apply_program_name(
             return address_name
 
 
-@st.cache_data(ttl=3600)
-def get_program_chart_data(
+def get_program_names(
     df,
-    metric,
-    agg_method,
-    date_range,
-    exclude_solana,
-    exclude_oracle,
-    programs,
+    address_col="PROGRAM_ID",
+    address_name_col="ADDRESS_NAME",
+    label_col="LABEL",
+    friendly_name_col="FriendlyName",
 ):
+    """Column-wise `apply_program_name`, for every row of `df` at once."""
+
+    def get_col(col):
+        return pd.Series(np.asarray(df[col], dtype=object), index=df.index)
+
+    def title(x):
+        # title-case each distinct value once
+        codes, uniques = pd.factorize(x)
+        titled = np.append(pd.Series(uniques, dtype=object).str.title().to_numpy(dtype=object), np.nan)
+        return pd.Series(titled[codes], index=x.index)
+
+    address = get_col(address_col)
+    address_name = get_col(address_name_col)
+    friendly_name = get_col(friendly_name_col)
+    # NaN unless both are strings, as `str.title` raises for anything else
+    labeled_name = title(get_col(label_col)) + "- " + title(address_name)
+    names = address_name.where(labeled_name.isna(), labeled_name)
+    names = names.where(address_name.notna(), friendly_name.where(friendly_name.notna(), address))
+    return names
+
+
+def filter_program_data(df, date_range, exclude_solana, exclude_oracle, today=None):
+    today = pd.to_datetime(datetime.datetime.today() if today is None else today, utc=True)
     if date_range == "All dates":
         chart_df = df.copy()
     elif date_range == "Year to Date":
-        chart_df = df.copy()[df.Date >= "2022-01-01"]
+        chart_df = df[df.Date >= "2022-01-01"]
     else:
-        chart_df = df.copy()[
-            df.Date >= (pd.to_datetime(datetime.datetime.today(), utc=True) - pd.Timedelta(date_range))
-        ]
+        chart_df = df[df.Date >= (today - pd.Timedelta(date_range))]
 
     if exclude_solana:
         chart_df = chart_df[chart_df.LABEL != "solana"]
@@ -362,14 +779,40 @@ def get_program_chart_data(
         chart_df = chart_df[~chart_df.LABEL.isin(["pyth", "switchboard"])]
         chart_df = chart_df[~chart_df.FriendlyName.isin(["SwitchBoard V2 Program", "Chainlink Program"])]
         chart_df = chart_df[~chart_df.LABEL_SUBTYPE.isin(["oracle"])]
+    return chart_df
+
+
+def get_top_programs(df, metric, agg_method, n):
+    return (
+        df.groupby("PROGRAM_ID", observed=True)
+        .agg({metric: agg_method})
+        .sort_values(by=metric, ascending=False)
+        .iloc[:n]
+        .index
+    )
+
+
+def add_program_chart_columns(chart_df):
+    chart_df["Name"] = get_program_names(chart_df)
+    chart_df["Explorer Site"] = chart_df.PROGRAM_ID.apply(lambda x: f"https://solana.fm/address/{x}")
+    # catch any `:` in Name values, which break altair
+    chart_df["Name"] = chart_df["Name"].apply(lambda x: x.replace(":", "-"))
+    return chart_df
+
+
+@st.cache_data(ttl=3600, hash_funcs=DATASET_HASH_FUNCS)
+def get_program_chart_data(
+    data: Dataset,
+    metric,
+    agg_method,
+    date_range,
+    exclude_solana,
+    exclude_oracle,
+    programs,
+):
+    chart_df = filter_program_data(data.df, date_range, exclude_solana, exclude_oracle)
     if type(programs) == int:
-        program_ids = (
-            chart_df.groupby("PROGRAM_ID")
-            .agg({metric: agg_method})
-            .sort_values(by=metric, ascending=False)
-            .iloc[:programs]
-            .index
-        )
+        program_ids = get_top_programs(chart_df, metric, agg_method, programs)
     else:
         program_ids = programs
     chart_df = (
@@ -377,31 +820,116 @@ def get_program_chart_data(
         .sort_values(by=["Date", metric], ascending=False)
         .reset_index(drop=True)
     )
-    chart_df["Name"] = chart_df.apply(
-        apply_program_name,
-        axis=1,
+    return add_program_chart_columns(chart_df)
+
+
+def build_program_rankings(df, today=None):
+    """Top programs for every Program Activity date range, exclusion, metric and aggregation method.
+
+    Returns the rankings (the top `PROGRAM_RANKING_MAX_N` programs of each combination, in order)
+    and the chart rows of every ranked program within the longest date range, with their names.
+    """
+    today = pd.to_datetime(datetime.datetime.today() if today is None else today, utc=True)
+    window = today - max(pd.Timedelta(x) for x in PROGRAM_DATE_RANGES)
+    df = df[df.Date >= window]
+    rankings = []
+    for date_range in PROGRAM_DATE_RANGES:
+        for exclude_solana in [True, False]:
+            for exclude_oracle in [True, False]:
+                chart_df = filter_program_data(df, date_range, exclude_solana, exclude_oracle, today)
+                for metric in ["TX_COUNT", "SIGNERS"]:
+                    for agg_method in agg_method_dict:
+                        program_ids = get_top_programs(chart_df, metric, agg_method, PROGRAM_RANKING_MAX_N)
+                        rankings.append(
+                            pd.DataFrame(
+                                {
+                                    "date_range": date_range,
+                                    "exclude_solana": exclude_solana,
+                                    "exclude_oracle": exclude_oracle,
+                                    "metric": metric,
+                                    "agg_method": agg_method,
+                                    "rank": np.arange(len(program_ids)),
+                                    "PROGRAM_ID": np.asarray(program_ids, dtype=object),
+                                }
+                            )
+                        )
+    rankings = pd.concat(rankings, ignore_index=True)
+    top_df = df[df.PROGRAM_ID.isin(rankings.PROGRAM_ID)].reset_index(drop=True)
+    return rankings, add_program_chart_columns(top_df)
+
+
+def get_program_ranking_files(labeled_file):
+    prefix = str(labeled_file).split(".")[0]
+    return f"{prefix}_rankings.parquet", f"{prefix}_top_programs.parquet"
+
+
+def write_program_rankings(df, labeled_file, today=None):
+    """Materialize the top program rankings of `df` (the contents of `labeled_file`) next to it."""
+    today = pd.to_datetime(datetime.datetime.today() if today is None else today, utc=True)
+    rankings, top_df = build_program_rankings(df, today)
+    rankings_file, top_file = get_program_ranking_files(labeled_file)
+    table = pa.Table.from_pandas(rankings, preserve_index=False)
+    # the date ranges are relative to when the rankings were built
+    table = table.replace_schema_metadata({**table.schema.metadata, b"today": today.isoformat().encode()})
+    # written aside and swapped in, as the app may be reading the previous rankings
+    pq.write_table(table, f"{rankings_file}.tmp")
+    top_df.to_parquet(f"{top_file}.tmp", index=False)
+    os.replace(f"{top_file}.tmp", top_file)
+    os.replace(f"{rankings_file}.tmp", rankings_file)
+    logging.info(f"#@# Wrote {len(rankings)} program rankings and {len(top_df)} chart rows for {labeled_file}")
+
+
+def get_labeled_program_file(new_users_only=False, user_type=None):
+    if user_type == "Signers":
+        if new_users_only:
+            return "data/programs_new_users_all_signers_labeled.csv.gz"
+        return "data/programs_all_signers_labeled.csv.gz"
+    if new_users_only:
+        return "data/programs_new_users_labeled.csv.gz"
+    return "data/programs_labeled.csv.gz"
+
+
+@cache_dataset(ttl=600)
+def load_program_rankings(labeled_file):
+    rankings_file, top_file = get_program_ranking_files(labeled_file)
+    table = pq.read_table(rankings_file)
+    today = pd.Timestamp(table.schema.metadata[b"today"].decode())
+    rankings = (
+        table.to_pandas()
+        .set_index(["date_range", "exclude_solana", "exclude_oracle", "metric", "agg_method", "rank"])
+        .sort_index()
     )
-    chart_df["Explorer Site"] = chart_df.PROGRAM_ID.apply(lambda x: f"https://solana.fm/address/{x}")
-    # catch any `:` in Name values, which break altair
-    chart_df["Name"] = chart_df["Name"].apply(lambda x: x.replace(":", "-"))
-    return chart_df
+    return rankings, pd.read_parquet(top_file), today
 
 
-@st.cache_data(ttl=600)
+def get_ranked_program_chart_data(
+    metric, agg_method, date_range, exclude_solana, exclude_oracle, n, new_users_only=False, user_type=None
+):
+    """`get_program_chart_data` for the top `n` programs, sliced from the rankings written by the combine step.
+
+    Returns None when there are no rankings for this combination, to fall back to computing them.
+    """
+    labeled_file = get_labeled_program_file(new_users_only, user_type)
+    if date_range not in PROGRAM_DATE_RANGES or n > PROGRAM_RANKING_MAX_N:
+        return None
+    if not all(Path(x).exists() for x in get_program_ranking_files(labeled_file)):
+        return None
+    rankings, top_df, today = load_program_rankings(labeled_file)
+    program_ids = rankings.loc[
+        (date_range, exclude_solana, exclude_oracle, metric, agg_method), "PROGRAM_ID"
+    ].iloc[:n]
+    chart_df = top_df[(top_df.Date >= today - pd.Timedelta(date_range)) & top_df.PROGRAM_ID.isin(program_ids)]
+    return chart_df.sort_values(by=["Date", metric], ascending=False).reset_index(drop=True)
+
+
+@cache_dataset(ttl=600)
 def load_labeled_program_data(new_users_only=False, user_type=None):
-    if user_type == "Signers":
-        if new_users_only:
-            return pd.read_csv("data/programs_new_users_all_signers_labeled.csv.gz")
-        else:
-            return pd.read_csv("data/programs_all_signers_labeled.csv.gz")
-    else:
-        if new_users_only:
-            return pd.read_csv("data/programs_new_users_labeled.csv.gz")
-        else:
-            return pd.read_csv("data/programs_labeled.csv.gz")
+    df = pd.read_csv(get_labeled_program_file(new_users_only, user_type))
+    df["Date"] = pd.to_datetime(df["Date"], utc=True)
+    return encode_address_columns(df, ["PROGRAM_ID"])
 
 
-@st.cache_data(ttl=60)
+@cache_dataset(ttl=60)
 def load_weekly_program_data():
     df = pd.read_csv("data/weekly_program.csv")
     datecols = ["WEEK"]
@@ -409,7 +937,7 @@ def load_weekly_program_data():
     return df
 
 
-@st.cache_data(ttl=60)
+@cache_dataset(ttl=60)
 def load_weekly_new_program_data():
     df = pd.read_csv("data/weekly_new_program.csv")
     df = df.sort_values(by="WEEK")
@@ -420,7 +948,7 @@ def load_weekly_new_program_data():
     return df
 
 
-@st.cache_data(ttl=60)
+@cache_dataset(ttl=60)
 def load_weekly_user_data(user_type="Fee Payers"):
     if user_type != "Fee Payers":
         df = pd.read_csv("data/weekly_users_all_signers.csv")
@@ -431,7 +959,7 @@ def load_weekly_user_data(user_type="Fee Payers"):
     return df
 
 
-@st.cache_data(ttl=60)
+@cache_dataset(ttl=60)
 def load_weekly_new_user_data(user_type="Fee Payers"):
     if user_type != "Fee Payers":
         df = pd.read_csv("data/weekly_new_users_all_signers.csv")
@@ -448,9 +976,7 @@ def load_weekly_new_user_data(user_type="Fee Payers"):
 @st.cache_data(ttl=1800)
 def load_nft_data():
     main_data = (
-        pd.read_json(
-            f"{api_base}/2b945162-59a9-4ccc-95ee-fca67ac142c4/data/latest", storage_options=storage_options
-        )
+        read_api_json(f"{api_base}/2b945162-59a9-4ccc-95ee-fca67ac142c4/data/latest")
         .rename(
             columns={
                 "WEEK": "Date",
@@ -486,27 +1012,23 @@ def load_nft_data():
         ]
     )
     mints_by_purchaser = (
-        pd.read_json(
-            f"{api_base}/04be6d7d-b5cd-4c11-9f73-68288e1353d4/data/latest", storage_options=storage_options
-        )
+        read_api_json(f"{api_base}/04be6d7d-b5cd-4c11-9f73-68288e1353d4/data/latest")
         .rename(columns={"DATE": "Date", "AVERAGE_MINTS": "Average Mints per Address"})
         .sort_values(by="Date", ascending=False)
         .reset_index(drop=True)
     )
     mints_by_purchaser["Date"] = pd.to_datetime(mints_by_purchaser["Date"], utc=True)
     mints_by_chain = (
-        pd.read_json(
-            f"{api_base}/88cfaf1c-e485-4926-817f-61ed261d9cfb/data/latest", storage_options=storage_options
-        )
+        read_api_json(f"{api_base}/88cfaf1c-e485-4926-817f-61ed261d9cfb/data/latest")
         .rename(columns={"DATE": "Date", "CHAIN": "Chain", "MINTS": "Count", "MINTERS": "Unique Users"})
         .sort_values(by="Date", ascending=False)
         .reset_index(drop=True)
     )
     mints_by_chain["Type"] = "Mints"
     mints_by_chain["Date"] = pd.to_datetime(mints_by_chain["Date"], utc=True)
-    sales_by_chain = pd.read_json(
-        f"{api_base}/7daf5636-2364-4281-b1cb-2d44ae1bcffd/data/latest", storage_options=storage_options
-    ).rename(columns={"DATE": "Date", "CHAIN": "Chain", "SALES": "Count", "BUYERS": "Unique Users"})
+    sales_by_chain = read_api_json(f"{api_base}/7daf5636-2364-4281-b1cb-2d44ae1bcffd/data/latest").rename(
+        columns={"DATE": "Date", "CHAIN": "Chain", "SALES": "Count", "BUYERS": "Unique Users"}
+    )
     sales_by_chain["Date"] = pd.to_datetime(sales_by_chain["Date"], utc=True)
     sales_by_chain["Type"] = "Sales"
     by_chain_data = (
@@ -520,7 +1042,7 @@ def load_nft_data():
 @st.cache_data(ttl=1800)
 def load_royalty_data():
     df = (
-        (
+        read_api_json(
             f"{api_base}/ffd713f1-4d05-4f3e-82b8-dc2c87db6691/data/latest"  # fork
             # f"{api_base}/7572e1e3-fbfb-4dd4-9d45-dd6cde7f42df/data/latest"  # original, see https://twitter.com/BlumbergKellen/status/1601245496789463045
         )
@@ -551,15 +1073,13 @@ def load_royalty_data():
 
 @st.cache_data(ttl=1800)
 def load_sol_daily_price():
-    df = pd.read_json(
-        f"{api_base}/398c8e9a-7178-4816-ae4a-74c3181dcafc/data/latest", storage_options=storage_options
-    )
+    df = read_api_json(f"{api_base}/398c8e9a-7178-4816-ae4a-74c3181dcafc/data/latest")
     df["Date"] = pd.to_datetime(df["Date"], utc=True)
     df = df.sort_values(by="Date")
     return df
 
 
-@st.cache_data(ttl=1800)
+@cache_dataset(ttl=1800)
 def load_top_nft_info():
     df = (
         pd.read_csv("data/top_nft_sales_metadata_with_royalties.csv.gz")
@@ -651,15 +1171,16 @@ def load_weekly_days_active_data():
 # #---
 
 
-def get_program_ids(df):
+def get_program_ids(df, n=30):
+    """Union of the top `n` programs for each metric and aggregation method."""
     prog_list = []
     for agg_method in ["mean", "sum", "max"]:
         for metric in ["TX_COUNT", "SIGNERS"]:
             program_ids = (
-                df.groupby("PROGRAM_ID")
+                df.groupby("PROGRAM_ID", observed=True)
                 .agg({metric: agg_method})
                 .sort_values(by=metric, ascending=False)
-                .iloc[:30]
+                .iloc[:n]
                 .index
             )
             prog_list.extend(program_ids.to_list())
@@ -679,64 +1200,91 @@ def reformat_columns(df: pd.DataFrame, datecols: Union[list, None]) -> pd.DataFr
     return df
 
 
-@st.cache_data(ttl=3600)
-def load_flipside_api_data(url: str, datecols: Union[list, None]) -> pd.DataFrame:
-    df = pd.read_json(url, storage_options=storage_options)
+def fetch_flipside_api_data(url: str, datecols: Union[tuple, None]) -> pd.DataFrame:
+    df = read_api_json(url)
     try:
-        df = reformat_columns(df, datecols)
+        # NOTE: uncached, this runs in the fetcher's threads and the result is cached there
+        df = reformat_columns.__wrapped__(df, None if datecols is None else list(datecols))
     except KeyError:
         pass
     return df
 
 
-@st.cache_data(ttl=3600 * 6)
-def run_query_and_cache(name, sql, param, force_update=False):
-    today = datetime.date.today()
-    cache_dir = Path("data/cache")
-    cache_dir.mkdir(parents=True, exist_ok=True)
-    file_path = cache_dir / f"{today}_{name}_{param}.csv"
-    if file_path.exists() and not force_update:
-        return pd.read_csv(file_path)
-    else:
-        query = sql.format(param=param)
-        query_result_set = sdk.query(
-            query,
-            ttl_minutes=120,
-            timeout_minutes=30,
-            retry_interval_seconds=1,
-            page_size=1000000,
-            page_number=1,
-            cached=False,
-        )
-        df = pd.DataFrame(query_result_set.rows, columns=query_result_set.columns)
-        df.to_csv(
-            file_path,
-            index=False,
-        )
-        return df
+@st.cache_resource
+def get_flipside_api_fetcher():
+    return DatasetFetcher(fetch_flipside_api_data, ttl=FLIPSIDE_API_TTL)
+
+
+def load_flipside_api_datasets(query_dict: Dict[str, dict]) -> Dict[str, pd.DataFrame]:
+    """Load the `api` results of every query in `query_dict` at once, see `DatasetFetcher`."""
+    return get_flipside_api_fetcher().get_many(
+        {
+            k: (v["api"], None if v["datecols"] is None else tuple(v["datecols"]))
+            for k, v in query_dict.items()
+        }
+    )
+
+
+def load_flipside_api_data(url: str, datecols: Union[list, None]) -> pd.DataFrame:
+    return load_flipside_api_datasets({url: {"api": url, "datecols": datecols}})[url]
+
+
+@st.cache_resource
+def get_query_job_manager():
+    cache = QueryResultCache("data/cache", max_bytes=QUERY_CACHE_MAX_BYTES, policies=QUERY_CACHE_POLICIES)
+    return QueryJobManager(stream_query_to_csv, cache)
+
+
+def submit_query_job(name, sql, param, force_update=False) -> QueryJob:
+    """Start (or join) the background query for `sql.format(param=param)`, cached in data/cache."""
+    return get_query_job_manager().submit(name, sql, param, force_update)
+
+
+def wait_for_query_jobs(jobs: List[QueryJob], message: str, poll_seconds: float = 2) -> List[pd.DataFrame]:
+    """Results of `jobs` once all have finished; until then, show their progress and rerun the page."""
+    failed = [x for x in jobs if x.state == "failed"]
+    if failed:
+        st.error(f"{message} failed: {failed[0].error}")
+        st.stop()
+    if all(x.done for x in jobs):
+        try:
+            return [x.result() for x in jobs]
+        except FileNotFoundError as e:
+            # evicted by another session's result in the meantime, which is a cache miss: submitting
+            # the query again on the rerun starts a new job
+            logging.info(f"#@# {e}, querying it again")
+            st.rerun()
+    pages = [x.pages for x in jobs]
+    done = sum(x.done for x in jobs)
+    st.text(
+        f"{message} ({done}/{len(jobs)} queries done, {max(x.elapsed for x in jobs):.0f}s)"
+        + "".join(f", page {n}/{total}" for n, total in pages if total and total > 1)
+    )
+    # #TODO: st.fragment would avoid rerunning the whole page while polling
+    time.sleep(poll_seconds)
+    st.rerun()
 
 
 def get_short_address(address: str) -> str:
     return address[:6] + "..." + address[-6:]
 
 
+@st.cache_resource
+def get_nft_metadata_store():
+    return NFTMetadataStore("data/nft_metadata.db")
+
+
 @st.cache_data(ttl=3600)
 def get_nft_mint_data(splits):
-    nft_api = NFTAPI(helius_key)
-    mint_data = []
-    for x in splits:
-        mints = nft_api.get_nft_metadata(list(x))
-        mint_data.extend(mints)
+    mints = [x for split in splits for x in split]
+    # mints resolved before (by any session, or the combine step) are read from the shared store
+    client = HeliusMetadataClient(helius_key, get_nft_metadata_store())
+    metadata = client.get_metadata(mints).set_index("mint")
     # HACK: just using names for now to get collection id
-    names = []
-    for x in mint_data:
-        try:
-            names.append(x["onChainData"]["data"]["name"])
-        # #HACK: some bad data mint address data
-        except TypeError:
-            names.append("Unknown")
+    # #HACK: some bad data mint address data
+    names = metadata.name.reindex(mints).fillna("Unknown")
     collections = [x.split("-")[0].split("#")[0].strip() for x in names]
-    collection_df = pd.DataFrame({"Mint": [x["mint"] for x in mint_data], "NFT Name": collections})
+    collection_df = pd.DataFrame({"Mint": mints, "NFT Name": collections})
     return collection_df
 
 
@@ -887,7 +1435,7 @@ def add_uri_info(xnft_info: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
-@st.cache_data(ttl=60)
+@cache_dataset(ttl=60)
 def load_xnft_data():
     df = pd.read_csv("data/xnft_create_install_all_info.csv")
     datecols = ["BLOCK_TIMESTAMP", "created_datetime", "updated_datetime"]
@@ -897,8 +1445,9 @@ def load_xnft_data():
 
 # def grouping_with_other(x):
 #     if
-@st.cache_data(ttl=3600)
-def aggregate_xnft_data(df, n=15):
+@st.cache_data(ttl=3600, hash_funcs=DATASET_HASH_FUNCS)
+def aggregate_xnft_data(data: Dataset, n=15):
+    df = data.df.copy(deep=False)
     total_counts = (
         df.groupby(["Xnft", "Mint Seed Name"])["Tx Id"]
         .count()
@@ -1038,7 +1587,7 @@ def get_mad_lad_df(mad_lad_mintlist):
     return df
 
 
-@st.cache_data(ttl=3600)
+@cache_dataset(ttl=3600)
 def load_mad_lad_data():
     df = pd.read_csv("data/mad_lad_all.csv")
     datecols = ["BLOCK_TIMESTAMP"]
@@ -1046,7 +1595,7 @@ def load_mad_lad_data():
     return df
 
 
-@st.cache_data(ttl=3600)
+@cache_dataset(ttl=3600)
 def load_xnft_new_users():
     df = pd.read_csv("data/xnft_new_users.csv")
     datecols = ["FIRST_TX_DATE"]
@@ -1054,7 +1603,7 @@ def load_xnft_new_users():
     return df
 
 
-@st.cache_data(ttl=3600)
+@cache_dataset(ttl=3600)
 def load_defi_data():
     dex_info = pd.read_csv("data/dex_info.csv")
     datecols = ["DATE"]
@@ -1071,8 +1620,9 @@ def load_defi_data():
     return dex_info, dex_new_user, dex_signers_fee_payers
 
 
-@st.cache_data(ttl=3600)
-def agg_defi_data(df, date_range):
+@st.cache_data(ttl=3600, hash_funcs=DATASET_HASH_FUNCS)
+def agg_defi_data(data: Dataset, date_range):
+    df = data.df
     chart_df = df.copy()[
         df["Date"]
         >= (pd.to_datetime(datetime.datetime.today(), utc=True) - pd.Timedelta(f"{int(date_range[:-1])}d"))
@@ -1108,8 +1658,9 @@ def agg_defi_data(df, date_range):
     return tx_data, user_data
 
 
-@st.cache_data(ttl=3600)
-def agg_defi_signers_data(df, date_range, protocol):
+@st.cache_data(ttl=3600, hash_funcs=DATASET_HASH_FUNCS)
+def agg_defi_signers_data(data: Dataset, date_range, protocol):
+    df = data.df
     chart_df = df.copy()[
         (
             df["Date"]
@@ -1123,8 +1674,9 @@ def agg_defi_signers_data(df, date_range, protocol):
     return chart_df
 
 
-@st.cache_data(ttl=3600)
-def agg_new_defi_users_data(df, date_range, protocol):
+@st.cache_data(ttl=3600, hash_funcs=DATASET_HASH_FUNCS)
+def agg_new_defi_users_data(data: Dataset, date_range, protocol):
+    df = data.df
     chart_df = df.copy()[
         (
             df["First Tx Date"]
@@ -1145,7 +1697,7 @@ def add_rarity_data(df, rarity_df="data/madlads_rarity.csv", on="Mint", how="inn
     return merged
 
 
-@st.cache_data(ttl=7200)
+@cache_dataset(ttl=7200)
 def load_staker_data():
     df = pd.read_csv("data/staking_combined.csv.gz", low_memory=False)
     df = reformat_columns(df, ["DATE"])
@@ -1154,18 +1706,19 @@ def load_staker_data():
         .sort_values(by=["Date", "Total Stake"], ascending=False)
         .reset_index(drop=True)
     )
-    return df
+    return encode_address_columns(df, ["Address"])
 
 
-@st.cache_data(ttl=3600)
-def filter_staker_data(df, min_stake_value):
-    included_addresses = df.groupby(["Address"])["Total Stake"].max().reset_index()
+@st.cache_data(ttl=3600, hash_funcs=DATASET_HASH_FUNCS)
+def filter_staker_data(data: Dataset, min_stake_value) -> Dataset:
+    df = data.df
+    included_addresses = df.groupby(["Address"], observed=True)["Total Stake"].max().reset_index()
     included_addresses = included_addresses[included_addresses["Total Stake"] >= min_stake_value]
     df = df[df["Address"].isin(included_addresses["Address"])].reset_index(drop=True)
-    return df
+    return data.derive(df, min_stake_value)
 
 
-@st.cache_data(ttl=3600)
+@cache_dataset(ttl=3600)
 def load_staker_interaction_data():
     df = pd.read_csv("data/top_staker_interactions.csv", low_memory=False)
     df = reformat_columns(df, ["Date"])
@@ -1174,13 +1727,14 @@ def load_staker_interaction_data():
         .sort_values(by=["Date", "Address"], ascending=False)
         .reset_index(drop=True)
     )
-    return df
+    return encode_address_columns(df, ["Address"])
 
 
-@st.cache_data(ttl=3600 * 12)
+@st.cache_data(ttl=3600 * 12, hash_funcs=DATASET_HASH_FUNCS)
 def get_stakers_chart_data(
-    df, date_range, exclude_foundation, exclude_labeled, n_addresses, token, keep_others=False
+    data: Dataset, date_range, exclude_foundation, exclude_labeled, n_addresses, token, keep_others=False
 ):
+    df = data.df
     min_stake_date = df[df["Total Stake"].notna()].Date.min()
     if date_range == "All dates":
         chart_df = df.copy()[df.Date >= min_stake_date]
@@ -1224,6 +1778,7 @@ def get_stakers_chart_data(
                 chart_df.groupby(
                     ["Date", "Name", "Address", "Explorer Url", "Token", "Token Name", "Symbol"],
                     dropna=False,
+                    observed=True,
                 )
                 .agg(
                     {
@@ -1277,6 +1832,7 @@ def get_stakers_chart_data(
                 staker_chart_df.groupby(
                     ["Date", "Name", "Address", "Explorer Url"],
                     dropna=False,
+                    observed=True,
                 )
                 .agg({"Total Stake": "sum", "Rank": "mean"})
                 .reset_index()
@@ -1305,6 +1861,7 @@ def get_stakers_chart_data(
                 token_top_holders_df.groupby(
                     ["Date", "Name", "Address", "Explorer Url", "Token", "Token Name", "Symbol"],
                     dropna=False,
+                    observed=True,
                 )
                 .agg(
                     {
@@ -1345,7 +1902,52 @@ def get_stakers_chart_data(
     return staker_chart_df, token_top_stakers_df, token_top_holders_df
 
 
-@st.cache_data(ttl=3600 * 24)
+def build_asof_panel(df, keys, date_col="DATE", end_date=None, since=None, freq="D"):
+    """Dense panel with a row per `keys` per date, holding the latest row of `df` on or before that date.
+
+    Each key's rows run from its first date to `end_date` (or its own last date), one row per
+    `freq`. Rows are repeated with `np.repeat` over the sorted deltas rather than resampled per
+    group, so this is linear in the output size. With `since`, only dates from `since` on are
+    emitted, e.g. to rebuild the dates after a changed partition.
+    """
+    step = pd.Timedelta(pd.tseries.frequencies.to_offset(freq))
+    df = df.dropna(subset=keys)
+    if end_date is not None:
+        df = df[df[date_col] <= end_date]
+    df = (
+        df.sort_values(by=[*keys, date_col], kind="stable")
+        .drop_duplicates(subset=[*keys, date_col], keep="last")
+        .reset_index(drop=True)
+    )
+    if df.empty:
+        # e.g. no holders within the date range
+        return df
+    tz = df[date_col].dt.tz
+    dates = df[date_col].values
+    codes = df.groupby(keys, sort=False).ngroup().to_numpy()
+    last_in_group = np.append(codes[1:] != codes[:-1], True)
+    next_dates = np.append(dates[1:], dates[-1:])
+    if end_date is None:
+        next_dates[last_in_group] = dates[last_in_group] + step.to_timedelta64()
+    else:
+        end = pd.Timestamp(end_date).tz_convert(None) if tz is not None else pd.Timestamp(end_date)
+        next_dates[last_in_group] = (end + step).to_datetime64()
+    spans = (next_dates - dates) // step.to_timedelta64()
+    offsets = np.zeros(len(df), dtype=np.int64)
+    if since is not None:
+        since = pd.Timestamp(since).tz_convert(None) if tz is not None else pd.Timestamp(since)
+        offsets = np.maximum(-((dates - since.to_datetime64()) // step.to_timedelta64()), 0)
+    spans = np.maximum(spans - offsets, 0)
+
+    rows = np.repeat(np.arange(len(df)), spans)
+    steps = np.arange(len(rows)) - np.repeat(np.cumsum(spans) - spans, spans) + offsets[rows]
+    panel = df.take(rows).reset_index(drop=True)
+    panel_dates = pd.Series(dates[rows] + steps * step.to_timedelta64())
+    panel[date_col] = panel_dates.dt.tz_localize(tz) if tz is not None else panel_dates
+    return panel
+
+
+@cache_dataset(ttl=3600 * 24)
 def load_lst(filled=True):
     if filled:
         df = pd.read_csv("data/liquid_staking_token_holders.csv.gz")
@@ -1353,7 +1955,7 @@ def load_lst(filled=True):
         df = pd.read_csv("data/liquid_staking_token_holders_delta.csv")
     df = reformat_columns(df, ["DATE"])
     df = df.sort_values(by=["Address", "Token", "Date"])
-    return df
+    return encode_address_columns(df, ["Address"])
 
 
 @st.cache_data(ttl=3600 * 2)
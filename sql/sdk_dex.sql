@@ -53,7 +53,7 @@ SELECT
 FROM
     solana.core.fact_events
 WHERE
-    date = {{ date }}
+    date {% if date2 %}BETWEEN {{ date }} AND {{ date2 }}{% else %}= {{ date }}{% endif %}
     and program_id in (
         --Mango Markets
         'mv3ekLzLbnVPNxjSKvqBpU3ZeZXPQdEC3bp5MDEBG68',
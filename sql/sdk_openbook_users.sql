@@ -53,7 +53,7 @@ from
     solana.core.fact_events,
     lateral flatten(signers) as s
 where
-    date = {{ date }}
+    date {% if date2 %}BETWEEN {{ date }} AND {{ date2 }}{% else %}= {{ date }}{% endif %}
     and program_id in (
         --Mango Markets
         'mv3ekLzLbnVPNxjSKvqBpU3ZeZXPQdEC3bp5MDEBG68',
@@ -161,7 +161,7 @@ select
 from
     solana.core.fact_events
 where
-    date = {{ date }}
+    date {% if date2 %}BETWEEN {{ date }} AND {{ date2 }}{% else %}= {{ date }}{% endif %}
         and program_id in (
         --Mango Markets
         'mv3ekLzLbnVPNxjSKvqBpU3ZeZXPQdEC3bp5MDEBG68',
@@ -16,7 +16,7 @@ FROM
     ),
     lateral flatten(t.signers) as s
 WHERE
-    e.block_timestamp :: DATE = {{ date }}
+    e.block_timestamp :: DATE {% if date2 %}BETWEEN {{ date }} AND {{ date2 }}{% else %}= {{ date }}{% endif %}
 GROUP BY
     program_id,
     "Date"
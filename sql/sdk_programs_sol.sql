@@ -15,7 +15,7 @@ FROM
         AND e.block_timestamp :: DATE = t.block_timestamp :: DATE
     )
 WHERE
-    e.block_timestamp :: DATE = {{ date }}
+    e.block_timestamp :: DATE {% if date2 %}BETWEEN {{ date }} AND {{ date2 }}{% else %}= {{ date }}{% endif %}
 GROUP BY
     program_id,
     "Date"
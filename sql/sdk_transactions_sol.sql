@@ -52,7 +52,7 @@ WITH consumption_tx AS (
             input => t.log_messages
         ) s
     WHERE
-        block_timestamp :: DATE = {{ date }}
+        block_timestamp :: DATE {% if date2 %}BETWEEN {{ date }} AND {{ date2 }}{% else %}= {{ date }}{% endif %}
         AND s.value LIKE '% consumed %'
     GROUP BY
         t.block_timestamp,
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+
+from spire_fyi.utils import build_asof_panel
+
+KEYS = ["ADDRESS", "TOKEN"]
+
+
+def make_delta_df(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2023-01-01", "2023-03-31", freq="D", tz="UTC")
+    return pd.DataFrame(
+        {
+            "ADDRESS": rng.choice([f"wallet{i}" for i in range(20)], n),
+            "TOKEN": rng.choice(["mSOL", "stSOL", "jitoSOL"], n),
+            "DATE": rng.choice(dates, n),
+            "AMOUNT": rng.random(n),
+        }
+    )
+
+
+def get_expected(df, end_date):
+    # the per-group resample this replaced
+    df = df[df.DATE <= end_date]
+    last = df.sort_values(by="DATE").groupby(KEYS).tail(1).copy()
+    last["DATE"] = end_date
+    df = pd.concat([df, last])
+    df = df[~df[[*KEYS, "DATE"]].duplicated(keep="last")]
+    df = df.set_index("DATE").groupby(KEYS).resample("D").ffill().droplevel(KEYS).reset_index()
+    return df.sort_values(by=[*KEYS, "DATE"]).reset_index(drop=True)[["ADDRESS", "TOKEN", "DATE", "AMOUNT"]]
+
+
+def test_asof_panel_matches_resample():
+    df = make_delta_df()
+    end_date = pd.Timestamp("2023-03-15", tz="UTC")
+    panel = build_asof_panel(df, KEYS, end_date=end_date)
+    pd.testing.assert_frame_equal(panel[["ADDRESS", "TOKEN", "DATE", "AMOUNT"]], get_expected(df, end_date))
+
+
+def test_asof_panel_since():
+    df = make_delta_df(seed=1)
+    end_date = pd.Timestamp("2023-03-31", tz="UTC")
+    panel = build_asof_panel(df, KEYS, end_date=end_date)
+    since = pd.Timestamp("2023-03-01", tz="UTC")
+    recent = build_asof_panel(df, KEYS, end_date=end_date, since=since)
+    expected = panel[panel.DATE >= since].reset_index(drop=True)
+    pd.testing.assert_frame_equal(recent, expected)
+
+
+def test_asof_panel_empty():
+    df = make_delta_df().iloc[:0]
+    panel = build_asof_panel(df, KEYS, end_date=pd.Timestamp("2023-03-15", tz="UTC"))
+    assert panel.empty
+    assert list(panel.columns) == list(df.columns)
+    assert panel.DATE.dtype == df.DATE.dtype
+
+
+def test_asof_panel_empty_window():
+    # no rows on or before `end_date`
+    df = make_delta_df()
+    panel = build_asof_panel(df, KEYS, end_date=pd.Timestamp("2022-01-01", tz="UTC"))
+    assert panel.empty
+    assert list(panel.columns) == list(df.columns)
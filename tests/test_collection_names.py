@@ -0,0 +1,146 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from combine_data import get_collection_name, get_collection_names
+
+LABELS_FILE = Path(__file__).parents[1] / "data/labeled_collections_by_uri.csv"
+
+
+def get_expected(df):
+    return df.apply(get_collection_name, axis=1)
+
+
+def assert_same_names(df):
+    expected = get_expected(df)
+    names = get_collection_names(df)
+    pd.testing.assert_series_equal(names, expected, check_dtype=False, check_names=False)
+
+
+def make_metadata_df(rows):
+    return pd.DataFrame(rows, columns=["name", "symbol", "creator_address"])
+
+
+def get_real_collections():
+    labels = pd.read_csv(LABELS_FILE)
+    collections = labels.unique_collection.str.rsplit("-", n=1, expand=True)
+    return pd.DataFrame(
+        {"collection_name": collections[0], "creator_address": collections[1], "Name": labels.Name}
+    )
+
+
+def get_real_rows():
+    """Sale metadata in the shapes seen for the labeled collections, numbered as individual nfts."""
+    rows = []
+    for i, x in enumerate(get_real_collections().itertuples()):
+        name, creator = x.Name, x.creator_address
+        k = i * 37 + 1
+        rows += [
+            (f"{name} #{k}", x.collection_name, creator),
+            (f"{name} #{k}", "", creator),
+            (f"{name} #{k}", "   ", creator),
+            (name, "", creator),
+            (f"#{k}", "", creator),
+            (f"#{k} {name}", "", creator),
+            (f"#{k} {name}!", "", creator),
+            (f"{name}: {k}", "", creator),
+            (f"{name} | {k}", "", creator),
+            (f"{name}-{k}", "", creator),
+            (f"TYR-{name}-{k}", "", creator),
+            (f"{name} {k}", "", creator),
+            (f"  {name} #{k}  ", f" {x.collection_name} ", f" {creator} "),
+        ]
+    return rows
+
+
+def test_real_collection_names():
+    df = make_metadata_df(get_real_rows())
+    assert len(df) > 500
+    assert_same_names(df)
+
+
+@pytest.mark.parametrize(
+    "symbol",
+    ["", " ", "\t", "  SYM  "],
+)
+def test_empty_and_whitespace_symbols(symbol):
+    df = make_metadata_df(
+        [
+            ("Okay Bear #123", symbol, "creator1"),
+            ("Lotus Lad", symbol, "creator2"),
+            ("Claynosaurz 42", symbol, "creator3"),
+        ]
+    )
+    assert_same_names(df)
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "Okay Bear #123",
+        "Okay Bear #",
+        "Okay Bear # 12",
+        "Okay Bear #12a",
+        "#123",
+        "# 123",
+        "#123 Okay Bear",
+        "#123 Okay Bear! v2",
+        "#abc Okay Bear",
+        "#Okay Bear",
+        "#1#2",
+        "A#B#C",
+        "Okay#Bear#1",
+        "Okay Bear#1",
+    ],
+)
+def test_hash_names(name):
+    df = make_metadata_df([(name, "", "creator1"), (name, "SYM", "creator1")])
+    assert_same_names(df)
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "Degen: Ape 12",
+        "Degen | Ape 12",
+        "Degen-Ape-12",
+        "TYR-Infant-12",
+        "TYR-Infant 2-12",
+        "Degen Ape",
+        "Degen Ape 12",
+        "12",
+    ],
+)
+def test_separator_names(name):
+    assert_same_names(make_metadata_df([(name, "", "creator1")]))
+
+
+def test_repeated_rows_keep_index():
+    df = make_metadata_df(get_real_rows()[:50] * 20)
+    df.index = np.arange(len(df))[::-1] * 3
+    assert_same_names(df)
+
+
+@pytest.mark.parametrize(
+    "row",
+    [
+        (123, "", "creator1"),
+        ("Okay Bear #1", 123, "creator1"),
+        (None, "", "creator1"),
+        ("Okay Bear #1", np.nan, "creator1"),
+    ],
+)
+def test_non_string_values_raise(row):
+    df = make_metadata_df([("Okay Bear #1", "", "creator1"), row])
+    with pytest.raises(AttributeError):
+        get_expected(df)
+    with pytest.raises(TypeError):
+        get_collection_names(df)
+
+
+def test_non_string_creator_unused():
+    # the creator is only read when it is the collection name
+    df = make_metadata_df([("Okay Bear #1", "SYM", np.nan), ("Okay Bear #1", "", None)])
+    assert_same_names(df)
@@ -0,0 +1,106 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from spire_fyi.utils import apply_program_name, get_program_names
+
+COLUMNS = ["PROGRAM_ID", "ADDRESS_NAME", "LABEL", "FriendlyName"]
+
+
+def get_expected(df, **kwargs):
+    return df.apply(apply_program_name, axis=1, **kwargs)
+
+
+def assert_same_names(df, **kwargs):
+    expected = get_expected(df, **kwargs)
+    names = get_program_names(df, **kwargs)
+    pd.testing.assert_series_equal(names, expected, check_dtype=False, check_names=False)
+
+
+def make_program_df(n, seed=0):
+    rng = np.random.default_rng(seed)
+    program_ids = np.array([f"Program{i:05d}111111111111111111111" for i in range(max(n // 10, 1))])
+    df = pd.DataFrame(
+        {
+            "PROGRAM_ID": rng.choice(program_ids, n),
+            "ADDRESS_NAME": rng.choice(["jupiter aggregator v4", "ORCA whirlpool", "raydium", None], n),
+            "LABEL": rng.choice(["jupiter", "orca", "solana", None], n),
+            "FriendlyName": rng.choice(["Token Program", "Serum: DEX v3", None], n),
+        }
+    )
+    return df
+
+
+def test_program_names_match_apply():
+    assert_same_names(make_program_df(2000))
+
+
+def test_program_names_with_missing_values():
+    df = pd.DataFrame(
+        {
+            "PROGRAM_ID": ["a", "b", "c", "d", "e"],
+            "ADDRESS_NAME": [None, np.nan, "name", "name", None],
+            "LABEL": ["label", None, np.nan, "label", np.nan],
+            "FriendlyName": [None, "friendly", "friendly", np.nan, np.nan],
+        }
+    )
+    assert_same_names(df)
+
+
+def test_program_names_with_non_string_values():
+    df = pd.DataFrame(
+        {
+            "PROGRAM_ID": ["a", "b", "c", "d", "e"],
+            "ADDRESS_NAME": [123, "name", 4.5, "name", True],
+            "LABEL": ["label", 7, "label", None, "label"],
+            "FriendlyName": [None, None, 8, None, None],
+        },
+        dtype=object,
+    )
+    assert_same_names(df)
+
+
+def test_program_names_with_categoricals():
+    df = make_program_df(2000, seed=1)
+    for col in COLUMNS:
+        df[col] = df[col].astype("category")
+    assert_same_names(df)
+
+
+def test_program_names_with_other_columns():
+    df = make_program_df(500, seed=2).rename(columns={"PROGRAM_ID": "ADDRESS"})
+    assert_same_names(df, address_col="ADDRESS")
+
+
+def test_program_names_keep_index():
+    df = make_program_df(100, seed=3)
+    df.index = np.arange(len(df))[::-1] * 2
+    assert_same_names(df)
+
+
+def test_program_names_empty():
+    df = pd.DataFrame({x: pd.Series([], dtype=object) for x in COLUMNS})
+    assert len(get_program_names(df)) == 0
+
+
+# timings (about 15-20x here), kept out of the unit suite:
+# PYTHONPATH=. python tests/test_program_names.py
+def benchmark(n=200_000):
+    df = make_program_df(n)
+    start = time.perf_counter()
+    get_expected(df)
+    apply_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    get_program_names(df)
+    vectorized_seconds = time.perf_counter() - start
+    return apply_seconds, vectorized_seconds
+
+
+if __name__ == "__main__":
+    for n in [10_000, 100_000, 1_000_000]:
+        apply_seconds, vectorized_seconds = benchmark(n)
+        print(
+            f"{n} rows: apply {apply_seconds:.2f}s, get_program_names {vectorized_seconds:.3f}s "
+            f"({apply_seconds / vectorized_seconds:.0f}x)"
+        )
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from flipside.errors import ApiError
+
+from spire_fyi import utils
+
+COLUMNS = ["ROW"]
+
+
+class FakeSdk:
+    """Serves `n_rows` rows in pages, rejecting pages larger than `max_page_size` after `reject_after` calls."""
+
+    def __init__(self, n_rows, max_page_size, reject_after):
+        self.rows = [[i] for i in range(n_rows)]
+        self.max_page_size = max_page_size
+        self.reject_after = reject_after
+        self.calls = []
+
+    def query(self, query, page_size, page_number, **kwargs):
+        return self.get_query_results("query-id", page_number=page_number, page_size=page_size)
+
+    def get_query_results(self, query_id, page_number, page_size):
+        self.calls.append((page_number, page_size))
+        if len(self.calls) > self.reject_after and page_size >= self.max_page_size:
+            raise ApiError(
+                "RequestedPageSizeTooLarge",
+                400,
+                f"try reducing your page size to below {self.max_page_size}",
+            )
+        start = (page_number - 1) * page_size
+        return SimpleNamespace(
+            query_id=query_id,
+            page=SimpleNamespace(totalPages=-(-len(self.rows) // page_size)),
+            rows=self.rows[start : start + page_size],
+            columns=COLUMNS,
+        )
+
+
+@pytest.mark.parametrize(
+    "page_size,max_page_size,reject_after",
+    [
+        # 6250 rows written at 3125, resumes with 1562 per page, which does not divide 6250
+        (3125, 3125, 2),
+        # halving lines up with the rows already written
+        (1000, 1000, 3),
+        # rejected on the very first page
+        (2000, 1500, 0),
+    ],
+)
+def test_stream_query_to_csv_resized_pages(tmp_path, monkeypatch, page_size, max_page_size, reject_after):
+    fake_sdk = FakeSdk(10000, max_page_size, reject_after)
+    monkeypatch.setattr(utils, "sdk", fake_sdk)
+    output_file = tmp_path / "out.csv"
+
+    rows = utils.stream_query_to_csv("select 1", output_file, page_size=page_size, min_page_size=100)
+
+    assert rows == 10000
+    df = pd.read_csv(output_file)
+    assert df.ROW.tolist() == list(range(10000))
+    assert any(x[1] < page_size for x in fake_sdk.calls)
+    assert not output_file.with_name("out.csv.part").exists()
+
+
+def test_stream_query_to_csv_page_size_floor(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "sdk", FakeSdk(10000, 50, 1))
+    output_file = tmp_path / "out.csv"
+
+    with pytest.raises(ApiError):
+        utils.stream_query_to_csv("select 1", output_file, page_size=1000, min_page_size=100)
+    assert not output_file.exists()
+    assert not output_file.with_name("out.csv.part").exists()